@@ -0,0 +1,147 @@
+'''Sample acquisition of the raspberry pi pico.
+
+Copy this file to the pico next to main.py. It does not import machine or the
+MicroPython time functions, they are passed in by main.py, so the same loop can
+run on a PC with stand-in ADC objects (see benchmarks/bench_acquisition.py).
+
+Samples are written into a preallocated array in RAM and go to flash in large
+blocks, instead of one small file.write per sample. The records use the binary
+format decoded by sensor_data.py on the server. In streaming mode (StreamWriter)
+every block also goes to the server while the capture goes on'''
+import struct
+
+# Binary format, see sensor_data.py on the server
+BINARY_MAGIC = b'SNSR'
+BINARY_VERSION = 2
+BINARY_CONTENT_TYPE = 'application/x-sensor-samples'
+RECORD_FORMAT = '<HHH'  # tick delta, sharp reading, sv03 reading
+RECORD_SIZE = 6
+MAX_TICK_DELTA = 65534  # Largest delta of a sample
+TICK_SKIP = 65535  # Delta of a skip record: no sample, only 65535 ticks
+
+# 4096 records use 24 kB of RAM
+BUFFER_RECORDS = 4096
+
+
+def write_binary_header(file, channels, scales, tick_us):
+    '''Writes the header of a binary run: magic, version, channel count, record size,
+    time base, channel names and the volts per count of each channel'''
+    names = ','.join(channels).encode()
+    file.write(struct.pack('<4sBBHIH', BINARY_MAGIC, BINARY_VERSION, len(channels),
+                           2 + 2 * len(channels), tick_us, len(names)))
+    file.write(names)
+    for scale in scales:
+        file.write(struct.pack('<f', scale))
+
+
+class SampleBuffer:
+    '''Fixed size block of binary records allocated once at boot, so the
+    acquisition loop does not allocate memory or touch the flash'''
+
+    def __init__(self, capacity=BUFFER_RECORDS):
+        self.capacity = capacity
+        self.data = bytearray(RECORD_SIZE * capacity)
+        self.view = memoryview(self.data)
+        self.count = 0
+        self.flushes = 0
+
+    def full(self):
+        return self.count >= self.capacity
+
+    def append(self, tick_delta, sharp_value, sv03_value):
+        struct.pack_into(RECORD_FORMAT, self.data, self.count * RECORD_SIZE, tick_delta, sharp_value, sv03_value)
+        self.count += 1
+
+    def flush(self, file):
+        '''Writes the buffered records to the file in a single call and empties the buffer'''
+        if self.count:
+            file.write(self.view[:self.count * RECORD_SIZE])
+            self.flushes += 1
+        self.count = 0
+
+
+class StreamWriter:
+    '''File for capture() in streaming mode: every block of records written to the
+    file is also passed to send(offset, data), offset being the number of records
+    sent before it. send returns True when the server took the block. After a
+    failed send the records only go to the file, and the run is uploaded whole'''
+
+    def __init__(self, file, send, record_size=RECORD_SIZE):
+        self.file = file
+        self.send = send
+        self.record_size = record_size
+        self.records = 0
+        self.streaming = True
+
+    def write(self, data):
+        self.file.write(data)
+        if self.streaming:
+            try:
+                self.streaming = self.send(self.records, data)
+            except OSError as error:
+                print(error)
+                self.streaming = False
+        self.records += len(data) // self.record_size
+
+
+def capture(file, buffer, read_sharp, read_sv03, end_angle, ticks_us, ticks_diff,
+            tick_us=10, flush_when_full=True):
+    '''Reads both sensors until the sv03 reading reaches end_angle.
+
+    read_sharp and read_sv03 return raw read_u16() values, ticks_us and ticks_diff
+    are the clock functions of the time module. When the buffer is full it is
+    flushed to the file, or with flush_when_full=False the file is only written
+    at the end and the samples that do not fit are dropped. Returns a dictionary
+    with the samples captured and dropped, the flushes and the achieved rate in Hz'''
+    buffer.count = 0
+    buffer.flushes = 0
+    captured = 0
+    dropped = 0
+    previous_ticks = 0
+    start_time = ticks_us()
+    while True:
+        current_time = ticks_us()
+        sv03_value = read_sv03()
+        sharp_value = read_sharp()
+
+        # A zero reading of the Sharp sensor is not valid (0 V)
+        if sharp_value == 0:
+            continue
+
+        if buffer.full():
+            if flush_when_full:
+                buffer.flush(file)
+            else:
+                dropped += 1
+        if not buffer.full():
+            # Ticks since the start of the run, the delta is computed from them so
+            # that rounding does not accumulate. Dropped samples widen the next delta
+            elapsed_ticks = ticks_diff(current_time, start_time) // tick_us
+            delta = elapsed_ticks - previous_ticks
+            # A stall longer than MAX_TICK_DELTA (a slow flush, a batch sent in
+            # streaming mode) goes in skip records, so the next times stay right
+            while delta > MAX_TICK_DELTA and not buffer.full():
+                buffer.append(TICK_SKIP, 0, 0)
+                delta -= TICK_SKIP
+                if buffer.full() and flush_when_full:
+                    buffer.flush(file)
+            if buffer.full():
+                dropped += 1
+            else:
+                buffer.append(delta, sharp_value, sv03_value)
+                previous_ticks = elapsed_ticks
+                captured += 1
+
+        # Check if the total reading angle is over
+        if sv03_value >= end_angle:
+            break
+
+    duration_us = ticks_diff(ticks_us(), start_time)
+    buffer.flush(file)
+    return {
+        'captured': captured,
+        'dropped': dropped,
+        'flushes': buffer.flushes,
+        'duration_s': duration_us / 1000000,
+        'rate_hz': captured * 1000000 / duration_us if duration_us else 0,
+    }
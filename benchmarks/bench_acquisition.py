@@ -0,0 +1,95 @@
+'''Runs the pico acquisition loop (acquisition.py) on a PC with stand-in sensors and flash
+
+Usage: python benchmarks/bench_acquisition.py [--samples 20000] [--write-latency-us 900]
+The flash file charges a fixed latency per write call, which is what limits the
+loop on the pico. The captured file is decoded with sensor_data.decode_binary to
+check that it is a valid run'''
+import argparse
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from acquisition import SampleBuffer, capture, write_binary_header
+from benchmarks.synthetic import synthetic_columns
+from sensor_data import decode_binary
+
+
+class FakeADC:
+    '''Stand-in for machine.ADC that plays back a list of read_u16() values'''
+
+    def __init__(self, values):
+        self.values = values
+        self.index = 0
+
+    def read_u16(self):
+        value = self.values[min(self.index, len(self.values) - 1)]
+        self.index += 1
+        return value
+
+
+class FlashFile(io.BytesIO):
+    '''In-memory file that waits a fixed time on every write, like the pico flash'''
+
+    def __init__(self, write_latency_us):
+        super().__init__()
+        self.write_latency = write_latency_us / 1e6
+        self.writes = 0
+
+    def write(self, data):
+        self.writes += 1
+        deadline = time.perf_counter() + self.write_latency
+        while time.perf_counter() < deadline:
+            pass
+        return super().write(data)
+
+
+def ticks_us():
+    return time.perf_counter_ns() // 1000
+
+
+def ticks_diff(a, b):
+    return a - b
+
+
+def run(n_samples, capacity, flush_when_full, write_latency_us):
+    '''Captures one sweep of n_samples readings and returns the statistics'''
+    columns = synthetic_columns(n_samples)
+    sharp = FakeADC(np.round(columns['distance_reading'] / 5 * 65535).astype(int).tolist())
+    # The sweep ends on the last sample, when the angle reaches its end value
+    sv03_values = np.arange(n_samples).tolist()
+    sv03 = FakeADC(sv03_values)
+    file = FlashFile(write_latency_us)
+    write_binary_header(file, ('distance_reading', 'angle_reading'), (5 / 65535, 3.3 / 65535), 10)
+    stats = capture(file, SampleBuffer(capacity), sharp.read_u16, sv03.read_u16, sv03_values[-1],
+                    ticks_us, ticks_diff, 10, flush_when_full)
+    _, records, skipped = decode_binary(file.getvalue())
+    assert len(records) == stats['captured'] and skipped == 0
+    stats['writes'] = file.writes
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--samples', type=int, default=20000)
+    parser.add_argument('--write-latency-us', type=float, default=900)
+    args = parser.parse_args()
+
+    cases = [
+        ('write per sample', 1, True),
+        ('512 record blocks', 512, True),
+        ('4096 record blocks', 4096, True),
+        ('only at the end', 4096, False),
+    ]
+    print(f"{'strategy':>20} {'captured':>9} {'dropped':>8} {'writes':>7} {'rate (Hz)':>10}")
+    for name, capacity, flush_when_full in cases:
+        stats = run(args.samples, capacity, flush_when_full, args.write_latency_us)
+        print(f"{name:>20} {stats['captured']:>9} {stats['dropped']:>8} {stats['writes']:>7} {stats['rate_hz']:>10.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+'''Benchmark of the compressed archive tier of the run store
+
+For runs decoded from the binary format sent by the pico (the readings are ADC
+levels, as in real runs) it reports the size of the NDJSON text, of the .npy
+columns and of the archive, the full read throughput of both formats, and the time
+of a 1000-sample window and of a threshold query that the zone maps can answer by
+skipping most chunks.
+
+Usage: python benchmarks/bench_archive.py [--max-exp 7]'''
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.synthetic import synthetic_binary, synthetic_ndjson
+from run_store import RunStore
+from sensor_data import load_sensor_columns
+
+
+def best_of(function, repeats):
+    '''Returns the best wall time in seconds of several calls to function'''
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--min-exp', type=int, default=4)
+    parser.add_argument('--max-exp', type=int, default=7)
+    parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'samples':>10} {'ndjson MB':>9} {'npy MB':>7} {'arch MB':>8} {'ratio':>6} {'vs json':>7} "
+          f"{'npy MB/s':>9} {'arch MB/s':>9} {'win npy':>8} {'win arch':>8} {'thr npy':>8} {'thr arch':>8}")
+    with tempfile.TemporaryDirectory() as folder:
+        store = RunStore(folder)
+        for exponent in range(args.min_exp, args.max_exp + 1):
+            n = 10 ** exponent
+            columns, _ = load_sensor_columns(synthetic_binary(n))
+            # The NDJSON text is only measured up to 10^6 lines, beyond that it is extrapolated
+            json_bytes = len(synthetic_ndjson(min(n, 10 ** 6))) * max(1, n // 10 ** 6)
+            run = store.add(columns)
+            times = columns['time']
+            t0, t1 = times[n // 2], times[n // 2 + 999]
+            # Rare event: the last 0.1 % of the distance range
+            high = columns['distance_reading'].max()
+            low = high - (high - columns['distance_reading'].min()) * 0.001
+
+            def full_read():
+                loaded = store.load_columns(run['id'], mmap=False)
+                return sum(float(values[-1]) for values in loaded.values())
+
+            def window():
+                return store.window(run['id'], t0, t1)
+
+            def threshold():
+                return store.window(run['id'], column='distance_reading', low=low)
+
+            columns_bytes = sum(values.nbytes for values in columns.values())
+            npy_read = best_of(full_read, args.repeats)
+            npy_window = best_of(window, args.repeats)
+            npy_threshold = best_of(threshold, args.repeats)
+            report = store.compact(0)
+            archive_bytes = report['bytes_after']
+            archive_read = best_of(full_read, args.repeats)
+            archive_window = best_of(window, args.repeats)
+            archive_threshold = best_of(threshold, args.repeats)
+            mb = 1024 * 1024
+            print(f"{n:>10} {json_bytes / mb:>9.2f} {columns_bytes / mb:>7.2f} {archive_bytes / mb:>8.2f} "
+                  f"{columns_bytes / archive_bytes:>5.1f}x {json_bytes / archive_bytes:>6.1f}x "
+                  f"{columns_bytes / mb / npy_read:>9.0f} {columns_bytes / mb / archive_read:>9.0f} "
+                  f"{npy_window * 1e3:>6.2f}ms {archive_window * 1e3:>6.2f}ms "
+                  f"{npy_threshold * 1e3:>6.2f}ms {archive_threshold * 1e3:>6.2f}ms")
+
+
+if __name__ == '__main__':
+    main()
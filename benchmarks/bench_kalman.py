@@ -0,0 +1,76 @@
+'''Benchmark of kalman.kalman_filter against the filterpy loop used by generate_plot
+
+Usage: python benchmarks/bench_kalman.py [--max-exp 6]
+Every size is run on two channels (Sharp and CJMCU). The filterpy loop is only
+timed up to --max-ref-exp samples because it takes minutes beyond that'''
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from filterpy.kalman import KalmanFilter, rts_smoother
+
+from benchmarks.synthetic import synthetic_columns
+from kalman import kalman_filter
+
+
+def filterpy_reference(measurements, smooth):
+    '''The per-sample predict()/update() loop, one filter per channel'''
+    states = []
+    for channel in measurements:
+        kf = KalmanFilter(dim_x=2, dim_z=1)
+        kf.x = np.array([[0.], [0.]])
+        kf.F = np.array([[1., 1.], [0., 1.]])
+        kf.H = np.array([[1., 0.]])
+        kf.P *= 1000.
+        kf.R = 5
+        kf.Q = np.eye(2)
+        xs, Ps = [], []
+        for z in channel:
+            kf.predict()
+            kf.update(z)
+            xs.append(kf.x.copy())
+            Ps.append(kf.P.copy())
+        xs, Ps = np.array(xs), np.array(Ps)
+        if smooth:
+            xs, _, _, _ = rts_smoother(xs, Ps, [kf.F] * len(xs), [kf.Q] * len(xs))
+        states.append(xs[:, :, 0])
+    return np.array(states)
+
+
+def timed(function):
+    start = time.perf_counter()
+    result = function()
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--min-exp', type=int, default=3)
+    parser.add_argument('--max-exp', type=int, default=6)
+    parser.add_argument('--max-ref-exp', type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'samples':>10} {'mode':>8} {'filterpy':>10} {'engine':>10} {'speedup':>9} {'max error':>10}")
+    for exponent in range(args.min_exp, args.max_exp + 1):
+        n = 10 ** exponent
+        columns = synthetic_columns(n)
+        measurements = np.vstack([columns['distance_reading'], columns['angle_reading']])
+        for mode in ('filter', 'smooth', 'steady'):
+            smooth = mode == 'smooth'
+            states, new = timed(lambda: kalman_filter(measurements, smooth=smooth, steady=mode == 'steady'))
+            if exponent > args.max_ref_exp:
+                print(f"{n:>10} {mode:>8} {'-':>10} {new:>9.4f}s")
+                continue
+            reference, old = timed(lambda: filterpy_reference(measurements, smooth))
+            # The steady mode skips the initial transient, compare after it
+            skip = 50 if mode == 'steady' else 0
+            error = np.abs(states[:, skip:] - reference[:, skip:]).max()
+            print(f"{n:>10} {mode:>8} {old:>9.4f}s {new:>9.4f}s {old / new:>8.0f}x {error:>10.2e}")
+
+
+if __name__ == '__main__':
+    main()
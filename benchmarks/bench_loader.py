@@ -0,0 +1,64 @@
+'''Benchmark of the bulk NDJSON loader against webserver.read_json_to_list
+
+The last columns decode the same run in the binary format sent by the pico.
+
+Usage: python benchmarks/bench_loader.py [--max-exp 7]
+Sizes go from 10^4 lines up to 10^max-exp lines. 10^7 lines is roughly 700 MB
+of text, so it is left out of the default run'''
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from benchmarks.synthetic import synthetic_binary, write_synthetic_ndjson
+from sensor_data import load_sensor_columns
+from webserver import read_json_to_list
+
+
+def best_of(function, repeats):
+    '''Returns the best wall time in seconds of several calls to function'''
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def old_loader(filename):
+    '''The loading step as generate_plot used to do it: lists first, arrays later'''
+    distance, angle, times = read_json_to_list(filename)
+    return np.array(times), np.array(distance), np.array(angle)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--min-exp', type=int, default=4)
+    parser.add_argument('--max-exp', type=int, default=6)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'lines':>10} {'MB':>8} {'read_json_to_list':>18} {'load_sensor_columns':>20} {'speedup':>8}"
+          f" {'binary MB':>10} {'binary':>9} {'speedup':>8}")
+    with tempfile.TemporaryDirectory() as folder:
+        for exponent in range(args.min_exp, args.max_exp + 1):
+            n = 10 ** exponent
+            filename = os.path.join(folder, f'run_{n}.json')
+            size = write_synthetic_ndjson(filename, n)
+            repeats = args.repeats if exponent < 7 else 1
+            old = best_of(lambda: old_loader(filename), repeats)
+            new = best_of(lambda: load_sensor_columns(filename), repeats)
+            os.remove(filename)
+            binary = synthetic_binary(n)
+            decoded = best_of(lambda: load_sensor_columns(binary), repeats)
+            print(f"{n:>10} {size / 1e6:>8.1f} {old:>17.3f}s {new:>19.3f}s {old / new:>7.1f}x"
+                  f" {len(binary) / 1e6:>10.2f} {decoded:>8.4f}s {old / decoded:>7.0f}x")
+
+
+if __name__ == '__main__':
+    main()
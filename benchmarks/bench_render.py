@@ -0,0 +1,76 @@
+'''Benchmark of plotting.PlotRenderer against the pyplot figure built for every upload
+
+Usage: python benchmarks/bench_render.py [--max-exp 7] [--max-ref-exp 6]
+The renderer is timed on its second call, which is the steady state on the server
+(the figure already exists). The pyplot reference draws every sample'''
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+
+from plotting import PANELS, PlotRenderer
+
+
+def synthetic_results(n_samples, seed=0):
+    '''Smooth kinematic series with noise, like the output of process_readings'''
+    rng = np.random.default_rng(seed)
+    t = np.linspace(0, 9, n_samples)
+    results = {'t': t}
+    for i, (name, _, _, _, _) in enumerate(PANELS):
+        results[name] = np.sin(t * (i + 1)) * 10 ** i + rng.normal(0, 0.05 * 10 ** i, n_samples)
+    return results
+
+
+def pyplot_reference(results, filename):
+    '''The plotting code generate_plot used before the renderer'''
+    fig, axs = plt.subplots(2, 3, figsize=(15, 10))
+    for ax, (name, title, ylabel, label, color) in zip(axs.flat, PANELS):
+        ax.plot(results['t'], results[name], color=color, label=label)
+        ax.set_title(title)
+        ax.set_xlabel('Time (s)')
+        ax.set_ylabel(ylabel)
+        ax.legend()
+    plt.tight_layout()
+    plt.savefig(filename)
+    plt.close()
+
+
+def timed(function):
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--min-exp', type=int, default=3)
+    parser.add_argument('--max-exp', type=int, default=7)
+    parser.add_argument('--max-ref-exp', type=int, default=6)
+    args = parser.parse_args()
+
+    renderer = PlotRenderer()
+    print(f"{'samples':>10} {'pyplot':>9} {'renderer':>9} {'speedup':>8}")
+    with tempfile.TemporaryDirectory() as folder:
+        filename = os.path.join(folder, 'plot.png')
+        for exponent in range(args.min_exp, args.max_exp + 1):
+            n = 10 ** exponent
+            results = synthetic_results(n)
+            renderer.render(results, filename)
+            new = timed(lambda: renderer.render(results, filename))
+            if exponent > args.max_ref_exp:
+                print(f"{n:>10} {'-':>9} {new:>8.3f}s")
+                continue
+            old = timed(lambda: pyplot_reference(results, filename))
+            print(f"{n:>10} {old:>8.3f}s {new:>8.3f}s {old / new:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+'''Benchmark of the resampling stage and of the segment-parallel processing
+
+Usage: python benchmarks/bench_resample.py [--max-exp 6] [--segments 8]
+For every size the run gets --segments holes longer than resampling.MAX_GAP.
+Prints the time of resample_segments and of process_readings with the segments
+processed one after the other and in the thread pool. The last columns compare
+the derivative of a noiseless sine sampled at the pico timestamps with its exact
+value: np.gradient(y, np.gradient(t)) as generate_plot did, and np.gradient on
+the uniform grid'''
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('SENSOR_WARMUP', '0')
+
+import numpy as np
+
+from benchmarks.synthetic import synthetic_columns
+from resampling import resample_segments, RESAMPLE_RATE, MAX_GAP
+import pipeline
+import webserver
+
+
+def best_of(repeats, function):
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def with_holes(columns, n_segments):
+    '''Shifts every 1/n_segments of the run one second later'''
+    columns = dict(columns)
+    n = len(columns['time'])
+    columns['time'] = columns['time'] + np.repeat(np.arange(n_segments), -(-n // n_segments))[:n]
+    return columns
+
+
+def derivative_errors(times):
+    '''Largest error of the derivative of sin(2 pi t) with the old and the new method'''
+    frequency = 2 * np.pi
+    y = np.sin(frequency * times)
+    old = np.gradient(y, np.gradient(times))
+    segment, = resample_segments({'time': times, 'y': y}, RESAMPLE_RATE, np.inf)
+    new = np.gradient(segment['y'], 1. / RESAMPLE_RATE)
+    exact_old = frequency * np.cos(frequency * times)
+    exact_new = frequency * np.cos(frequency * segment['time'])
+    # The one-sided differences at the ends are less accurate in both methods
+    return np.nanmax(np.abs(old - exact_old)[1:-1]), np.abs(new - exact_new)[1:-1].max()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--min-exp', type=int, default=4)
+    parser.add_argument('--max-exp', type=int, default=6)
+    parser.add_argument('--segments', type=int, default=8)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"rate {RESAMPLE_RATE:g} Hz, gaps over {MAX_GAP:g} s split the run, {os.cpu_count()} CPUs")
+    print(f"{'samples':>10} {'resample':>10} {'serial':>10} {'parallel':>10} {'speedup':>8} "
+          f"{'old error':>10} {'new error':>10}")
+    for exponent in range(args.min_exp, args.max_exp + 1):
+        n = 10 ** exponent
+        base = synthetic_columns(n)
+        columns = with_holes(base, args.segments)
+        resample = best_of(args.repeats, lambda: resample_segments(columns))
+
+        pipeline.PARALLEL_MIN_SAMPLES = float('inf')
+        serial = best_of(args.repeats, lambda: webserver.process_readings(columns))
+        pipeline.PARALLEL_MIN_SAMPLES = 0
+        parallel = best_of(args.repeats, lambda: webserver.process_readings(columns))
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            old_error, new_error = derivative_errors(base['time'])
+        print(f"{n:>10} {resample:>9.4f}s {serial:>9.4f}s {parallel:>9.4f}s {serial / parallel:>7.2f}x "
+              f"{old_error:>10.2e} {new_error:>10.2e}")
+
+
+if __name__ == '__main__':
+    main()
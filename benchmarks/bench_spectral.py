@@ -0,0 +1,93 @@
+'''Benchmark of the spectral derivatives against savgol_filter plus np.gradient
+
+Usage: python benchmarks/bench_spectral.py [--max-exp 6] [--noise 0.01]
+The test signal is known analytically on two channels, like r and theta after
+the Kalman filter: a sum of slow sines plus a ramp, sampled on the uniform grid
+of resampling.RESAMPLE_RATE with gaussian noise added. For each method it prints
+the time of the two channels and the RMS error of the signal and of its first and
+second derivatives, over the whole run and without the first and last 5%'''
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from scipy.signal import savgol_filter
+
+from resampling import RESAMPLE_RATE
+from spectral import spectral_derivatives
+
+# (amplitude, frequency in Hz) of the sines of each channel
+CHANNELS = (((1.0, 0.3), (0.2, 1.7), (0.05, 4.0)),
+            ((40.0, 0.1), (10.0, 0.9), (2.0, 3.1)))
+RAMP = 0.5
+
+
+def known_signal(t):
+    '''Returns (values, first derivatives, second derivatives) of both channels'''
+    values, first, second = [], [], []
+    for components in CHANNELS:
+        y, y_dot, y_ddot = RAMP * t, np.full_like(t, RAMP), np.zeros_like(t)
+        for amplitude, frequency in components:
+            w = 2 * np.pi * frequency
+            y = y + amplitude * np.sin(w * t)
+            y_dot = y_dot + amplitude * w * np.cos(w * t)
+            y_ddot = y_ddot - amplitude * w * w * np.sin(w * t)
+        values.append(y)
+        first.append(y_dot)
+        second.append(y_ddot)
+    return np.array(values), np.array(first), np.array(second)
+
+
+def gradient_path(values, dt, window=51, order=3):
+    '''The path of process_readings: Savitzky-Golay, then two chained np.gradient'''
+    smoothed = savgol_filter(values, window_length=window, polyorder=order, axis=1)
+    first = np.gradient(smoothed, dt, axis=1)
+    return smoothed, first, np.gradient(first, dt, axis=1)
+
+
+def spectral_path(values, dt):
+    return tuple(spectral_derivatives(values, dt))
+
+
+def best_of(repeats, function):
+    best, result = float('inf'), None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def rms(error, margin):
+    cut = int(error.shape[1] * margin)
+    return float(np.sqrt(np.mean(error[:, cut:error.shape[1] - cut] ** 2)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--min-exp', type=int, default=4)
+    parser.add_argument('--max-exp', type=int, default=6)
+    parser.add_argument('--noise', type=float, default=0.01)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    dt = 1. / RESAMPLE_RATE
+    print(f"{RESAMPLE_RATE:g} Hz grid, noise {args.noise:g}. RMS error whole run / inner 90%")
+    print(f"{'samples':>10} {'method':>9} {'time':>9} {'signal':>19} {'1st derivative':>19} {'2nd derivative':>19}")
+    rng = np.random.default_rng(0)
+    for exponent in range(args.min_exp, args.max_exp + 1):
+        n = 10 ** exponent
+        t = np.arange(n) * dt
+        exact = known_signal(t)
+        noisy = exact[0] + rng.normal(0., args.noise, exact[0].shape)
+        for name, method in (('gradient', gradient_path), ('spectral', spectral_path)):
+            elapsed, result = best_of(args.repeats, lambda: method(noisy, dt))
+            errors = ' '.join(f"{rms(r - e, 0):>9.3g} {rms(r - e, 0.05):>9.3g}" for r, e in zip(result, exact))
+            print(f"{n:>10} {name:>9} {elapsed:>8.4f}s {errors}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+'''Benchmark of the startup of the web server and of its first processed upload
+
+Every measurement runs in a new Python process, in a temporary folder so the
+result cache and the output files of the repository are not touched.
+- import: time to import webserver, and whether the heavy libraries were loaded
+- first request: import plus one /check_start_signal request
+- first upload: processing of the first run (generate_plot) on a cold process
+- after warmup: the same, once warmup() has finished
+
+Usage: python benchmarks/bench_startup.py [--repeats 3] [--samples 10000]'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ('pandas', 'scipy', 'matplotlib', 'openpyxl')
+
+CHILD = '''
+import json, sys, time
+sys.path.insert(0, {repository!r})
+started = time.perf_counter()
+import webserver
+timings = {{'import': time.perf_counter() - started}}
+timings['heavy'] = sorted(name for name in {heavy!r} if name in sys.modules)
+started = time.perf_counter()
+webserver.app.test_client().get('/check_start_signal')
+timings['first request'] = timings['import'] + time.perf_counter() - started
+if {warm!r} and hasattr(webserver, 'warmup'):
+    webserver.warmup()
+from benchmarks.synthetic import write_synthetic_ndjson
+write_synthetic_ndjson('run.json', {samples!r})
+started = time.perf_counter()
+webserver.generate_plot('run.json')
+timings['upload'] = time.perf_counter() - started
+print(json.dumps(timings))
+'''
+
+
+def run_child(samples, warm):
+    '''Runs one measurement in a new process and returns its timings'''
+    code = CHILD.format(repository=REPOSITORY, heavy=HEAVY_MODULES, warm=warm, samples=samples)
+    with tempfile.TemporaryDirectory() as folder:
+        output = subprocess.run([sys.executable, '-W', 'ignore', '-c', code], cwd=folder,
+                                check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--samples', type=int, default=10_000)
+    args = parser.parse_args()
+
+    cold = [run_child(args.samples, False) for _ in range(args.repeats)]
+    warm = [run_child(args.samples, True) for _ in range(args.repeats)]
+    median = lambda runs, name: statistics.median(run[name] for run in runs)
+    print(f"import webserver:             {median(cold, 'import'):.3f} s")
+    print(f"heavy modules after import:   {', '.join(cold[0]['heavy']) or 'none'}")
+    print(f"import + first request:       {median(cold, 'first request'):.3f} s")
+    print(f"first upload, cold:           {median(cold, 'upload'):.3f} s")
+    print(f"first upload, after warmup:   {median(warm, 'upload'):.3f} s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+'''Benchmark of the streaming mode: online pipeline against the batch one, and the
+time from the end of a capture to a processed run
+
+Usage: python benchmarks/bench_streaming.py [--samples 100000] [--batch 512]
+- online: OnlinePipeline fed --batch records at a time, per batch and in total,
+  against process_readings of the whole run, with the largest relative
+  difference of every series (the online stages give the same samples)
+- end to end, with the Flask test client in a temporary folder: a binary run
+  sent in batches to /streams and then closed, against the same run uploaded
+  whole to /upload_json. 'ready' is the time from the last byte sent to the
+  moment the run can be read from /runs/<id>/series'''
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('SENSOR_WARMUP', '0')
+
+import numpy as np
+
+from benchmarks.synthetic import synthetic_binary
+from sensor_data import binary_to_columns, decode_binary
+
+
+def wait_for_job(client, job_id, timeout=600.):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        status = client.get(f'/jobs/{job_id}').get_json()
+        if status['state'] in ('done', 'failed'):
+            return status
+        time.sleep(0.005)
+    raise TimeoutError(f'job {job_id} still running')
+
+
+def batches(raw, batch):
+    '''Header of a binary run and its records in blocks of batch records'''
+    header, _, _ = decode_binary(raw)
+    size = header['header_size']
+    step = batch * header['record_size']
+    return raw[:size], [raw[offset:offset + step] for offset in range(size, len(raw), step)]
+
+
+def bench_online(webserver, raw, batch):
+    from online import OnlinePipeline
+
+    columns, _ = binary_to_columns(raw)
+    started = time.perf_counter()
+    expected = webserver.process_readings(columns)
+    batch_seconds = time.perf_counter() - started
+
+    n = len(columns['time'])
+    pipeline = OnlinePipeline(webserver.PROCESSING_PARAMETERS)
+    latencies = []
+    for start in range(0, n, batch):
+        piece = {name: values[start:start + batch] for name, values in columns.items()}
+        started = time.perf_counter()
+        pipeline.feed(piece)
+        latencies.append(time.perf_counter() - started)
+    started = time.perf_counter()
+    results = pipeline.finish()
+    finish_seconds = time.perf_counter() - started
+
+    print(f"batch pipeline {batch_seconds * 1000:8.1f} ms")
+    print(f"online pipeline {sum(latencies) * 1000:7.1f} ms in {len(latencies)} batches of {batch} "
+          f"(p50 {np.median(latencies) * 1000:.2f} ms, max {max(latencies) * 1000:.2f} ms), "
+          f"finish {finish_seconds * 1000:.2f} ms")
+    for name, values in expected.items():
+        if len(values) != len(results[name]):
+            print(f"  {name}: {len(results[name])} samples instead of {len(values)}")
+            continue
+        scale = np.abs(values).max() or 1.
+        print(f"  {name:>10} max relative difference {np.abs(results[name] - values).max() / scale:.1e}")
+
+
+def bench_end_to_end(webserver, raw, batch):
+    client = webserver.app.test_client()
+    header, blocks = batches(raw, batch)
+    stream_id = client.post('/streams?device=bench', data=header).get_data(as_text=True)
+    offset = 0
+    started = time.perf_counter()
+    for block in blocks:
+        response = client.post(f'/streams/{stream_id}/records?offset={offset}', data=block)
+        assert response.status_code == 200, response.data
+        offset = int(response.headers['X-Records'])
+    sending = time.perf_counter() - started
+    started = time.perf_counter()
+    response = client.post(f'/streams/{stream_id}/end')
+    assert response.status_code == 200, response.data
+    stream_ready = time.perf_counter() - started
+    client.get(f"/runs/{response.headers['X-Run-Id']}/series").get_data()
+    wait_for_job(client, response.headers['X-Job-Id'])
+
+    # The same bytes would come from the result cache, without the last record
+    # the upload is processed again
+    raw = raw[:-decode_binary(raw)[0]['record_size']]
+    started = time.perf_counter()
+    response = client.post('/upload_json?device=bench', data=raw, content_type='application/x-sensor-samples')
+    status = wait_for_job(client, response.headers['X-Job-Id'])
+    assert status['state'] == 'done', status
+    upload_ready = time.perf_counter() - started
+
+    print(f"streamed: {len(blocks)} batches sent in {sending:.2f} s, ready {stream_ready * 1000:.1f} ms "
+          f"after the end")
+    print(f"uploaded: ready {upload_ready * 1000:.1f} ms after the capture (upload, processing and plot)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--samples', type=int, default=100_000)
+    parser.add_argument('--batch', type=int, default=512, help='records per batch, STREAM_BATCH_RECORDS of main.py')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as folder:
+        os.chdir(folder)
+        import webserver
+        # scipy and matplotlib are not part of the times
+        webserver.warmup()
+        raw = synthetic_binary(args.samples)
+        bench_online(webserver, raw, args.batch)
+        bench_end_to_end(webserver, raw, args.batch)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+'''Benchmark of time window queries on stored runs
+
+Compares RunStore.window, which binary searches the memory-mapped columns, with
+loading the whole run and slicing it. The window always holds --window samples, so
+the memory-mapped query should take the same time whatever the length of the run.
+
+Usage: python benchmarks/bench_window.py [--max-exp 7] [--window 1000]'''
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from benchmarks.synthetic import synthetic_columns
+from run_store import RunStore
+
+
+def best_of(function, repeats):
+    '''Returns the best wall time in seconds of several calls to function'''
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--min-exp', type=int, default=4)
+    parser.add_argument('--max-exp', type=int, default=7)
+    parser.add_argument('--window', type=int, default=1000)
+    parser.add_argument('--repeats', type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"{'samples':>10} {'full load':>11} {'mmap window':>12} {'speedup':>8}")
+    with tempfile.TemporaryDirectory() as folder:
+        store = RunStore(folder)
+        for exponent in range(args.min_exp, args.max_exp + 1):
+            n = 10 ** exponent
+            run = store.add(synthetic_columns(n))
+            times = store.load_columns(run['id'])['time']
+            t0, t1 = times[n // 2], times[n // 2 + args.window - 1]
+
+            def full_load():
+                columns = store.load_columns(run['id'], mmap=False)
+                start, end = np.searchsorted(columns['time'], [t0, t1], side='left')
+                return {name: values[start:end + 1] for name, values in columns.items()}
+
+            def mmap_window():
+                columns, _, _ = store.window(run['id'], t0, t1)
+                # Touch the values, as a response would
+                return sum(float(values.sum()) for values in columns.values())
+
+            old = best_of(full_load, max(1, args.repeats // 4))
+            new = best_of(mmap_window, args.repeats)
+            print(f"{n:>10} {old * 1e3:>9.2f}ms {new * 1e3:>10.2f}ms {old / new:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+'''Regression checks of the answers of the server to runs and requests it cannot use
+
+Usage: python benchmarks/check_errors.py
+Runs the server with the Flask test client in a temporary folder and checks:
+- a run the pipeline cannot process (every distance reading 0, so r is infinite)
+  fails its job once, and every later read of the run answers 422 without
+  processing it again
+- malformed ?t0= and ?t1= answer 400 on every route with a time window
+- uploads without samples (empty, garbage, a binary body shorter than its
+  magic) answer 400 and leave no run, job or upload file behind'''
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('SENSOR_WARMUP', '0')
+
+from benchmarks.synthetic import synthetic_ndjson
+
+# Routes that need the processed series of a run
+PROCESSED_ROUTES = ('series', 'plot.png', 'export.csv', 'export.npz', 'window?kind=processed')
+# Routes of a run with ?t0= and ?t1=
+WINDOW_ROUTES = ('series', 'window', 'window?kind=processed')
+# (body, Content-Type) of uploads that hold no run
+EMPTY_UPLOADS = ((b'', 'application/json'), (b'garbage\n', 'application/json'), (b'\n\n', 'application/json'),
+                 (b'SNS', 'application/json'), (b'', 'application/x-sensor-samples'),
+                 (b'SNS', 'application/x-sensor-samples'), (b'{"time": 0}\n', 'application/x-sensor-samples'))
+
+
+def wait_for_job(client, job_id, timeout=120.):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        status = client.get(f'/jobs/{job_id}').get_json()
+        if status['state'] in ('done', 'failed'):
+            return status
+        time.sleep(0.05)
+    raise TimeoutError(f'job {job_id} still running')
+
+
+def check_unprocessable_run(webserver, client):
+    body = ''.join(json.dumps({'distance_reading': 0, 'time': index * 0.002, 'angle_reading': 1.5}) + '\n'
+                   for index in range(500))
+    response = client.post('/upload_json?device=check', data=body, content_type='application/json')
+    assert response.status_code == 202, response.data
+    status = wait_for_job(client, response.headers['X-Job-Id'])
+    assert status['state'] == 'failed', status
+    run_id = response.headers['X-Run-Id']
+    assert 'error' in client.get(f'/runs/{run_id}/pipeline').get_json()
+
+    processed = []
+    original = webserver.process_readings
+    webserver.process_readings = lambda *args, **kwargs: processed.append(args) or original(*args, **kwargs)
+    try:
+        for route in PROCESSED_ROUTES:
+            response = client.get(f'/runs/{run_id}/{route}')
+            assert response.status_code == 422, (route, response.status_code, response.data)
+            assert response.get_json()['run_id'] == run_id
+    finally:
+        webserver.process_readings = original
+    assert not processed, f'processed again {len(processed)} times'
+    print(f"unprocessable run: job failed, {len(PROCESSED_ROUTES)} routes answer 422 without processing it")
+
+
+def check_time_windows(client):
+    response = client.post('/upload_json?device=check', data=synthetic_ndjson(2000), content_type='application/json')
+    status = wait_for_job(client, response.headers['X-Job-Id'])
+    assert status['state'] == 'done', status
+    run_id = response.headers['X-Run-Id']
+    for route in WINDOW_ROUTES:
+        separator = '&' if '?' in route else '?'
+        for query in ('t0=abc', 't1=nan', 't0=0.5&t1=', 't0=nan&t1=1'):
+            response = client.get(f'/runs/{run_id}/{route}{separator}{query}')
+            assert response.status_code == 400, (route, query, response.status_code)
+        response = client.get(f'/runs/{run_id}/{route}{separator}t0=0.5&t1=1')
+        assert response.status_code == 200, (route, response.status_code)
+    print(f"time windows: malformed t0 and t1 answer 400 on {len(WINDOW_ROUTES)} routes")
+
+
+def check_empty_uploads(webserver, client):
+    runs = client.get('/runs').get_json()['total']
+    job = client.get('/jobs/latest').get_json()
+    for body, content_type in EMPTY_UPLOADS:
+        response = client.post('/upload_json?device=check', data=body, content_type=content_type)
+        assert response.status_code == 400, (body, content_type, response.status_code, response.data)
+    assert client.get('/runs').get_json()['total'] == runs
+    assert client.get('/jobs/latest').get_json() == job
+    leftovers = [name for name in os.listdir(webserver.run_store.folder) if name.startswith('upload-')]
+    assert not leftovers, leftovers
+    print(f"empty uploads: {len(EMPTY_UPLOADS)} bodies answer 400 without a run")
+
+
+def main():
+    with tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as folder:
+        os.chdir(folder)
+        import webserver
+        client = webserver.app.test_client()
+        check_unprocessable_run(webserver, client)
+        check_time_windows(client)
+        check_empty_uploads(webserver, client)
+
+
+if __name__ == '__main__':
+    main()
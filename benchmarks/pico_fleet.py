@@ -0,0 +1,235 @@
+'''Load generator that simulates a lab of pico stations against a running server
+
+Usage: python benchmarks/pico_fleet.py --url http://127.0.0.1:5000 [--devices 20] [--duration 60]
+Start the server first (python webserver.py, or gunicorn). Every simulated device
+repeats what main.py does on the wire, with one asyncio task per device:
+- polls /check_start_signal?device=<id> (long polling with ?wait=, as main.py
+  does now, or with --poll-interval 1 the old firmware: ?wait=0 and 1 s between polls)
+- when the start signal comes, waits --capture-seconds as the sweep would and
+  POSTs its run to /upload_json?device=<id> the way urequests sends the generator
+  of send_file_in_chunks: HTTP/1.0, Transfer-Encoding: chunked, 1 KB chunks
+- checks the body against 'JSON file received successfully', the only answer the
+  pico takes as a success. Like send_file_in_chunks it never sends a run twice:
+  the next capture overwrites the file, so any other answer is a lost run
+The start buttons are pressed through /start_reading, every --run-interval
+seconds per device on average, with random offsets so the devices do not start
+in step. Like urequests, every request opens its own connection.
+
+At the end it prints, per request kind, the requests per second, the latency
+percentiles and the errors by kind, plus the upload throughput. The latency of a
+long poll includes the time it was held, the server time shows with short polls.
+--json writes the same numbers to a file'''
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import sys
+import time
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from benchmarks.synthetic import synthetic_binary, synthetic_ndjson
+from sensor_data import BINARY_CONTENT_TYPE
+
+# Exact body the firmware compares the upload answer with
+SUCCESS_TEXT = 'JSON file received successfully'
+# Size of the chunks of send_file_in_chunks
+CHUNK_SIZE = 1024
+# Seconds the firmware waits after a failed poll
+RETRY_DELAY = 1.
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+class HTTPError(Exception):
+    pass
+
+
+async def http_request(host, port, method, path, body_chunks=None, content_type=None, timeout=30.):
+    '''Request written like urequests writes it. Returns (status, body bytes)'''
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    try:
+        head = [f'{method} {path} HTTP/1.0', f'Host: {host}']
+        if content_type:
+            head.append(f'Content-Type: {content_type}')
+        if body_chunks is not None:
+            head.append('Transfer-Encoding: chunked')
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode())
+        if body_chunks is not None:
+            for chunk in body_chunks:
+                writer.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+                await writer.drain()
+            writer.write(b'0\r\n\r\n')
+        await writer.drain()
+        status_line = await asyncio.wait_for(reader.readline(), timeout)
+        parts = status_line.split(None, 2)
+        if len(parts) < 2:
+            raise HTTPError(f'bad status line {status_line!r}')
+        # HTTP/1.0: the server closes the connection after the body
+        response = await asyncio.wait_for(reader.read(), timeout)
+        return int(parts[1]), response.partition(b'\r\n\r\n')[2]
+    finally:
+        writer.close()
+
+
+def file_chunks(data):
+    '''The generator of send_file_in_chunks, over a run in memory'''
+    for offset in range(0, len(data), CHUNK_SIZE):
+        yield data[offset:offset + CHUNK_SIZE]
+
+
+class Stats:
+    '''Latencies and errors of one kind of request'''
+
+    def __init__(self):
+        self.latencies = []
+        self.errors = {}
+        self.bytes = 0
+
+    def record(self, started, error=None, size=0):
+        if error is None:
+            self.latencies.append(time.perf_counter() - started)
+            self.bytes += size
+        else:
+            self.errors[error] = self.errors.get(error, 0) + 1
+
+    def summary(self, elapsed):
+        requests = len(self.latencies) + sum(self.errors.values())
+        summary = {'requests': requests, 'ok': len(self.latencies), 'per_second': requests / elapsed,
+                   'errors': self.errors, 'error_rate': sum(self.errors.values()) / requests if requests else 0.,
+                   'megabytes_per_second': self.bytes / elapsed / 1e6}
+        if self.latencies:
+            values = np.percentile(self.latencies, PERCENTILES)
+            summary['latency'] = {f'p{p:g}': float(v) for p, v in zip(PERCENTILES, values)}
+            summary['latency']['max'] = max(self.latencies)
+        return summary
+
+
+def error_name(error):
+    if isinstance(error, asyncio.TimeoutError):
+        return 'timeout'
+    if isinstance(error, (ConnectionError, OSError)):
+        return 'connection'
+    return type(error).__name__
+
+
+async def device(args, host, port, device_id, runs, stats, stop):
+    '''Main loop of main.py: poll the start signal, capture, upload'''
+    wait = 0 if args.poll_interval else args.start_wait
+    content_type = BINARY_CONTENT_TYPE if args.binary else 'application/json'
+    while not stop.is_set():
+        started = time.perf_counter()
+        try:
+            status, body = await http_request(host, port, 'GET',
+                                              f'/check_start_signal?wait={wait:g}&device={device_id}',
+                                              timeout=wait + 5)
+            start = status == 200 and json.loads(body).get('start')
+            stats['poll'].record(started, None if status == 200 else f'http {status}')
+        except Exception as error:
+            stats['poll'].record(started, error_name(error))
+            await asyncio.sleep(RETRY_DELAY)
+            continue
+        if not start:
+            if args.poll_interval:
+                await asyncio.sleep(args.poll_interval)
+            continue
+        await asyncio.sleep(args.capture_seconds)
+        run = next(runs)
+        # One attempt, as the firmware: an error here is a run lost for good
+        started = time.perf_counter()
+        try:
+            status, body = await http_request(host, port, 'POST', f'/upload_json?device={device_id}',
+                                              file_chunks(run), content_type, timeout=args.upload_timeout)
+            if body.decode(errors='replace') == SUCCESS_TEXT:
+                stats['upload'].record(started, size=len(run))
+            else:
+                stats['upload'].record(started, f'http {status}')
+        except Exception as error:
+            stats['upload'].record(started, error_name(error))
+
+
+async def press_start_buttons(args, host, port, device_ids, stats, stop):
+    '''Presses the start button of a random device, device_ids / run_interval times a second'''
+    while not stop.is_set():
+        await asyncio.sleep(random.expovariate(len(device_ids) / args.run_interval))
+        started = time.perf_counter()
+        try:
+            status, _ = await http_request(host, port, 'GET', f'/start_reading?device={random.choice(device_ids)}')
+            stats['start'].record(started, None if status == 200 else f'http {status}')
+        except Exception as error:
+            stats['start'].record(started, error_name(error))
+
+
+async def fleet(args):
+    url = urlsplit(args.url)
+    host, port = url.hostname, url.port or 80
+    device_ids = [f'sim-{index:03d}' for index in range(args.devices)]
+    # Runs the server has not seen yet, a run sent twice would come from the result cache
+    runs = [synthetic_binary(args.samples, seed) if args.binary else synthetic_ndjson(args.samples, seed)
+            for seed in range(args.distinct_runs)]
+    next_run = itertools.cycle(runs)
+    stats = {'poll': Stats(), 'upload': Stats(), 'start': Stats()}
+    stop = asyncio.Event()
+    tasks = [asyncio.create_task(device(args, host, port, device_id, next_run, stats, stop))
+             for device_id in device_ids]
+    tasks.append(asyncio.create_task(press_start_buttons(args, host, port, device_ids, stats, stop)))
+    started = time.perf_counter()
+    await asyncio.sleep(args.duration)
+    stop.set()
+    # Requests in flight are not counted, the long polls would otherwise end the run late
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    elapsed = time.perf_counter() - started
+    return {'devices': args.devices, 'duration': elapsed, 'run_bytes': len(runs[0]),
+            'requests': {name: kind.summary(elapsed) for name, kind in stats.items()}}
+
+
+def print_report(report):
+    print(f"{report['devices']} devices, {report['duration']:.1f} s, runs of {report['run_bytes'] / 1e3:.0f} kB")
+    print(f"{'request':>8} {'count':>7} {'req/s':>8} {'p50':>8} {'p90':>8} {'p99':>8} {'p99.9':>8} {'max':>8} "
+          f"{'errors':>7} {'MB/s':>6}  error kinds")
+    for name, summary in report['requests'].items():
+        latency = summary.get('latency', {})
+        columns = ' '.join(f"{latency[key] * 1000:>6.0f}ms" if key in latency else f"{'-':>8}"
+                           for key in ('p50', 'p90', 'p99', 'p99.9', 'max'))
+        kinds = ', '.join(f'{kind}: {count}' for kind, count in sorted(summary['errors'].items()))
+        print(f"{name:>8} {summary['requests']:>7} {summary['per_second']:>8.2f} {columns} "
+              f"{summary['error_rate']:>6.1%} {summary['megabytes_per_second']:>6.2f}  {kinds}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--devices', type=int, default=20)
+    parser.add_argument('--duration', type=float, default=60., help='seconds of load')
+    parser.add_argument('--samples', type=int, default=20000, help='samples of every run')
+    parser.add_argument('--run-interval', type=float, default=30.,
+                        help='mean seconds between two runs of the same device')
+    parser.add_argument('--capture-seconds', type=float, default=0., help='duration of the simulated sweep')
+    parser.add_argument('--start-wait', type=float, default=25., help='?wait= of the long polls, as main.py')
+    parser.add_argument('--poll-interval', type=float, default=0.,
+                        help='seconds between short polls (old firmware: 1), 0 for long polling')
+    parser.add_argument('--json-lines', dest='binary', action='store_false',
+                        help='upload JSON lines instead of the binary format')
+    parser.add_argument('--upload-timeout', type=float, default=60.)
+    parser.add_argument('--distinct-runs', type=int, default=64,
+                        help='different runs generated, taken in turn by the uploads; after that they are cache hits')
+    parser.add_argument('--json', help='file for the report in JSON')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    report = asyncio.run(fleet(args))
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(report, file, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+'''Local scrape of /metrics after a few uploads, and the cost of recording a value
+
+Usage: python benchmarks/scrape_metrics.py [--uploads 3] [--samples 20000]
+Runs the server with the Flask test client in a temporary folder: polls the start
+signal, uploads synthetic runs, waits for their jobs, downloads the plot and a csv
+export twice (a miss, then a hit) and scrapes /metrics. Checks that the scrape
+parses and that every metric family has the expected samples, then times
+Counter.inc and Histogram.observe against a plain dict increment'''
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('SENSOR_WARMUP', '0')
+
+from benchmarks.synthetic import synthetic_ndjson
+from metrics import Registry
+
+EXPECTED_SAMPLES = (
+    'sensor_upload_bytes_count', 'sensor_upload_seconds_count', 'sensor_uploads_total{result="accepted"}',
+    'sensor_stage_seconds_count{stage="parse"}', 'sensor_stage_seconds_count{stage="resample"}',
+    'sensor_stage_seconds_count{stage="kalman"}', 'sensor_stage_seconds_count{stage="plot"}',
+    'sensor_stage_seconds_count{stage="export"}', 'sensor_start_polls_total{device="bench"}',
+    'sensor_output_requests_total{file="plot",result="hit"}',
+    'sensor_output_requests_total{file="export",result="miss"}',
+    'sensor_jobs_queued', 'sensor_jobs_running', 'sensor_result_cache_lookups_total{result="misses"}',
+)
+
+
+def parse_exposition(text):
+    '''Returns {sample name with labels: value} and {family: type} of a scrape'''
+    samples, types = {}, {}
+    for line in text.splitlines():
+        if line.startswith('# TYPE '):
+            _, _, family, kind = line.split(' ')
+            types[family] = kind
+        elif line and not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            samples[name] = float(value)
+    return samples, types
+
+
+def wait_for_job(client, job_id, timeout=120.):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        status = client.get(f'/jobs/{job_id}').get_json()
+        if status['state'] in ('done', 'failed'):
+            return status
+        time.sleep(0.05)
+    raise TimeoutError(f'job {job_id} still running')
+
+
+def scrape(n_uploads, n_samples):
+    import webserver
+    client = webserver.app.test_client()
+    run_ids = []
+    for index in range(n_uploads):
+        client.get('/check_start_signal?device=bench')
+        response = client.post('/upload_json?device=bench', data=synthetic_ndjson(n_samples, seed=index),
+                               content_type='application/json')
+        assert response.status_code == 202, response.data
+        status = wait_for_job(client, response.headers['X-Job-Id'])
+        assert status['state'] == 'done', status
+        run_ids.append(response.headers['X-Run-Id'])
+    for run_id in run_ids[:1]:
+        for _ in range(2):
+            client.get(f'/runs/{run_id}/plot.png').get_data()
+            client.get(f'/runs/{run_id}/export.csv').get_data()
+
+    start = time.perf_counter()
+    response = client.get('/metrics')
+    elapsed = time.perf_counter() - start
+    assert response.status_code == 200
+    assert response.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+    samples, types = parse_exposition(response.get_data(as_text=True))
+    missing = [name for name in EXPECTED_SAMPLES if name not in samples]
+    assert not missing, f'missing samples: {missing}'
+    assert samples['sensor_upload_bytes_count'] == n_uploads
+    assert samples['sensor_start_polls_total{device="bench"}'] == n_uploads
+    assert types['sensor_stage_seconds'] == 'histogram'
+    print(f"scrape: {len(samples)} samples in {len(types)} families, {len(response.data)} bytes, "
+          f"{elapsed * 1000:.2f} ms")
+    for name in sorted(samples):
+        if name.startswith('sensor_stage_seconds_sum'):
+            print(f"  {name} {samples[name]:.4f}")
+
+
+def recording_cost(calls):
+    '''Nanoseconds per call of inc and observe, and of a dict increment for comparison'''
+    registry = Registry()
+    counter = registry.counter('bench_total', '', labels=('device',))
+    histogram = registry.histogram('bench_seconds', '', labels=('stage',))
+    plain = {}
+    results = {}
+    for name, function in (('dict += 1', lambda: plain.__setitem__('a', plain.get('a', 0) + 1)),
+                           ('Counter.inc', lambda: counter.inc('pico')),
+                           ('Histogram.observe', lambda: histogram.observe(0.003, 'kalman'))):
+        start = time.perf_counter()
+        for _ in range(calls):
+            function()
+        results[name] = (time.perf_counter() - start) / calls * 1e9
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--uploads', type=int, default=3)
+    parser.add_argument('--samples', type=int, default=20000)
+    parser.add_argument('--calls', type=int, default=200000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as folder:
+        os.chdir(folder)
+        scrape(args.uploads, args.samples)
+    for name, nanoseconds in recording_cost(args.calls).items():
+        print(f"{name:>18} {nanoseconds:>7.0f} ns/call")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+'''Benchmark suite of the whole server path on synthetic runs, with a baseline
+
+Usage: python benchmarks/suite.py [--max-exp 6] [--save-baseline] [--threshold 0.25]
+Every size from 10^min-exp to 10^max-exp samples gets a synthetic run like
+received_sensor_readings.json (benchmarks/synthetic.py) and times, best of
+--repeats:
+- read_json_to_list: the old line by line loader of webserver
+- parse: load_sensor_columns, the loader of the uploads
+- every stage of the configured pipeline (resample, kalman, calibrate, savgol,
+  gradient...) as reported by process_readings
+- plot: PlotRenderer.render of the processed run to a PNG
+- export_csv, export_npy and export_xlsx (the old export_to_excel), the last one
+  only up to XLSX_MAX_SAMPLES rows
+- generate_plot: processing plus plot of a run that is not in the result cache
+- upload_to_plot: POST /upload_json, wait for the job and GET /runs/<id>/plot.png
+
+The server runs with the Flask test client in a temporary folder, with the memory
+tracing of the pipeline off. The results are written as JSON to --output and
+compared with --baseline: a stage regresses when it is more than --threshold
+slower (25% by default) and at least MIN_REGRESSION_SECONDS slower, so the
+stages that take microseconds do not fail on noise. The exit status is 1 when
+something regressed. The baseline belongs to the machine that wrote it,
+--save-baseline replaces it with the results of this run.
+
+10^7 samples need several GB of memory and minutes per repeat, so they are left
+out of the default run'''
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPOSITORY)
+os.environ.setdefault('SENSOR_WARMUP', '0')
+os.environ.setdefault('SENSOR_TRACE_MEMORY', '0')
+
+import numpy as np
+
+from benchmarks.synthetic import synthetic_ndjson
+
+BASELINE_FILE = os.path.join(REPOSITORY, 'benchmarks', 'baseline.json')
+RESULTS_FILE = os.path.join(REPOSITORY, 'benchmarks', 'results', 'latest.json')
+# openpyxl writes about 10^4 rows per second and Excel stops at 1048576 rows
+XLSX_MAX_SAMPLES = 10 ** 5
+# Differences below this are noise, whatever the ratio
+MIN_REGRESSION_SECONDS = 0.005
+# Stages with more variance than the rest (disk, threads, matplotlib)
+STAGE_THRESHOLDS = {'upload_to_plot': 0.5, 'generate_plot': 0.5, 'plot': 0.5}
+
+
+def best_of(repeats, function):
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def wait_for_job(client, job_id, timeout=600.):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        status = client.get(f'/jobs/{job_id}').get_json()
+        if status['state'] in ('done', 'failed'):
+            return status
+        time.sleep(0.01)
+    raise TimeoutError(f'job {job_id} still running')
+
+
+def bench_size(webserver, n, repeats, seeds):
+    '''Seconds of every stage for a run of n samples'''
+    from exports import write_export
+    from sensor_data import load_sensor_columns
+
+    data = synthetic_ndjson(n)
+    with open('run.json', 'wb') as file:
+        file.write(data)
+    timings = {'read_json_to_list': best_of(repeats, lambda: webserver.read_json_to_list('run.json')),
+               'parse': best_of(repeats, lambda: load_sensor_columns('run.json'))}
+
+    columns, _ = load_sensor_columns('run.json')
+    for _ in range(repeats):
+        report = {}
+        results = webserver.process_readings(columns, report=report)
+        for step in report['stages']:
+            timings[step['stage']] = min(timings.get(step['stage'], float('inf')), step['seconds'])
+
+    renderer = webserver.get_plot_renderer()
+    timings['plot'] = best_of(repeats, lambda: renderer.render(results, 'plot.png'))
+    for export_format in ('csv', 'npy', 'xlsx'):
+        if export_format == 'xlsx' and n > XLSX_MAX_SAMPLES:
+            continue
+        timings[f'export_{export_format}'] = best_of(
+            repeats, lambda: write_export(export_format, results, f'export.{export_format}'))
+
+    # Every repeat needs a run that is not in the result cache yet
+    runs = iter(synthetic_ndjson(n, seed=next(seeds)) for _ in range(repeats))
+
+    def generate_plot():
+        with open('run.json', 'wb') as file:
+            file.write(next(runs))
+        webserver.generate_plot('run.json')
+
+    timings['generate_plot'] = best_of(repeats, generate_plot)
+
+    client = webserver.app.test_client()
+    uploads = iter(synthetic_ndjson(n, seed=next(seeds)) for _ in range(repeats))
+
+    def upload_to_plot():
+        response = client.post('/upload_json?device=bench', data=next(uploads), content_type='application/json')
+        assert response.status_code == 202, response.data
+        status = wait_for_job(client, response.headers['X-Job-Id'])
+        assert status['state'] == 'done', status
+        plot = client.get(f"/runs/{response.headers['X-Run-Id']}/plot.png")
+        assert plot.status_code == 200
+        plot.get_data()
+
+    timings['upload_to_plot'] = best_of(repeats, upload_to_plot)
+    return timings
+
+
+def machine():
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+            'processor': platform.processor() or platform.machine(), 'cpus': os.cpu_count()}
+
+
+def compare(results, baseline, threshold):
+    '''Prints every stage against the baseline. Returns the list of regressions'''
+    if baseline['machine'] != results['machine']:
+        print('warning: the baseline was measured on another machine or environment')
+    regressions = []
+    print(f"{'samples':>10} {'stage':>18} {'baseline':>10} {'now':>10} {'ratio':>7}")
+    for size, timings in results['sizes'].items():
+        for stage, seconds in timings.items():
+            reference = baseline['sizes'].get(size, {}).get(stage)
+            if reference is None:
+                print(f"{size:>10} {stage:>18} {'-':>10} {seconds:>9.4f}s")
+                continue
+            ratio = seconds / reference if reference > 0 else float('inf')
+            limit = STAGE_THRESHOLDS.get(stage, threshold)
+            regressed = ratio > 1 + limit and seconds - reference > MIN_REGRESSION_SECONDS
+            if regressed:
+                regressions.append((size, stage, reference, seconds))
+            print(f"{size:>10} {stage:>18} {reference:>9.4f}s {seconds:>9.4f}s {ratio:>6.2f}x"
+                  f"{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--min-exp', type=int, default=3)
+    parser.add_argument('--max-exp', type=int, default=6)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--output', default=RESULTS_FILE)
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='fraction a stage may be slower than the baseline')
+    parser.add_argument('--save-baseline', action='store_true')
+    args = parser.parse_args()
+    output = os.path.abspath(args.output)
+    baseline_file = os.path.abspath(args.baseline)
+
+    results = {'machine': machine(), 'repeats': args.repeats, 'sizes': {}}
+    seeds = iter(range(1, 10 ** 6))
+    with tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as folder:
+        os.chdir(folder)
+        import webserver
+        for exponent in range(args.min_exp, args.max_exp + 1):
+            n = 10 ** exponent
+            started = time.perf_counter()
+            results['sizes'][str(n)] = bench_size(webserver, n, args.repeats, seeds)
+            print(f"{n:>10} samples done in {time.perf_counter() - started:.1f} s", file=sys.stderr)
+
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as file:
+        json.dump(results, file, indent=1)
+    if args.save_baseline:
+        with open(baseline_file, 'w') as file:
+            json.dump(results, file, indent=1)
+        print(f'baseline saved to {baseline_file}')
+        return 0
+    if not os.path.exists(baseline_file):
+        print(f'no baseline in {baseline_file}, run with --save-baseline to create it')
+        return 0
+    with open(baseline_file) as file:
+        baseline = json.load(file)
+    regressions = compare(results, baseline, args.threshold)
+    for size, stage, reference, seconds in regressions:
+        print(f'regression: {stage} with {size} samples went from {reference:.4f} s to {seconds:.4f} s')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
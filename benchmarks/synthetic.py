@@ -0,0 +1,58 @@
+'''Generator of synthetic sensor runs that look like received_sensor_readings.json'''
+import json
+
+import numpy as np
+
+
+def synthetic_columns(n_samples, seed=0):
+    '''Returns time, distance_reading and angle_reading arrays for a run of n_samples.
+    Voltages follow a slow sweep plus noise and the time steps are irregular,
+    as they are in the readings captured by the pico'''
+    rng = np.random.default_rng(seed)
+    # Mostly 1-3 ms between samples with occasional flash write gaps of ~40 ms
+    steps = rng.choice([0.001, 0.002, 0.003], size=n_samples)
+    gaps = rng.random(n_samples) < 0.02
+    steps[gaps] = rng.uniform(0.030, 0.048, size=int(gaps.sum()))
+    time = np.round(np.cumsum(steps), 9)
+
+    phase = np.linspace(0, np.pi, n_samples)
+    distance = 1.8 - 1.2 * np.sin(phase) + rng.normal(0, 0.02, n_samples)
+    angle = 2.54 - 2.0 * phase / np.pi + rng.normal(0, 0.005, n_samples)
+    return {
+        'time': time,
+        'distance_reading': np.round(np.clip(distance, 0.05, 5.0), 6),
+        'angle_reading': np.round(np.clip(angle, 0.0, 3.3), 6),
+    }
+
+
+def synthetic_ndjson(n_samples, seed=0):
+    '''Returns the bytes of an NDJSON run with the same keys written by main.read_sensor'''
+    columns = synthetic_columns(n_samples, seed)
+    lines = [
+        json.dumps({'distance_reading': d, 'time': t, 'angle_reading': a})
+        for d, t, a in zip(columns['distance_reading'].tolist(), columns['time'].tolist(),
+                           columns['angle_reading'].tolist())
+    ]
+    return ('\n'.join(lines) + '\n').encode()
+
+
+def write_synthetic_ndjson(filename, n_samples, seed=0):
+    '''Writes a synthetic NDJSON run to filename and returns its size in bytes'''
+    data = synthetic_ndjson(n_samples, seed)
+    with open(filename, 'wb') as file:
+        file.write(data)
+    return len(data)
+
+
+def synthetic_binary(n_samples, seed=0, tick_us=10):
+    '''Returns the same run as synthetic_ndjson in the binary format sent by the pico'''
+    from sensor_data import encode_binary_header, MAX_TICK_DELTA
+
+    columns = synthetic_columns(n_samples, seed)
+    records = np.zeros(n_samples, dtype=[('tick_delta', '<u2'), ('distance_reading', '<u2'), ('angle_reading', '<u2')])
+    ticks = np.round(columns['time'] * 1e6 / tick_us).astype(np.int64)
+    records['tick_delta'] = np.minimum(np.diff(ticks, prepend=0), MAX_TICK_DELTA)
+    records['distance_reading'] = np.round(columns['distance_reading'] / 5 * 65535)
+    records['angle_reading'] = np.round(columns['angle_reading'] / 3.3 * 65535)
+    header = encode_binary_header(['distance_reading', 'angle_reading'], [5 / 65535, 3.3 / 65535], tick_us)
+    return header + records.tobytes()
@@ -0,0 +1,66 @@
+'''Reduction of long series to about one point per pixel before they are drawn.
+
+lttb_indices keeps the visual shape of a curve (Largest Triangle Three Buckets,
+Steinarsson 2013). minmax_indices keeps the minimum and maximum of every bucket,
+which is cheaper and never hides a peak'''
+import numpy as np
+
+
+def _bucket_edges(n, n_buckets, first=0):
+    '''Start index of each of n_buckets buckets spread over [first, n), plus n at the end'''
+    return np.linspace(first, n, n_buckets + 1).astype(np.int64)
+
+
+def lttb_indices(x, y, n_out):
+    '''Returns the indices of the n_out points of (x, y) chosen by LTTB.
+    The first and last points are always kept. Non finite values are never preferred'''
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+
+    # n_out - 2 buckets for the points between the first and the last one
+    edges = _bucket_edges(n - 1, n_out - 2, first=1)
+    counts = np.diff(edges)
+    finite_y = np.where(np.isfinite(y), y, 0.)
+    # Average point of every bucket, and of the last point for the final bucket
+    average_x = np.append(np.add.reduceat(x[:n - 1], edges[:-1]) / counts, x[-1])
+    average_y = np.append(np.add.reduceat(finite_y[:n - 1], edges[:-1]) / counts, finite_y[-1])
+
+    indices = np.empty(n_out, dtype=np.int64)
+    indices[0] = 0
+    indices[-1] = n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        # Area of the triangle formed by the previous selected point, each candidate
+        # of this bucket and the average of the next bucket
+        area = np.abs((x[a] - average_x[i + 1]) * (finite_y[start:end] - finite_y[a])
+                      - (x[a] - x[start:end]) * (average_y[i + 1] - finite_y[a]))
+        area[~np.isfinite(y[start:end])] = -1.
+        a = start + int(np.argmax(area))
+        indices[i + 1] = a
+    return indices
+
+
+def minmax_indices(y, n_buckets):
+    '''Returns the sorted indices of the minimum and maximum of each of n_buckets
+    equal buckets of y, plus the first and last points'''
+    n = len(y)
+    if 2 * n_buckets >= n:
+        return np.arange(n)
+    y = np.asarray(y, dtype=np.float64)
+    # Equal size buckets as a 2-D view, the few points left over form one more bucket
+    size = n // n_buckets
+    body = y[:size * n_buckets].reshape(n_buckets, size)
+    finite = np.isfinite(body)
+    offsets = np.arange(n_buckets) * size
+    lows = offsets + np.argmin(np.where(finite, body, np.inf), axis=1)
+    highs = offsets + np.argmax(np.where(finite, body, -np.inf), axis=1)
+    extremes = [lows, highs, [0, n - 1]]
+    tail = y[size * n_buckets:]
+    if np.isfinite(tail).any():
+        tail = np.where(np.isfinite(tail), tail, np.nan)
+        extremes.append(size * n_buckets + np.array([np.nanargmin(tail), np.nanargmax(tail)]))
+    return np.unique(np.concatenate(extremes))
@@ -0,0 +1,133 @@
+'''Registry of the measuring stations, one Pico W each.
+
+Every pico sends its device id with the start signal polls and with its uploads.
+The start signal, the state of the current capture and the last processed run are
+kept per device, so pressing start for one station never wakes up another one.
+
+The state lives in the SharedState database, so any worker process can set the start
+signal of a pico that long-polls another one. A poll checks the flag with a read,
+which never waits for the writers, every POLL_INTERVAL seconds. A start set in the
+same process wakes the poll right away through the condition variable of the device.
+A condition only exists while a poll of this process waits on it, so the registry
+lock is taken when a poll starts and ends. Devices without a run are forgotten by
+the database once there are too many or they were not seen for long (see
+shared_state), any id polled once does not stay forever'''
+import contextlib
+import re
+import threading
+import time
+
+# Device of the picos whose firmware does not send an id
+DEFAULT_DEVICE = 'pico'
+# Device ids are used in URLs and file names
+DEVICE_ID_PATTERN = re.compile(r'^[A-Za-z0-9_.-]{1,64}$')
+# Seconds between two checks of the shared start flag during a long poll
+POLL_INTERVAL = 0.25
+
+# States of a device, in the order they happen during a measurement
+IDLE = 'idle'              # polling, no start requested
+REQUESTED = 'requested'    # start pressed, waiting for the pico to poll
+CAPTURING = 'capturing'    # the pico took the start signal and is measuring
+PROCESSING = 'processing'  # upload received, job queued or running
+DONE = 'done'              # last run processed
+FAILED = 'failed'          # processing of the last run failed
+
+
+def valid_device_id(device_id):
+    return bool(device_id) and DEVICE_ID_PATTERN.match(device_id) is not None
+
+
+class DeviceRegistry:
+    '''Devices by id, created the first time they are mentioned'''
+
+    def __init__(self, state, listener=None, poll_interval=POLL_INTERVAL):
+        # state is the SharedState database. listener is called with the state of a
+        # device every time it changes
+        self.state = state
+        self.listener = listener
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        # Device id -> [condition, polls waiting on it]
+        self._conditions = {}
+
+    @contextlib.contextmanager
+    def _condition(self, device_id):
+        '''Condition of a device, shared by the polls of this process that wait on it
+        and forgotten when the last one ends'''
+        with self._lock:
+            entry = self._conditions.setdefault(device_id, [threading.Condition(), 0])
+            entry[1] += 1
+        try:
+            yield entry[0]
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._conditions[device_id]
+
+    def get(self, device_id):
+        '''State of the device with that id, creating it if needed'''
+        return self.state.device(device_id)
+
+    def find(self, device_id):
+        '''State of a known device, or None. Unlike get() it never creates one'''
+        return self.state.find_device(device_id)
+
+    def devices(self):
+        '''State of every known device, sorted by id'''
+        return self.state.devices()
+
+    def _update(self, device_id, only_if=None, **fields):
+        '''Changes a device, wakes up its polls in this process and notifies the listener'''
+        if not self.state.update_device(device_id, only_if, **fields):
+            return False
+        entry = self._conditions.get(device_id)
+        if entry is not None:
+            with entry[0]:
+                entry[0].notify_all()
+        if self.listener is not None:
+            self.listener(self.state.device(device_id))
+        return True
+
+    def request_start(self, device_id):
+        '''Sets the start signal of a device and wakes up its long poll'''
+        self._update(device_id, start_signal=1, state=REQUESTED)
+
+    def wait_for_start(self, device_id, timeout=0):
+        '''Poll of a pico: waits up to timeout seconds for its start signal.
+        Returns True, and clears the signal, if it was set'''
+        self.state.update_device(device_id, last_seen=time.time())
+        # A nan timeout would never end
+        deadline = time.monotonic() + (timeout if timeout > 0 else 0)
+        with self._condition(device_id) as condition:
+            while True:
+                # Only one poll takes the signal, even if the pico polled two workers
+                if self.state.start_signal(device_id) and self._update(
+                        device_id, only_if={'start_signal': 1}, start_signal=0, state=CAPTURING):
+                    return True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                with condition:
+                    condition.wait(min(self.poll_interval, remaining))
+
+    def upload_received(self, device_id, run_id):
+        '''The run of a device was stored and is about to be processed'''
+        self._update(device_id, last_seen=time.time(), state=PROCESSING, pending_run_id=run_id)
+
+    def run_processed(self, device_id, run_id, failed=False):
+        '''The job of a run finished. A failed run does not replace the last good one'''
+        if failed:
+            self._update(device_id, state=FAILED, pending_run_id=None)
+        else:
+            self._update(device_id, state=DONE, run_id=run_id, pending_run_id=None)
+
+    def clear(self, device_id):
+        '''Stops showing the last run of a device'''
+        self._update(device_id, state=IDLE, run_id=None)
+
+    def forget_run(self, run_id):
+        '''Removes a deleted run from the devices that show it'''
+        for device in self.devices():
+            if device['run_id'] == run_id:
+                self._update(device['id'], only_if={'run_id': run_id}, run_id=None)
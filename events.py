@@ -0,0 +1,89 @@
+'''Server-Sent Events channel that tells the open dashboards when something changes.
+
+Browsers keep one /events connection open and receive a message when a job changes
+state or a new run is processed, instead of downloading the results every few
+seconds. While nothing happens the connection only carries a short comment every
+HEARTBEAT seconds so proxies do not close it.
+
+With a SharedState the events are written to its database, so a dashboard connected
+to one worker process also receives the events published by the others. Streams
+check the database every POLL_INTERVAL seconds and right away after an event of
+their own process'''
+import json
+import threading
+import time
+from collections import deque
+
+# Seconds between keep-alive comments on an idle connection
+HEARTBEAT = 30
+# Events kept to replay to a browser that reconnects with Last-Event-ID
+HISTORY = 50
+# Seconds between two checks for events of other worker processes
+POLL_INTERVAL = 0.5
+
+
+class EventBroadcaster:
+    '''Keeps the recent events and wakes up every stream when a new one is published'''
+
+    def __init__(self, history=HISTORY, state=None, poll_interval=POLL_INTERVAL):
+        self.state = state
+        self.poll_interval = poll_interval
+        self._condition = threading.Condition()
+        self._events = deque(maxlen=history)
+        self._last_id = 0
+        # Incremented by every publish of this process, wakes up the streams
+        self._generation = 0
+
+    def publish(self, event, data):
+        '''Sends an event with a JSON serializable payload to every connected client'''
+        data = json.dumps(data)
+        if self.state is not None:
+            self.state.add_event(event, data)
+        with self._condition:
+            if self.state is None:
+                self._last_id += 1
+                self._events.append((self._last_id, event, data))
+            self._generation += 1
+            self._condition.notify_all()
+
+    def _current_id(self):
+        if self.state is not None:
+            return self.state.last_event_id()
+        with self._condition:
+            return self._last_id
+
+    def _events_after(self, last_id):
+        if self.state is not None:
+            return self.state.events_after(last_id)
+        with self._condition:
+            return [item for item in self._events if item[0] > last_id]
+
+    def stream(self, last_id=None, heartbeat=HEARTBEAT):
+        '''Generator of the text/event-stream body of one client. Without last_id only
+        the events published after the connection are sent'''
+        current_id = self._current_id()
+        # A client that saw events of a previous server process starts over
+        if last_id is None or last_id > current_id:
+            last_id = current_id
+        yield 'retry: 3000\n\n'
+        idle = 0.
+        while True:
+            with self._condition:
+                generation = self._generation
+            pending = self._events_after(last_id)
+            if pending:
+                idle = 0.
+                for event_id, event, data in pending:
+                    last_id = event_id
+                    yield f'id: {event_id}\nevent: {event}\ndata: {data}\n\n'
+                continue
+            if idle >= heartbeat:
+                idle = 0.
+                yield ': keep-alive\n\n'
+            timeout = heartbeat - idle
+            if self.state is not None:
+                timeout = min(timeout, self.poll_interval)
+            started = time.monotonic()
+            with self._condition:
+                self._condition.wait_for(lambda: self._generation != generation, timeout=timeout)
+            idle += time.monotonic() - started
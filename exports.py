@@ -0,0 +1,164 @@
+'''Downloadable exports of a processed run.
+
+Exports are no longer written after every upload. They are produced the first time
+somebody downloads them and then kept with the run in the result cache. CSV, NPY and
+NPZ are produced as generators of byte chunks, so a download can start before the
+whole file exists and memory stays bounded for long runs. XLSX is written with the
+write-only (streaming) mode of openpyxl and Parquet with pyarrow, when installed'''
+import importlib.util
+import io
+import zipfile
+
+import numpy as np
+
+# (series, column header) of every export, the headers of the old sensor_data.xlsx
+COLUMNS = (
+    ('t', 'Time (s)'),
+    ('r', 'r (Distance)'),
+    ('r_dot', 'r_dot (Velocity)'),
+    ('r_ddot', 'r_ddot (Acceleration)'),
+    ('theta', 'theta (Angle)'),
+    ('theta_dot', 'theta_dot (Angular Velocity)'),
+    ('theta_ddot', 'theta_ddot (Angular Acceleration)'),
+)
+MIMETYPES = {
+    'csv': 'text/csv',
+    'npy': 'application/octet-stream',
+    'npz': 'application/zip',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'parquet': 'application/vnd.apache.parquet',
+}
+# Formats produced chunk by chunk by export_chunks
+STREAMED_FORMATS = ('csv', 'npy', 'npz')
+# Rows converted at a time by the streamed formats
+CHUNK_ROWS = 16384
+
+
+def available_formats():
+    '''Export formats that can be produced with the installed libraries'''
+    formats = [name for name in MIMETYPES if name != 'parquet']
+    if importlib.util.find_spec('pyarrow') is not None:
+        formats.append('parquet')
+    return formats
+
+
+def _row_slices(n_rows, chunk_rows):
+    for start in range(0, n_rows, chunk_rows):
+        yield slice(start, min(start + chunk_rows, n_rows))
+
+
+def csv_chunks(arrays, chunk_rows=CHUNK_ROWS):
+    '''CSV text with one header line, in chunks of chunk_rows rows'''
+    yield (','.join(header for _, header in COLUMNS) + '\n').encode()
+    columns = [np.asarray(arrays[name], dtype=np.float64) for name, _ in COLUMNS]
+    for rows in _row_slices(len(columns[0]), chunk_rows):
+        text = io.StringIO()
+        np.savetxt(text, np.column_stack([column[rows] for column in columns]), fmt='%.12g', delimiter=',')
+        yield text.getvalue().encode()
+
+
+def _npy_header(dtype, shape):
+    header = io.BytesIO()
+    np.lib.format.write_array_header_1_0(header, {
+        'descr': np.lib.format.dtype_to_descr(dtype),
+        'fortran_order': False,
+        'shape': shape,
+    })
+    return header.getvalue()
+
+
+def npy_chunks(arrays, chunk_rows=CHUNK_ROWS):
+    '''A single .npy file holding a structured array with one field per series,
+    so np.load(...)['theta'] works as with the columns of a table'''
+    dtype = np.dtype([(name, '<f8') for name, _ in COLUMNS])
+    n_rows = len(arrays['t'])
+    yield _npy_header(dtype, (n_rows,))
+    for rows in _row_slices(n_rows, chunk_rows):
+        block = np.empty(rows.stop - rows.start, dtype=dtype)
+        for name, _ in COLUMNS:
+            block[name] = arrays[name][rows]
+        yield block.tobytes()
+
+
+class _ChunkSink:
+    '''Write-only file object that collects what zipfile writes until it is taken'''
+
+    def __init__(self):
+        self._parts = []
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self._parts)
+        self._parts = []
+        return data
+
+
+def npz_chunks(arrays, chunk_rows=CHUNK_ROWS):
+    '''An .npz archive with one array per series, as np.savez would write it.
+    The zip is written to a non seekable sink, so sizes go in data descriptors'''
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED) as archive:
+        for name, _ in COLUMNS:
+            column = np.ascontiguousarray(arrays[name], dtype='<f8')
+            with archive.open(name + '.npy', 'w', force_zip64=column.nbytes > 2 ** 31) as member:
+                member.write(_npy_header(column.dtype, column.shape))
+                for rows in _row_slices(len(column), chunk_rows):
+                    member.write(column[rows].tobytes())
+                    yield sink.take()
+    yield sink.take()
+
+
+def export_chunks(export_format, arrays):
+    '''Generator over the bytes of one of the STREAMED_FORMATS'''
+    if export_format == 'csv':
+        return csv_chunks(arrays)
+    if export_format == 'npy':
+        return npy_chunks(arrays)
+    if export_format == 'npz':
+        return npz_chunks(arrays)
+    raise ValueError(f'{export_format} exports are not streamed')
+
+
+def write_xlsx(arrays, filename, chunk_rows=CHUNK_ROWS):
+    '''Excel workbook written row by row with the write-only mode of openpyxl'''
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('Sheet1')
+    sheet.append([header for _, header in COLUMNS])
+    columns = [np.asarray(arrays[name], dtype=np.float64) for name, _ in COLUMNS]
+    for rows in _row_slices(len(columns[0]), chunk_rows):
+        block = np.column_stack([column[rows] for column in columns])
+        # Excel has no NaN or infinity, those cells are left empty as pandas did
+        for row in np.where(np.isfinite(block), block, np.nan).tolist():
+            sheet.append([value if value == value else None for value in row])
+    workbook.save(filename)
+
+
+def write_parquet(arrays, filename):
+    '''Parquet file with one column per series. Needs pyarrow'''
+    import pyarrow
+    import pyarrow.parquet
+
+    table = pyarrow.table({header: np.asarray(arrays[name], dtype=np.float64) for name, header in COLUMNS})
+    pyarrow.parquet.write_table(table, filename)
+
+
+def write_export(export_format, arrays, filename):
+    '''Writes an export of any of the available formats to filename'''
+    if export_format in STREAMED_FORMATS:
+        with open(filename, 'wb') as file:
+            for chunk in export_chunks(export_format, arrays):
+                file.write(chunk)
+    elif export_format == 'xlsx':
+        write_xlsx(arrays, filename)
+    elif export_format == 'parquet':
+        write_parquet(arrays, filename)
+    else:
+        raise ValueError(f'unknown export format {export_format}')
@@ -0,0 +1,133 @@
+'''Background processing of uploaded runs.
+
+Uploads are acknowledged as soon as their bytes are on disk. The processing
+(filtering, export and plotting) is handed to a bounded pool of worker threads
+and can be followed through the job id returned with the upload'''
+import itertools
+import os
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Number of runs processed at the same time
+MAX_WORKERS = 2
+# Jobs waiting or running before new submissions are rejected
+MAX_PENDING = 16
+# Finished jobs remembered for the /jobs/<id> endpoint
+MAX_HISTORY = 200
+
+
+class QueueFull(Exception):
+    '''Raised when MAX_PENDING jobs are already waiting'''
+
+
+class JobQueue:
+    '''Bounded worker pool that keeps the status of its recent jobs'''
+
+    def __init__(self, max_workers=MAX_WORKERS, max_pending=MAX_PENDING, max_history=MAX_HISTORY, listener=None):
+        # listener is called with a copy of the status of a job every time it changes
+        self.listener = listener
+        self.max_pending = max_pending
+        self.max_history = max_history
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict()
+        self._ids = itertools.count(1)
+        self._pending = 0
+        self._running = 0
+        self.latest_id = None
+
+    def submit(self, function, *args, **kwargs):
+        '''Queues function(*args, **kwargs) and returns the id of the new job.
+        The return value of the function is shown in the status of the job, so it
+        has to be JSON serializable'''
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise QueueFull(f'{self._pending} jobs already pending')
+            self._pending += 1
+            # The process id keeps the ids of several worker processes apart
+            job_id = f'{os.getpid()}-{next(self._ids)}'
+            self._jobs[job_id] = {
+                'id': job_id,
+                'state': 'queued',
+                'submitted': time.time(),
+                'started': None,
+                'finished': None,
+                'error': None,
+                'result': None,
+            }
+            self.latest_id = job_id
+            self._forget_old_jobs()
+            status = dict(self._jobs[job_id])
+        try:
+            self._notify(status)
+            self._executor.submit(self._run, job_id, function, args, kwargs)
+        except BaseException:
+            # The job never runs, it does not count as pending
+            with self._lock:
+                self._pending -= 1
+                self._jobs[job_id].update(state='failed', error='not queued')
+            raise
+        return job_id
+
+    def _run(self, job_id, function, args, kwargs):
+        with self._lock:
+            self._running += 1
+        fields = {'state': 'failed', 'error': 'interrupted'}
+        try:
+            self._update(job_id, state='running', started=time.time())
+            try:
+                result = function(*args, **kwargs)
+            except Exception as error:
+                traceback.print_exc()
+                fields = {'state': 'failed', 'error': repr(error)}
+            else:
+                fields = {'state': 'done', 'result': result}
+        finally:
+            # Even if the listener fails, or the queue would look fuller every time
+            with self._lock:
+                self._pending -= 1
+                self._running -= 1
+        self._update(job_id, finished=time.time(), **fields)
+
+    def _update(self, job_id, **fields):
+        with self._lock:
+            self._jobs[job_id].update(fields)
+            status = dict(self._jobs[job_id])
+        self._notify(status)
+
+    def _notify(self, status):
+        if self.listener is None:
+            return
+        try:
+            self.listener(status)
+        except Exception:
+            # A listener that fails (e.g. the shared database is locked) must not
+            # stop the job or leave it counted as pending
+            traceback.print_exc()
+
+    def _forget_old_jobs(self):
+        '''Drops the oldest finished jobs beyond max_history. Called with the lock held'''
+        for old_id in list(self._jobs):
+            if len(self._jobs) <= self.max_history:
+                break
+            if self._jobs[old_id]['state'] in ('done', 'failed'):
+                del self._jobs[old_id]
+
+    def status(self, job_id):
+        '''Returns a copy of the status of a job, or None if it is unknown'''
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def pending(self):
+        '''Number of jobs queued or running'''
+        with self._lock:
+            return self._pending
+
+    def running(self):
+        '''Number of jobs being run by a worker thread'''
+        with self._lock:
+            return self._running
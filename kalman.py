@@ -0,0 +1,189 @@
+'''Batched Kalman filter and RTS smoother for the sensor channels.
+
+The model is the one generate_plot used with filterpy: a constant velocity state
+[position, velocity] that advances one sample per step and observes the position.
+The covariances and gains of that model do not depend on the measurements, so they
+are computed once and shared by every channel. After a short transient the gain
+settles and the rest of the run is a linear recursive filter, which is evaluated
+with scipy.signal.lfilter instead of a Python loop. SciPy is imported on the first
+filter so that importing this module stays cheap'''
+import numpy as np
+
+# Model used since the first version of the web server (see generate_plot)
+KALMAN_F = np.array([[1., 1.], [0., 1.]])  # matriz de transición
+KALMAN_H = np.array([[1., 0.]])  # matriz de observación
+KALMAN_R = 5.  # incertidumbre de la medición
+KALMAN_Q = np.eye(2)  # ruido del proceso
+KALMAN_P0 = 1000.  # incertidumbre inicial
+
+# Relative change of the gain below which it is considered to be in steady state
+GAIN_TOLERANCE = 1e-14
+
+# Largest condition number accepted when diagonalizing a recursion matrix.
+# Worse conditioned recursions are evaluated with the plain loop instead
+MAX_CONDITION = 1e8
+
+
+def _gain_sequence(n_samples, R, Q, P0, steady):
+    '''Runs the covariance recursion of the filter until the gain stops changing.
+    Returns (gains, covariances, steady_gain, steady_covariance) where gains and
+    covariances hold the time-varying transient (empty when steady is True) and
+    the last two are the values used for every remaining sample'''
+    F, H = KALMAN_F, KALMAN_H
+    I = np.eye(2)
+    P = np.eye(2) * P0
+    gains = []
+    covariances = []
+    previous_K = None
+    for _ in range(n_samples):
+        # Predict and update (Joseph form, the same one filterpy uses)
+        P = F @ P @ F.T + Q
+        S = H @ P @ H.T + R
+        K = P @ H.T / S
+        IKH = I - K @ H
+        P = IKH @ P @ IKH.T + K * R @ K.T
+        if previous_K is not None and np.all(np.abs(K - previous_K) <= GAIN_TOLERANCE * np.abs(K)):
+            break
+        gains.append(K)
+        covariances.append(P)
+        previous_K = K
+    if steady:
+        return [], [], K, P
+    return gains, covariances, K, P
+
+
+def _linear_recursion(M, inputs, initial, reverse=False):
+    '''Evaluates s[k] = M @ s[k-1] + inputs[k] along axis 1 of inputs.
+
+    inputs has shape (n_channels, n_samples, 2) and initial (n_channels, 2) is the
+    state before the first sample. With reverse=True the recursion runs from the
+    last sample to the first. M is diagonalized so that each mode becomes a first
+    order IIR filter evaluated by lfilter for all channels at once'''
+    if reverse:
+        return _linear_recursion(M, inputs[:, ::-1], initial)[:, ::-1]
+
+    eigenvalues, V = np.linalg.eig(M)
+    if np.linalg.cond(V) > MAX_CONDITION:
+        # Defective recursion, fall back to the loop
+        states = np.empty_like(inputs)
+        s = initial
+        for k in range(inputs.shape[1]):
+            s = s @ M.T + inputs[:, k]
+            states[:, k] = s
+        return states
+
+    from scipy.signal import lfilter
+
+    V_inv = np.linalg.inv(V)
+    modes_in = inputs @ V_inv.T
+    modes_initial = initial @ V_inv.T
+    modes = np.empty(modes_in.shape, dtype=np.result_type(modes_in, eigenvalues))
+    for i, eigenvalue in enumerate(eigenvalues):
+        zi = (eigenvalue * modes_initial[:, i])[:, None]
+        modes[:, :, i], _ = lfilter([1.], [1., -eigenvalue], modes_in[:, :, i], axis=1, zi=zi)
+    states = modes @ V.T
+    return np.ascontiguousarray(states.real)
+
+
+def kalman_filter(measurements, smooth=False, steady=False,
+                  R=KALMAN_R, Q=KALMAN_Q, P0=KALMAN_P0, x0=None):
+    '''Filters one or several channels of measurements with independent states.
+
+    measurements is an array of shape (n_samples,) or (n_channels, n_samples).
+    Returns the [position, velocity] estimates with shape (n_samples, 2) or
+    (n_channels, n_samples, 2). With steady=True the steady-state gain is used from
+    the first sample, otherwise the initial transient follows filterpy exactly.
+    With smooth=True an offline RTS smoother pass is applied to the result'''
+    z = np.asarray(measurements, dtype=np.float64)
+    single_channel = z.ndim == 1
+    z = np.atleast_2d(z)
+    n_channels, n_samples = z.shape
+    states = np.empty((n_channels, n_samples, 2))
+    if n_samples == 0:
+        return states[0] if single_channel else states
+    Q = np.asarray(Q, dtype=np.float64)
+    if Q.ndim == 0:
+        Q = np.eye(2) * Q
+    x = np.zeros((n_channels, 2))
+    if x0 is not None:
+        x[:] = np.asarray(x0, dtype=np.float64).reshape(-1, 2)
+
+    F, H = KALMAN_F, KALMAN_H
+    gains, covariances, K, P = _gain_sequence(n_samples, R, Q, P0, steady)
+    n_transient = len(gains)
+
+    # Transient: the gain still changes from one sample to the next
+    for k in range(n_transient):
+        x = x @ F.T
+        x = x + (z[:, k] - x[:, 0])[:, None] * gains[k][:, 0]
+        states[:, k] = x
+    # Steady state: x[k] = (I - K H) F x[k-1] + K z[k]
+    if n_transient < n_samples:
+        A = (np.eye(2) - K @ H) @ F
+        inputs = z[:, n_transient:, None] * K[:, 0]
+        states[:, n_transient:] = _linear_recursion(A, inputs, x)
+
+    if smooth and n_samples > 1:
+        states = _rts_smoother(states, covariances, P, Q)
+    return states[0] if single_channel else states
+
+
+def _rts_smoother(states, covariances, P, Q):
+    '''Rauch-Tung-Striebel pass over filtered states.
+    xs[k] = x[k] + G[k] (xs[k+1] - F x[k]) with G[k] = P[k] F' inv(F P[k] F' + Q)'''
+    F = KALMAN_F
+    n_transient = len(covariances)
+    n_samples = states.shape[1]
+    smoothed = states.copy()
+
+    def smoother_gain(P_k):
+        return P_k @ F.T @ np.linalg.inv(F @ P_k @ F.T + Q)
+
+    # Steady part, from the second to last sample back to the end of the transient
+    start = min(n_transient, n_samples - 1)
+    if start < n_samples - 1:
+        G = smoother_gain(P)
+        inputs = states[:, start:n_samples - 1] @ (np.eye(2) - G @ F).T
+        smoothed[:, start:n_samples - 1] = _linear_recursion(G, inputs, states[:, -1], reverse=True)
+    # Transient part, the gain changes with every sample
+    for k in range(start - 1, -1, -1):
+        G = smoother_gain(covariances[k])
+        smoothed[:, k] = states[:, k] + (smoothed[:, k + 1] - states[:, k] @ F.T) @ G.T
+    return smoothed
+
+
+class KalmanTracker:
+    '''Kalman filter of several channels fed a block of samples at a time, for runs
+    that arrive while they are being captured. The state and the sample count are
+    kept between blocks, so the estimates are the ones kalman_filter returns for
+    the whole run (up to rounding)'''
+
+    def __init__(self, n_channels, R=KALMAN_R, Q=KALMAN_Q, P0=KALMAN_P0, max_transient=100_000):
+        Q = np.asarray(Q, dtype=np.float64)
+        if Q.ndim == 0:
+            Q = np.eye(2) * Q
+        # Same gains as kalman_filter: the transient, then the steady-state gain
+        self.gains, _, self.K, _ = _gain_sequence(max_transient, R, Q, P0, False)
+        self.A = (np.eye(2) - self.K @ KALMAN_H) @ KALMAN_F
+        self.x = np.zeros((n_channels, 2))
+        self.count = 0
+
+    def update(self, measurements):
+        '''Filters the next block (n_channels, n_samples) of measurements.
+        Returns the [position, velocity] estimates, shape (n_channels, n_samples, 2)'''
+        z = np.atleast_2d(np.asarray(measurements, dtype=np.float64))
+        n_samples = z.shape[1]
+        states = np.empty((z.shape[0], n_samples, 2))
+        x = self.x
+        n_transient = min(n_samples, max(0, len(self.gains) - self.count))
+        for k in range(n_transient):
+            x = x @ KALMAN_F.T
+            x = x + (z[:, k] - x[:, 0])[:, None] * self.gains[self.count + k][:, 0]
+            states[:, k] = x
+        if n_transient < n_samples:
+            inputs = z[:, n_transient:, None] * self.K[:, 0]
+            states[:, n_transient:] = _linear_recursion(self.A, inputs, x)
+        if n_samples:
+            self.x = states[:, -1].copy()
+        self.count += n_samples
+        return states
@@ -1,12 +1,15 @@
 '''Main function for the raspberry pi pico that reads and sends data'''
 # Import libraries for wifi connection
-import network, time
+import network, time, io
 
 # This libraries handle connection to the web server
-import urequests, ujson
+import urequests, ujson, ubinascii
+
+# Buffered acquisition loop and binary format of the readings (acquisition.py)
+from acquisition import SampleBuffer, StreamWriter, capture, write_binary_header, BINARY_CONTENT_TYPE
 
 # These libraries handle GPIO functions in general
-from machine import Pin, ADC
+from machine import Pin, ADC, unique_id
 
 
 
@@ -132,9 +135,44 @@ sv03 = ADC(Pin(26)) #GPIO26, physical pin 31
 sharp = ADC(Pin(27)) #GPIO28, physical pin 34
 sv03_vmax = 3.3
 
+# Readings are stored as fixed-width binary records instead of JSON text (about 6
+# bytes per sample instead of 70). The header describes the channels, their scale
+# in volts per ADC count and the time base, the server decodes it in sensor_data.py
+# Set use_binary_format to False to send the old JSON lines
+use_binary_format = True
+BINARY_CHANNELS = ('distance_reading', 'angle_reading')
+BINARY_SCALES = (5 / 65535, sv03_vmax / 65535)  # Volts per ADC count of each channel
+TICK_US = 10  # Time base of the records: one tick is 10 us
+
+readings_filename = 'sensor_readings.bin' if use_binary_format else 'sensor_readings.json'
+
+# RAM buffer for the readings, allocated once so the loop never waits on the flash
+sample_buffer = SampleBuffer()
+
+
 def read_sensor():
+    '''Moves the mechanism and records the sensors until the end angle is reached.
+    Returns the acquisition statistics (samples captured and dropped, rate)'''
+    if not use_binary_format:
+        return read_sensor_json()
+    # The binary format has one header per run, so each capture starts a new file
+    with open(readings_filename, 'wb') as file:
+        write_binary_header(file, BINARY_CHANNELS, BINARY_SCALES, TICK_US)
+        #Turn the LED On to indicate that the pico is measuring
+        led.on()
+        motor_forward()
+        stats = capture(file, sample_buffer, sharp.read_u16, sv03.read_u16, end_angle,
+                        time.ticks_us, time.ticks_diff, TICK_US)
+        motor_stop()
+        led.off()
+    print(stats)
+    return stats
+
+
+def read_sensor_json():
+    '''Old acquisition loop that writes one JSON line per reading'''
     start_time = time.ticks_ms() #Time when we start measuring
-    reading_duration = 9000 # Time to read in ms
+    captured = 0
     with open('sensor_readings.json', 'a') as file:
         motor_forward()
         while True:
@@ -153,18 +191,6 @@ def read_sensor():
             sharp_voltage = (sharp_value / 65535) * 5
             if sharp_voltage == 0:
                 continue
-            
-            # Print the voltage
-            #print(sv03_voltage)
-            print(sharp_voltage)
-
-            # Calculate angle and distance values
-            #sv03_angle = ((sv03_voltage/sv03_vmax) * 333.3) #-160 # 160° es el ángulo max
-            #C = 1.19
-            #k = 20.1
-            #sharp_distance = k * (sharp_voltage**(-C))
-            #print(sv03_angle)
-            #print(sharp_distance)
 
             # Create a value pair of reading and timestamp
             reading_data = {
@@ -174,15 +200,16 @@ def read_sensor():
             }
             #Add reading to file line by line
             file.write(ujson.dumps(reading_data) + '\n')
-            
-            #Print the readings (debugging purposes)
-            print("")
+            captured += 1
             
             # Check if the total reading angle is over
             if sv03_value >= end_angle:
                 motor_stop()
                 led.off()
                 break
+    duration = time.ticks_diff(time.ticks_ms(), start_time) / 1000
+    return {'captured': captured, 'dropped': 0, 'flushes': captured,
+            'duration_s': duration, 'rate_hz': captured / duration if duration else 0}
         
 
 def clear_file(filename):
@@ -196,7 +223,7 @@ def send_file_in_chunks(filename, url):
     into a stream of bytes, because the Pi Pico has limited RAM and thus
     cannot open the full readings file in RAM to send it to the server'''
 
-    headers = {'Content-Type': 'application/json'}
+    headers = {'Content-Type': BINARY_CONTENT_TYPE if use_binary_format else 'application/json'}
 
     # Function to generate file data in chunks (to avoid hogging RAM)
     def generate_file_data():
@@ -211,7 +238,7 @@ def send_file_in_chunks(filename, url):
     response = urequests.post(url, data=generate_file_data(), headers=headers)
     # Delete the data from the pico if the server received it succesfully
     if response.text == 'JSON file received successfully':
-        clear_file('sensor_readings.json')
+        clear_file(filename)
         return_to_start()
     print(response.text)
     response.close()
@@ -220,12 +247,87 @@ def send_file_in_chunks(filename, url):
 # Set parameters to send data over the web
 server_ip = 'http://192.168.122.170'
 port = ':5000'
-upload_url = server_ip + port + '/upload_json'
+# Id of this station, sent with every poll and upload so the server keeps the start
+# signal and the runs of each station apart. Set a name here to make it readable
+device_id = 'pico-' + ubinascii.hexlify(unique_id()).decode()
+upload_url = server_ip + port + '/upload_json?device=' + device_id
+
+# The server holds the start signal request for up to this many seconds and
+# answers as soon as the start button is pressed (long polling)
+start_wait = 25
+start_signal_url = server_ip + port + '/check_start_signal?wait=' + str(start_wait) + '&device=' + device_id
+
+# Streaming mode (binary format only): the records are sent in batches of
+# STREAM_BATCH_RECORDS while the mechanism moves and the server processes them as
+# they arrive, so the run is ready when the sweep ends. The sampling stops while a
+# batch is sent (holes shorter than the MAX_GAP of the server are interpolated).
+# If a batch does not get through the capture goes on and the file is uploaded whole
+use_streaming = False
+STREAM_BATCH_RECORDS = 512
+STREAM_TIMEOUT = 2  # seconds a batch can take
+stream_url = server_ip + port + '/streams'
+# Smaller than sample_buffer, so the batches go out often
+stream_buffer = SampleBuffer(STREAM_BATCH_RECORDS) if use_streaming else None
+
+
+def post_stream(url, data, timeout=STREAM_TIMEOUT):
+    '''POST to a stream of the server. Returns the status code and the body'''
+    response = urequests.post(url, data=data, headers={'Content-Type': BINARY_CONTENT_TYPE}, timeout=timeout)
+    result = response.status_code, response.text
+    response.close()
+    return result
+
+
+def stream_run():
+    '''Captures a run while it is sent to the server in batches. Returns False if
+    the server did not open the stream (nothing was captured), True once the run
+    was sent, in batches or with send_file_in_chunks'''
+    header = io.BytesIO()
+    write_binary_header(header, BINARY_CHANNELS, BINARY_SCALES, TICK_US)
+    header = header.getvalue()
+    try:
+        status, stream_id = post_stream(stream_url + '?device=' + device_id, header)
+    except OSError as error:
+        print(error)
+        return False
+    if status != 201:
+        print(stream_id)
+        return False
+    records_url = stream_url + '/' + stream_id + '/records?offset='
+
+    def send(offset, data):
+        status, text = post_stream(records_url + str(offset), data)
+        return status == 200
+
+    # The file keeps the whole run in case the stream breaks
+    with open(readings_filename, 'wb') as file:
+        file.write(header)
+        writer = StreamWriter(file, send)
+        led.on()
+        motor_forward()
+        stats = capture(writer, stream_buffer, sharp.read_u16, sv03.read_u16, end_angle,
+                        time.ticks_us, time.ticks_diff, TICK_US)
+        motor_stop()
+        led.off()
+    print(stats)
+
+    if writer.streaming:
+        try:
+            status, text = post_stream(stream_url + '/' + stream_id + '/end', b'', timeout=30)
+        except OSError as error:
+            print(error)
+            text = None
+        if text == 'JSON file received successfully':
+            clear_file(readings_filename)
+            return_to_start()
+            return True
+    # A batch or the end did not get through, the server gets the whole file
+    send_file_in_chunks(readings_filename, upload_url)
+    return True
 
 
 # Create file for the readings if it doesn't exist
-filename = 'sensor_readings.json'
-with open(filename, 'a') as file:
+with open(readings_filename, 'a') as file:
         pass
 
 
@@ -246,12 +348,21 @@ return_to_start()
 # Check for the START signal from the server. If present, read and send data
 while True:
         '''Main Loop'''
-        # Check for the start signal
-        response = urequests.get(server_ip + port + '/check_start_signal')
+        # Wait for the start signal. The request returns when the button is pressed
+        # or after start_wait seconds, then the next one is sent right away
+        try:
+            response = urequests.get(start_signal_url, timeout=start_wait + 5)
+            start = response.json().get('start')
+            response.close()
+        except OSError as error:
+            # Network error or timeout, wait a bit before trying again
+            print(error)
+            time.sleep(1)
+            continue
         
         # If the server returns the response, we invoke the reading and data send functions
-        if response.json().get('start'):
+        if start:
+            if use_streaming and use_binary_format and stream_run():
+                continue
             read_sensor()
-            send_file_in_chunks('sensor_readings.json', upload_url)
-        
-        time.sleep(1)  # Polling interval (can be adjusted, 1s seems to work well)
\ No newline at end of file
+            send_file_in_chunks(readings_filename, upload_url)
\ No newline at end of file
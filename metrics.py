@@ -0,0 +1,189 @@
+'''Counters and histograms of the server, exposed by /metrics in the Prometheus
+text format.
+
+Recording a value takes no lock: every thread writes to its own shard (a dict of
+lists), and a scrape adds up the shards. A thread registers its shard, under the
+lock, the first time it records something. The shards of the threads that ended
+are folded into one at that moment and at every scrape, so with a thread per
+request the shards stay as many as the live threads even without scrapes. A
+scrape copies each shard while its thread may be writing to it, so the sum and
+count of a histogram can be one observation apart for an instant, never lost.
+
+Values are recorded per request or per job, never per sample. Each worker process
+has its own values, like a Prometheus target per process'''
+import bisect
+import math
+import threading
+
+# Upper bounds of the latency histograms, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30.)
+# Upper bounds of the upload size histogram, in bytes
+SIZE_BUCKETS = tuple(1024 * 4 ** exponent for exponent in range(10))  # 1 KiB .. 256 MiB
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class Registry:
+    '''Metrics of the process and the shards the threads write them to'''
+
+    def __init__(self):
+        self.metrics = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._shards = []  # (thread, shard)
+        self._retired = {}  # shards of ended threads, folded together
+
+    def _shard(self):
+        '''dict of the current thread: (metric, labels) -> list of values'''
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._retire_ended()
+                self._shards.append((threading.current_thread(), shard))
+        return shard
+
+    def _retire_ended(self):
+        '''Folds the shards of the threads that ended into one. Called with the lock held'''
+        alive = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                alive.append((thread, shard))
+            else:
+                self._merge(self._retired, shard)
+        self._shards = alive
+
+    def _merge(self, target, shard):
+        for key, values in list(shard.copy().items()):
+            current = target.get(key)
+            if current is None:
+                target[key] = list(values)
+            else:
+                for index, value in enumerate(values):
+                    current[index] += value
+
+    def collect(self):
+        '''Sum of every shard: (metric, labels) -> list of values'''
+        with self._lock:
+            self._retire_ended()
+            totals = {}
+            self._merge(totals, self._retired)
+            for _, shard in self._shards:
+                self._merge(totals, shard)
+        return totals
+
+    def counter(self, name, help_text, labels=()):
+        return self._register(Counter(self, name, help_text, labels))
+
+    def histogram(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(self, name, help_text, labels, buckets))
+
+    def gauge(self, name, help_text, function, labels=(), kind='gauge'):
+        '''Value read at scrape time: function returns a number, or a dict
+        {label values tuple: number} when it has labels. With kind='counter' it is
+        a total kept elsewhere (e.g. the counters of the result cache). The names of
+        counters end in _total'''
+        return self._register(Gauge(self, name, help_text, labels, function, kind))
+
+    def _register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        '''Text exposition format (version 0.0.4) of every metric'''
+        totals = self.collect()
+        by_metric = {}
+        for (metric, labels), values in totals.items():
+            by_metric.setdefault(metric, []).append((labels, values))
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help_text}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.samples(sorted(by_metric.get(metric, ()), key=lambda item: item[0])))
+        return '\n'.join(lines) + '\n'
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, registry, name, help_text, labels):
+        self.registry = registry
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+
+    def _values(self, labels, size):
+        shard = self.registry._shard()
+        key = (self, labels)
+        values = shard.get(key)
+        if values is None:
+            values = shard[key] = [0] * size
+        return values
+
+
+class Counter(Metric):
+    '''Value that only goes up. Its name ends in _total'''
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        self._values(labels, 1)[0] += amount
+
+    def samples(self, items):
+        return [f'{self.name}{_format_labels(self.labels, labels)} {_format_value(values[0])}'
+                for labels, values in items]
+
+
+class Histogram(Metric):
+    '''Counts of the observations below each bucket bound, plus their sum'''
+    kind = 'histogram'
+
+    def __init__(self, registry, name, help_text, labels, buckets):
+        super().__init__(registry, name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        # Layout: one count per bucket (not cumulative), +Inf, sum
+        values = self._values(labels, len(self.buckets) + 2)
+        values[bisect.bisect_left(self.buckets, value)] += 1
+        values[-1] += value
+
+    def samples(self, items):
+        lines = []
+        for labels, values in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), values[:-1]):
+                cumulative += count
+                extra = (('le', _format_value(bound)),)
+                lines.append(f'{self.name}_bucket{_format_labels(self.labels, labels, extra)} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labels, labels)} {_format_value(values[-1])}')
+            lines.append(f'{self.name}_count{_format_labels(self.labels, labels)} {cumulative}')
+        return lines
+
+
+class Gauge(Metric):
+    '''Current value of something, read when the metrics are scraped'''
+
+    def __init__(self, registry, name, help_text, labels, function, kind):
+        super().__init__(registry, name, help_text, labels)
+        self.function = function
+        self.kind = kind
+
+    def samples(self, items):
+        value = self.function()
+        values = value if isinstance(value, dict) else {(): value}
+        return [f'{self.name}{_format_labels(self.labels, labels)} {_format_value(number)}'
+                for labels, number in sorted(values.items())]
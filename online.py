@@ -0,0 +1,387 @@
+'''Online version of the processing pipeline, for runs that arrive in batches while
+the pico is still capturing them (see streams).
+
+Every batch of readings is interpolated onto the uniform grid, continuing the grid
+of the batches before it, and goes through online versions of the stages. The
+result is the one Pipeline.run gives for the whole run (up to rounding), only
+delayed: a sample comes out once every stage has the samples it needs after it.
+- kalman: recursive update that keeps the state between batches, no delay
+- calibrate, threshold: sample by sample, no delay
+- savgol: sliding window, a sample comes out when the last one of its window
+  arrives, savgol_window // 2 samples later. The first and last samples of a
+  segment are fitted as savgol_filter does (mode='interp')
+- gradient: central differences, one sample of delay for each derivative
+With the default parameters the delay is 25 + 2 samples, 54 ms at 500 Hz.
+
+medfilt, wiener, detrend and spectral need the whole segment. A pipeline with any
+of them is not streamable, its runs are processed once they are complete'''
+import numpy as np
+
+from kalman import KalmanTracker
+from pipeline import STAGES, SERIES_KEYS, get_pipeline, measure, smoothing_window, stage_names
+from resampling import RESAMPLE_RATE, MAX_GAP, MIN_SEGMENT_SAMPLES
+
+# Marks the end of a segment in the pieces returned by OnlineResampler
+SEGMENT_END = None
+
+
+def _join(first, second):
+    '''Concatenates two dicts of arrays with the same keys, either can be None'''
+    if first is None:
+        return second
+    if second is None:
+        return first
+    return {name: np.concatenate([first[name], second[name]]) for name in first}
+
+
+def _length(arrays):
+    return len(next(iter(arrays.values()))) if arrays else 0
+
+
+def _slice(arrays, start, end=None):
+    return {name: values[start:end] for name, values in arrays.items()}
+
+
+class OnlineResampler:
+    '''Uniform grid of a run that grows with every batch of readings. The batches
+    are interpolated with the last reading of the previous one, and the run is
+    split at holes longer than max_gap, as resample_segments does with the whole run'''
+
+    def __init__(self, rate=RESAMPLE_RATE, max_gap=MAX_GAP, min_samples=MIN_SEGMENT_SAMPLES, time_name='time'):
+        self.rate = rate
+        self.max_gap = max_gap
+        self.min_samples = min_samples
+        self.time_name = time_name
+        self.first = None  # time of the first reading of the current segment
+        self.next_index = 0  # grid index of the next point of the segment
+        self.last = None  # last reading, name -> value
+        self.held = None  # grid points of a segment still shorter than min_samples
+
+    def feed(self, columns):
+        '''Interpolates a batch of readings sorted by time. Returns a list of pieces:
+        dicts with the columns of new grid points, or SEGMENT_END'''
+        times = np.asarray(columns[self.time_name], dtype=np.float64)
+        if not len(times):
+            return []
+        values = {name: np.asarray(column, dtype=np.float64) for name, column in columns.items()
+                  if name != self.time_name}
+        pieces = []
+        if self.last is not None and times[0] - self.last[self.time_name] > self.max_gap:
+            pieces.extend(self.finish())
+        bounds = np.concatenate([[0], np.flatnonzero(np.diff(times) > self.max_gap) + 1, [len(times)]])
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            if start:
+                pieces.extend(self.finish())
+            pieces.extend(self._extend(times[start:end], {name: column[start:end] for name, column in values.items()}))
+        return pieces
+
+    def _extend(self, times, values):
+        if self.first is None:
+            self.first = times[0]
+            self.next_index = 0
+        elif self.last is not None:
+            times = np.concatenate([[self.last[self.time_name]], times])
+            values = {name: np.concatenate([[self.last[name]], column]) for name, column in values.items()}
+        self.last = {self.time_name: times[-1], **{name: column[-1] for name, column in values.items()}}
+        # Same grid as resample_segments: first + index / rate, up to the last reading
+        last_index = int(np.floor((times[-1] - self.first) * self.rate + 1e-9))
+        indices = np.arange(self.next_index, last_index + 1)
+        if not len(indices):
+            return []
+        self.next_index = last_index + 1
+        grid = self.first + indices / self.rate
+        piece = {self.time_name: grid}
+        for name, column in values.items():
+            piece[name] = np.interp(grid, times, column)
+        if self.held is not None or self.next_index < self.min_samples:
+            self.held = _join(self.held, piece)
+            if self.next_index < self.min_samples:
+                return []
+            piece, self.held = self.held, None
+        return [piece]
+
+    def finish(self):
+        '''Ends the current segment. Returns [SEGMENT_END] if it had grid points'''
+        complete = self.first is not None and self.next_index >= self.min_samples
+        self.first = None
+        self.last = None
+        self.held = None
+        return [SEGMENT_END] if complete else []
+
+
+class OnlineStage:
+    '''Online version of a stage for one segment. feed gets every array of the new
+    grid points (not only the inputs of the stage) and returns the points that are
+    complete, finish returns the rest at the end of the segment'''
+
+    def __init__(self, stage, parameters, dt):
+        self.stage = stage
+        self.parameters = parameters
+        self.dt = dt
+
+    def feed(self, arrays):
+        raise NotImplementedError
+
+    def finish(self):
+        return None
+
+
+class PointwiseStage(OnlineStage):
+    '''Stages that compute each sample from that sample only (calibrate, threshold)'''
+
+    def feed(self, arrays):
+        return {**arrays, **self.stage.run({name: arrays[name] for name in self.stage.inputs},
+                                           self.parameters, self.dt)}
+
+
+class OnlineKalman(OnlineStage):
+    '''KalmanStage with the filter state kept between batches'''
+
+    def __init__(self, stage, parameters, dt):
+        super().__init__(stage, parameters, dt)
+        self.tracker = KalmanTracker(2, R=parameters['kalman_R'], Q=parameters['kalman_Q'],
+                                     P0=parameters['kalman_P0'])
+
+    def feed(self, arrays):
+        states = self.tracker.update(np.vstack([arrays['distance_reading'], arrays['angle_reading']]))
+        return {**arrays, 'distance_reading': states[0, :, 0], 'angle_reading': states[1, :, 0]}
+
+
+class SlidingWindow(OnlineStage):
+    '''Filter of the sources into the targets where every sample depends on the half
+    samples at each side of it, and the first and last half of a segment on its
+    first and last edge samples. Keeps the samples not returned yet, plus the ones
+    before them the window needs; the other arrays wait with them'''
+    sources = ()
+    targets = ()
+    half = 1
+    edge = 2
+
+    def __init__(self, stage, parameters, dt):
+        super().__init__(stage, parameters, dt)
+        self.buffer = None
+        self.returned = 0  # leading samples of buffer already returned
+        self.started = False
+
+    def middle(self, values):
+        '''Values at the samples half .. len - half - 1'''
+        raise NotImplementedError
+
+    def start(self, values):
+        '''First half values of a segment, from its first edge samples'''
+        raise NotImplementedError
+
+    def end(self, values):
+        '''Last half values of a segment, from its last edge samples'''
+        raise NotImplementedError
+
+    def whole(self, values):
+        '''Values of a segment shorter than edge'''
+        raise NotImplementedError
+
+    def _output(self, start, values):
+        output = _slice(self.buffer, start, start + _length(values))
+        output.update(zip(self.targets, (values[name] for name in self.sources)))
+        return output
+
+    def feed(self, arrays):
+        self.buffer = _join(self.buffer, arrays)
+        n = _length(self.buffer)
+        if not self.started:
+            if n < self.edge:
+                return None
+            self.started = True
+            values = {}
+            for name in self.sources:
+                column = self.buffer[name]
+                values[name] = np.concatenate([self.start(column[:self.edge]), self.middle(column)])
+            output = self._output(0, values)
+        else:
+            values = {name: self.middle(self.buffer[name])[self.returned - self.half:] for name in self.sources}
+            output = self._output(self.returned, values)
+        # Keep the samples not returned and the context the window and the end edge need
+        context = max(self.half, self.edge - self.half)
+        keep = max(0, n - self.half - context)
+        self.buffer = _slice(self.buffer, keep)
+        self.returned = n - self.half - keep
+        return output
+
+    def finish(self):
+        if self.buffer is None:
+            return None
+        if not self.started:
+            output = self._output(0, {name: self.whole(self.buffer[name]) for name in self.sources})
+        else:
+            output = self._output(self.returned, {name: self.end(self.buffer[name][-self.edge:])
+                                                  for name in self.sources})
+        self.buffer = None
+        return output
+
+
+class OnlineSavgol(SlidingWindow):
+    '''SavgolStage as a sliding window of savgol_window samples'''
+    sources = targets = ('r', 'theta')
+
+    def __init__(self, stage, parameters, dt):
+        super().__init__(stage, parameters, dt)
+        from scipy.signal import savgol_coeffs
+        self.window = parameters['savgol_window']
+        self.order = parameters['savgol_order']
+        if self.window > self.order:
+            self.half = self.window // 2
+            self.edge = self.window
+            self.coefficients = savgol_coeffs(self.window, self.order)
+        else:
+            # Never smooths, like SavgolStage with a window that does not fit
+            self.half, self.edge = 0, 1
+
+    def middle(self, values):
+        if not self.half:
+            return values
+        return np.convolve(values, self.coefficients, mode='valid')
+
+    def start(self, values):
+        from scipy.signal import savgol_filter
+        return savgol_filter(values, self.window, self.order)[:self.half] if self.half else values[:0]
+
+    def end(self, values):
+        from scipy.signal import savgol_filter
+        return savgol_filter(values, self.window, self.order)[-self.half:] if self.half else values[:0]
+
+    def whole(self, values):
+        from scipy.signal import savgol_filter
+        window = smoothing_window(self.window, self.order, len(values))
+        return values if window is None else savgol_filter(values, window_length=window, polyorder=self.order)
+
+
+class OnlineDerivative(SlidingWindow):
+    '''np.gradient of the sources: central differences, one-sided at both ends'''
+    half = 1
+    edge = 2
+
+    def __init__(self, stage, parameters, dt, sources, targets):
+        super().__init__(stage, parameters, dt)
+        self.sources = sources
+        self.targets = targets
+
+    def middle(self, values):
+        return (values[2:] - values[:-2]) / (2. * self.dt)
+
+    def start(self, values):
+        return (values[1:2] - values[:1]) / self.dt
+
+    def end(self, values):
+        return (values[-1:] - values[-2:-1]) / self.dt
+
+    def whole(self, values):
+        return np.gradient(values, self.dt) if len(values) > 1 else np.zeros_like(values)
+
+
+class OnlineGradient(OnlineStage):
+    '''GradientStage: the first derivatives, then the derivatives of those'''
+
+    def __init__(self, stage, parameters, dt):
+        super().__init__(stage, parameters, dt)
+        self.first = OnlineDerivative(stage, parameters, dt, ('r', 'theta'), ('r_dot', 'theta_dot'))
+        self.second = OnlineDerivative(stage, parameters, dt, ('r_dot', 'theta_dot'), ('r_ddot', 'theta_ddot'))
+
+    def feed(self, arrays):
+        arrays = self.first.feed(arrays)
+        return self.second.feed(arrays) if arrays is not None else None
+
+    def finish(self):
+        arrays = self.first.finish()
+        fed = self.second.feed(arrays) if arrays is not None else None
+        return _join(fed, self.second.finish())
+
+
+# Online versions of the stages, by name
+ONLINE_STAGES = {'kalman': OnlineKalman, 'calibrate': PointwiseStage, 'threshold': PointwiseStage,
+                 'savgol': OnlineSavgol, 'gradient': OnlineGradient}
+
+
+def streamable(parameters):
+    '''True if every stage of the parameters has an online version'''
+    return all(name in ONLINE_STAGES for name in stage_names(parameters))
+
+
+class OnlinePipeline:
+    '''Processes a run batch by batch with the online stages. results() returns the
+    series of the samples processed so far, finish() the complete run'''
+
+    def __init__(self, parameters):
+        names = stage_names(parameters)
+        missing = [name for name in names if name not in ONLINE_STAGES]
+        if missing:
+            raise ValueError(f'stages {missing} have no online version')
+        # Checks that the stages fit together
+        get_pipeline(parameters)
+        self.names = names
+        self.parameters = parameters
+        self.rate = parameters.get('resample_rate', RESAMPLE_RATE)
+        self.resampler = OnlineResampler(self.rate, parameters.get('max_gap', MAX_GAP))
+        self.chain = None  # online stages of the current segment
+        self.chunks = []
+        self.samples = 0
+        self.segments = 0
+        self.steps = {}
+        self._joined = None
+
+    def _new_chain(self):
+        return [ONLINE_STAGES[name](STAGES[name](), self.parameters, 1. / self.rate) for name in self.names]
+
+    def _run(self, arrays, finishing):
+        '''Passes arrays through the stages of the segment. With finishing the stages
+        are flushed too'''
+        for stage in self.chain:
+            inputs = {name: arrays[name] for name in stage.stage.inputs} if arrays is not None else {}
+            with measure(self.steps, stage.stage.name, inputs) as step:
+                output = stage.feed(arrays) if arrays is not None else None
+                if finishing:
+                    output = _join(output, stage.finish())
+                step['outputs'] = {name: output[name] for name in stage.stage.outputs} if output else {}
+            arrays = output
+        if arrays is not None and _length(arrays):
+            arrays['t'] = arrays['time']
+            self.chunks.append({name: arrays[name] for name in SERIES_KEYS})
+            self.samples += _length(arrays)
+            self._joined = None
+
+    def feed(self, columns):
+        '''Processes a batch of readings (time, distance_reading and angle_reading)'''
+        with measure(self.steps, 'resample', columns) as step:
+            pieces = self.resampler.feed(columns)
+            step['outputs'] = [piece for piece in pieces if piece is not SEGMENT_END]
+        self._process(pieces)
+
+    def _process(self, pieces):
+        for piece in pieces:
+            if piece is SEGMENT_END:
+                self._run(None, True)
+                self.chain = None
+                continue
+            if self.chain is None:
+                self.chain = self._new_chain()
+                self.segments += 1
+            self._run(piece, False)
+
+    def finish(self, report=None):
+        '''Ends the run and returns its series. report, if given, gets the statistics
+        of the stages, as Pipeline.run fills it'''
+        self._process(self.resampler.finish())
+        if report is not None:
+            report['segments'] = self.segments
+            report['parallel'] = False
+            report['online'] = True
+            report.setdefault('stages', []).extend(self.steps.values())
+        return self.results()
+
+    def results(self):
+        '''Series of the samples processed so far'''
+        if self._joined is None:
+            if not self.chunks:
+                self._joined = {name: np.empty(0) for name in SERIES_KEYS}
+            else:
+                self._joined = {name: np.concatenate([chunk[name] for chunk in self.chunks]) for name in SERIES_KEYS}
+                self.chunks = [self._joined]
+        return self._joined
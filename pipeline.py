@@ -0,0 +1,377 @@
+'''Processing pipeline of a run, built from stages.
+
+A stage is one step of the processing (Kalman filter, calibration, smoothing,
+derivatives, ...). It declares the arrays it reads (inputs) and the ones it
+returns (outputs), and its settings come from the processing parameters. The
+list of stages is part of the parameters too, so a run is always processed again
+with the stages it was processed with, and changing them changes the cache key.
+
+The pipeline resamples the readings on a uniform grid (see resampling), runs the
+stages on every segment, in a thread pool for long runs, and joins the segments.
+Every step is measured: wall time and the bytes and samples it read and
+returned. The times of a stage are added over the segments.
+
+SENSOR_PIPELINE=kalman,calibrate,medfilt,savgol,gradient selects the stages.
+
+The peak of the memory allocated by each step is measured with tracemalloc on
+the fraction SENSOR_TRACE_MEMORY of the runs (0 by default, 1 for every run).
+tracemalloc about doubles the time of short runs (long ones spend their time in
+NumPy), and its peak is global to the process: the peaks only mean something
+when the runs are processed one at a time, and the segments of a run in
+parallel (PARALLEL_MIN_SAMPLES) share theirs'''
+import contextlib
+import importlib
+import os
+import random
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from kalman import kalman_filter
+from resampling import resample_segments, RESAMPLE_RATE, MAX_GAP
+from spectral import spectral_derivatives
+
+# Columns of a resampled segment, before the first stage
+READING_COLUMNS = ('time', 'distance_reading', 'angle_reading')
+# Arrays every pipeline has to produce, 't' is the grid of the segments
+SERIES_KEYS = ('t', 'r', 'r_dot', 'r_ddot', 'theta', 'theta_dot', 'theta_ddot')
+
+# Runs with at least this many samples process their segments in parallel
+PARALLEL_MIN_SAMPLES = 200_000
+# Threads of the segment pool, created with the first long run
+SEGMENT_WORKERS = 4
+segment_pool = None
+
+
+class Stage:
+    '''One step of the pipeline. Subclasses set name, inputs and outputs and
+    implement run, which gets the input arrays, the processing parameters and the
+    sample spacing of the segment and returns a dict with the outputs. requires
+    lists the modules run imports, loaded before the memory is traced'''
+    name = None
+    inputs = ()
+    outputs = ()
+    requires = ()
+
+    def run(self, arrays, parameters, dt):
+        raise NotImplementedError
+
+
+class KalmanStage(Stage):
+    '''Kalman filter with independent states for the Sharp and CJMCU channels'''
+    name = 'kalman'
+    inputs = ('distance_reading', 'angle_reading')
+    outputs = ('distance_reading', 'angle_reading')
+    requires = ('scipy.signal',)
+
+    def run(self, arrays, parameters, dt):
+        # Aplicar el filtro de Kalman: cada canal tiene su propio estado y se filtran juntos
+        estados = kalman_filter(np.vstack([arrays['distance_reading'], arrays['angle_reading']]),
+                                R=parameters['kalman_R'], Q=parameters['kalman_Q'], P0=parameters['kalman_P0'])
+        return {'distance_reading': estados[0, :, 0], 'angle_reading': estados[1, :, 0]}
+
+
+class CalibrationStage(Stage):
+    '''Voltages to distance (Sharp sensor) and angle (CJMCU potentiometer)'''
+    name = 'calibrate'
+    inputs = ('distance_reading', 'angle_reading')
+    outputs = ('r', 'theta')
+
+    def run(self, arrays, parameters, dt):
+        theta = arrays['angle_reading'] / parameters['angle_voltage_scale'] * parameters['angle_range']
+        r = np.power(arrays['distance_reading'], parameters['distance_exponent']) * parameters['distance_k']
+        return {'r': r, 'theta': theta}
+
+
+class SeriesStage(Stage):
+    '''Stage that applies the same filter to r and theta'''
+    inputs = ('r', 'theta')
+    outputs = ('r', 'theta')
+
+    def run(self, arrays, parameters, dt):
+        return {name: self.filter(arrays[name], parameters) for name in self.outputs}
+
+    def filter(self, values, parameters):
+        raise NotImplementedError
+
+
+class ThresholdStage(SeriesStage):
+    '''Values between -threshold and threshold become 0'''
+    name = 'threshold'
+
+    def filter(self, values, parameters):
+        threshold = parameters.get('threshold', 0.8)
+        return np.where(np.abs(values) < threshold, 0., values)
+
+
+class MedianStage(SeriesStage):
+    '''Median filter, removes isolated spikes'''
+    name = 'medfilt'
+    requires = ('scipy.signal',)
+
+    def filter(self, values, parameters):
+        from scipy.signal import medfilt
+        kernel = parameters.get('medfilt_kernel', 3)
+        return medfilt(values, kernel) if len(values) >= kernel else values
+
+
+class WienerStage(SeriesStage):
+    '''Wiener filter with a window of wiener_size samples'''
+    name = 'wiener'
+    requires = ('scipy.signal',)
+
+    def filter(self, values, parameters):
+        from scipy.signal import wiener
+        size = parameters.get('wiener_size', 3)
+        if len(values) < size:
+            return values
+        # Flat stretches have no local variance, the filter leaves them as they are
+        with np.errstate(divide='ignore', invalid='ignore'):
+            filtered = wiener(values, size)
+        return np.where(np.isfinite(filtered), filtered, values)
+
+
+class DetrendStage(SeriesStage):
+    '''Removes the least squares line of every segment'''
+    name = 'detrend'
+    requires = ('scipy.signal',)
+
+    def filter(self, values, parameters):
+        from scipy.signal import detrend
+        return detrend(values) if len(values) > 1 else values
+
+
+def smoothing_window(window, polyorder, n_samples):
+    '''Savitzky-Golay window that fits in a segment of n_samples, or None if it is
+    too short to be smoothed'''
+    window = min(window, n_samples if n_samples % 2 else n_samples - 1)
+    return window if window > polyorder else None
+
+
+class SavgolStage(SeriesStage):
+    '''Savitzky-Golay smoothing, the window shrinks to fit short segments'''
+    name = 'savgol'
+    requires = ('scipy.signal',)
+
+    def filter(self, values, parameters):
+        from scipy.signal import savgol_filter
+        window = smoothing_window(parameters['savgol_window'], parameters['savgol_order'], len(values))
+        if window is None:
+            return values
+        return savgol_filter(values, window_length=window, polyorder=parameters['savgol_order'])
+
+
+class GradientStage(Stage):
+    '''Velocity and acceleration with np.gradient (numerical differentiation).
+    The grid is uniform, dt is the spacing of every sample'''
+    name = 'gradient'
+    inputs = ('r', 'theta')
+    outputs = ('r_dot', 'r_ddot', 'theta_dot', 'theta_ddot')
+
+    def run(self, arrays, parameters, dt):
+        # Linear velocity (dr/dt) and acceleration (d²r/dt²)
+        r_dot = np.gradient(arrays['r'], dt)
+        # Angular velocity (dθ/dt) and angular acceleration (d²θ/dt²)
+        theta_dot = np.gradient(arrays['theta'], dt)
+        return {'r_dot': r_dot, 'r_ddot': np.gradient(r_dot, dt),
+                'theta_dot': theta_dot, 'theta_ddot': np.gradient(theta_dot, dt)}
+
+
+class SpectralStage(Stage):
+    '''Smoothed r and theta and both derivatives from one FFT of each (see spectral)'''
+    name = 'spectral'
+    inputs = ('r', 'theta')
+    outputs = ('r', 'theta', 'r_dot', 'r_ddot', 'theta_dot', 'theta_ddot')
+
+    def run(self, arrays, parameters, dt):
+        (r, theta), (r_dot, theta_dot), (r_ddot, theta_ddot) = spectral_derivatives(
+            np.vstack([arrays['r'], arrays['theta']]), dt,
+            cutoff=parameters['spectral_cutoff'], rolloff=parameters['spectral_rolloff'])
+        return {'r': r, 'theta': theta, 'r_dot': r_dot, 'r_ddot': r_ddot,
+                'theta_dot': theta_dot, 'theta_ddot': theta_ddot}
+
+
+# Stages by the name used in the configuration
+STAGES = {stage.name: stage for stage in (KalmanStage, CalibrationStage, ThresholdStage, MedianStage, WienerStage,
+                                          DetrendStage, SavgolStage, GradientStage, SpectralStage)}
+# Default stages of each derivative method
+DEFAULT_STAGES = {
+    'gradient': ('kalman', 'calibrate', 'savgol', 'gradient'),
+    'spectral': ('kalman', 'calibrate', 'spectral'),
+}
+
+
+def stage_names(parameters):
+    '''Stages of the processing parameters. Runs stored before the pipeline only
+    have the derivative method'''
+    if 'stages' in parameters:
+        return tuple(parameters['stages'])
+    return DEFAULT_STAGES[parameters.get('derivative_method', 'gradient')]
+
+
+def _sizes(arrays):
+    '''(bytes, samples) of a dict of arrays, or of a list of them (segments)'''
+    if isinstance(arrays, dict):
+        arrays = [arrays]
+    n_bytes = sum(values.nbytes for part in arrays for values in part.values())
+    samples = sum(max((len(values) for values in part.values()), default=0) for part in arrays)
+    return n_bytes, samples
+
+
+# Fraction of the runs whose stages get their peak memory measured with tracemalloc
+TRACE_MEMORY = float(os.environ.get('SENSOR_TRACE_MEMORY', '0'))
+# tracemalloc is started while at least one pipeline runs
+_tracing_lock = threading.Lock()
+_tracing_runs = 0
+
+
+@contextlib.contextmanager
+def _tracing(enabled=True):
+    global _tracing_runs
+    if not enabled:
+        yield
+        return
+    with _tracing_lock:
+        if _tracing_runs == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _tracing_runs = 1
+        elif _tracing_runs:
+            _tracing_runs += 1
+    try:
+        yield
+    finally:
+        with _tracing_lock:
+            if _tracing_runs:
+                _tracing_runs -= 1
+                if _tracing_runs == 0:
+                    tracemalloc.stop()
+
+
+@contextlib.contextmanager
+def measure(report, name, inputs):
+    '''Times the block and adds its statistics to report[name]. inputs, and the
+    'outputs' the block sets in the yielded dict, are dicts of arrays or lists of them'''
+    step = {'outputs': {}}
+    with _tracing(tracemalloc.is_tracing()):
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            start_memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        started = time.perf_counter()
+        yield step
+        seconds = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1] - start_memory if tracing else None
+    input_bytes, input_samples = _sizes(inputs)
+    output_bytes, output_samples = _sizes(step['outputs'])
+    stats = report.setdefault(name, {'stage': name, 'calls': 0, 'seconds': 0., 'peak_bytes': None,
+                                     'input_bytes': 0, 'output_bytes': 0, 'input_samples': 0, 'output_samples': 0})
+    stats['calls'] += 1
+    stats['seconds'] += seconds
+    if peak is not None:
+        stats['peak_bytes'] = max(stats['peak_bytes'] or 0, peak)
+    stats['input_bytes'] += input_bytes
+    stats['output_bytes'] += output_bytes
+    stats['input_samples'] += input_samples
+    stats['output_samples'] += output_samples
+
+
+def merge_steps(report, steps):
+    '''Adds the statistics measured by measure() in steps to report'''
+    for name, step in steps.items():
+        stats = report.get(name)
+        if stats is None:
+            report[name] = dict(step)
+            continue
+        for key in ('calls', 'seconds', 'input_bytes', 'output_bytes', 'input_samples', 'output_samples'):
+            stats[key] += step[key]
+        if step['peak_bytes'] is not None:
+            stats['peak_bytes'] = max(stats['peak_bytes'] or 0, step['peak_bytes'])
+
+
+def get_segment_pool():
+    '''Returns the threads that process the segments of long runs, creating them the first time'''
+    global segment_pool
+    if segment_pool is None:
+        segment_pool = ThreadPoolExecutor(max_workers=SEGMENT_WORKERS, thread_name_prefix='segment')
+    return segment_pool
+
+
+class Pipeline:
+    '''Stages run in order on every segment of a run'''
+
+    def __init__(self, names):
+        unknown = [name for name in names if name not in STAGES]
+        if unknown:
+            raise ValueError(f'unknown stages {unknown}, available: {sorted(STAGES)}')
+        self.stages = [STAGES[name]() for name in names]
+        # Check the inputs of every stage against the arrays available at that point
+        available = set(READING_COLUMNS)
+        for stage in self.stages:
+            missing = [name for name in stage.inputs if name not in available]
+            if missing:
+                raise ValueError(f'stage {stage.name} needs {missing}, not produced by the stages before it')
+            available.update(stage.outputs)
+        missing = [name for name in SERIES_KEYS[1:] if name not in available]
+        if missing:
+            raise ValueError(f'the stages do not produce {missing}')
+
+    def run(self, columns, parameters, report=None):
+        '''Processes the raw columns of a run. Returns the arrays of SERIES_KEYS and
+        fills report, if given, with the list of stage statistics'''
+        steps = {}
+        # Importing under tracemalloc is very slow, and it is not part of the stage
+        for stage in self.stages:
+            for module in stage.requires:
+                importlib.import_module(module)
+        with _tracing(TRACE_MEMORY > 0 and random.random() < TRACE_MEMORY):
+            rate = parameters.get('resample_rate', RESAMPLE_RATE)
+            with measure(steps, 'resample', columns) as step:
+                segments = resample_segments(columns, rate, parameters.get('max_gap', MAX_GAP))
+                step['outputs'] = segments
+
+            def process(segment):
+                # Statistics of its own, the segments can run in parallel threads
+                segment_steps = {}
+                arrays = dict(segment)
+                for stage in self.stages:
+                    inputs = {name: arrays[name] for name in stage.inputs}
+                    with measure(segment_steps, stage.name, inputs) as step:
+                        step['outputs'] = stage.run(inputs, parameters, 1. / rate)
+                    arrays.update(step['outputs'])
+                arrays['t'] = arrays['time']
+                return {name: arrays[name] for name in SERIES_KEYS}, segment_steps
+
+            parallel = len(segments) > 1 and len(columns['time']) >= PARALLEL_MIN_SAMPLES
+            processed = list(get_segment_pool().map(process, segments)) if parallel else [process(s) for s in segments]
+            results = []
+            for result, segment_steps in processed:
+                results.append(result)
+                merge_steps(steps, segment_steps)
+            if not results:
+                results = [{name: np.empty(0) for name in SERIES_KEYS}]
+            with measure(steps, 'join', results) as step:
+                if len(results) == 1:
+                    step['outputs'] = results[0]
+                else:
+                    step['outputs'] = {name: np.concatenate([result[name] for result in results])
+                                       for name in SERIES_KEYS}
+        if report is not None:
+            report['segments'] = len(segments)
+            report['parallel'] = parallel
+            report.setdefault('stages', []).extend(steps.values())
+        return step['outputs']
+
+
+_pipelines = {}
+
+
+def get_pipeline(parameters):
+    '''Pipeline of the stages of the processing parameters, built once per list of stages'''
+    names = stage_names(parameters)
+    pipeline = _pipelines.get(names)
+    if pipeline is None:
+        pipeline = _pipelines.setdefault(names, Pipeline(names))
+    return pipeline
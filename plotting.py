@@ -0,0 +1,73 @@
+'''Renderer of the 2x3 results figure saved as static/plot.png.
+
+The figure, axes, titles, labels and legends are built once and reused. Each render
+only replaces the data of the six lines, reduced beforehand to the minimum and
+maximum of every horizontal pixel, so the cost no longer grows with the number of
+samples. It uses the object oriented matplotlib API (no pyplot), and the image is
+written to a temporary file and renamed so the server never sends a half written PNG'''
+import os
+import threading
+
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+from decimation import minmax_indices
+
+# (series, title, y label, legend, color) of each subplot, row by row
+PANELS = (
+    ('r', 'Distance vs Time', 'Distance (r)', 'Distance (r)', None),
+    ('r_dot', 'Linear Velocity vs Time', 'Velocity (dr/dt)', 'Linear Velocity (dr/dt)', None),
+    ('r_ddot', 'Linear Acceleration vs Time', 'Acceleration (d²r/dt²)', 'Linear Acceleration (d²r/dt²)', None),
+    ('theta', 'Angle vs Time', 'Angle (θ)', 'Angle (θ)', 'orange'),
+    ('theta_dot', 'Angular Velocity vs Time', 'Velocity (dθ/dt)', 'Angular Velocity (dθ/dt)', 'orange'),
+    ('theta_ddot', 'Angular Acceleration vs Time', 'Acceleration (d²θ/dt²)', 'Angular Acceleration (d²θ/dt²)', 'orange'),
+)
+FIGURE_SIZE = (15, 10)  # inches, as the original plt.subplots figure
+DPI = 100
+
+
+class PlotRenderer:
+    '''Keeps one figure alive and redraws it with new data. Not thread safe,
+    the server only renders while holding its output lock'''
+
+    def __init__(self, figsize=FIGURE_SIZE, dpi=DPI):
+        self.figure = Figure(figsize=figsize, dpi=dpi)
+        self.canvas = FigureCanvasAgg(self.figure)
+        axes = self.figure.subplots(2, 3)
+        self.lines = {}
+        self.axes = {}
+        for ax, (name, title, ylabel, label, color) in zip(axes.flat, PANELS):
+            line, = ax.plot([0., 1.], [0., 1.], color=color, label=label)
+            ax.set_title(title)
+            ax.set_xlabel('Time (s)')
+            ax.set_ylabel(ylabel)
+            ax.legend()
+            self.lines[name] = line
+            self.axes[name] = ax
+        self.figure.tight_layout()
+
+    def pixel_width(self, name):
+        '''Width in pixels of the plotting area of a subplot'''
+        return max(1, int(self.axes[name].get_window_extent().width))
+
+    def update(self, results):
+        '''Replaces the data of every line with the decimated series of results'''
+        t = np.asarray(results['t'], dtype=np.float64)
+        for name, line in self.lines.items():
+            y = np.asarray(results[name], dtype=np.float64)
+            indices = minmax_indices(y, self.pixel_width(name))
+            # Infinite values would break the autoscaling, they are left as gaps
+            y_drawn = np.where(np.isfinite(y[indices]), y[indices], np.nan)
+            line.set_data(t[indices], y_drawn)
+            ax = self.axes[name]
+            ax.relim()
+            ax.autoscale_view()
+
+    def render(self, results, filename):
+        '''Draws results and writes the PNG atomically to filename'''
+        self.update(results)
+        temporary_filename = f'{filename}.{os.getpid()}-{threading.get_ident()}.tmp'
+        with open(temporary_filename, 'wb') as file:
+            self.figure.savefig(file, format='png')
+        os.replace(temporary_filename, filename)
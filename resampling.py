@@ -0,0 +1,59 @@
+'''Resampling of the pico timestamps onto a uniform time grid.
+
+The pico does not sample at a fixed rate: the readings come in bursts about 1 ms
+apart with pauses of tens of milliseconds while it writes to flash, and a run can
+have longer holes when a capture stalls. The Savitzky-Golay filter and the Kalman
+model (one step per sample) assume equally spaced samples, so the readings are
+interpolated onto a grid of a fixed rate before filtering.
+
+Holes longer than max_gap are not bridged: the run is split there into segments,
+each one resampled (and later filtered) on its own. The whole run is interpolated
+with a single np.interp call, a grid point of a segment only falls between two
+samples of that same segment'''
+import numpy as np
+
+# Rate of the uniform grid, in samples per second
+RESAMPLE_RATE = 500.
+# Time steps longer than this (seconds) split the run into separate segments
+MAX_GAP = 0.25
+# Segments with fewer grid points are dropped, a derivative needs at least two
+MIN_SEGMENT_SAMPLES = 2
+
+
+def find_segments(times, max_gap=MAX_GAP):
+    '''(start, end) index ranges of the parts of a sorted time column without steps
+    longer than max_gap, as an array of shape (n_segments, 2)'''
+    if not len(times):
+        return np.empty((0, 2), dtype=np.intp)
+    breaks = np.flatnonzero(np.diff(times) > max_gap) + 1
+    return np.column_stack([np.concatenate([[0], breaks]), np.concatenate([breaks, [len(times)]])])
+
+
+def resample_segments(columns, rate=RESAMPLE_RATE, max_gap=MAX_GAP, time_name='time',
+                      min_samples=MIN_SEGMENT_SAMPLES):
+    '''Interpolates the columns of a run, sorted by time, onto a grid of rate samples
+    per second. Returns a list with one dict of columns per segment, its grid in
+    time_name'''
+    times = np.asarray(columns[time_name], dtype=np.float64)
+    segments = find_segments(times, max_gap)
+    if not len(segments):
+        return []
+    first = times[segments[:, 0]]
+    last = times[segments[:, 1] - 1]
+    # Grid points of every segment, from its first sample up to its last one
+    counts = np.floor((last - first) * rate + 1e-9).astype(np.intp) + 1
+    keep = counts >= min_samples
+    first, counts = first[keep], counts[keep]
+    if not len(counts):
+        return []
+    offsets = np.cumsum(counts) - counts
+    steps = np.arange(counts.sum()) - np.repeat(offsets, counts)
+    grid = np.repeat(first, counts) + steps / rate
+
+    resampled = {time_name: grid}
+    for name, values in columns.items():
+        if name != time_name:
+            resampled[name] = np.interp(grid, times, np.asarray(values, dtype=np.float64))
+    bounds = np.cumsum(counts)[:-1]
+    split = {name: np.split(values, bounds) for name, values in resampled.items()}
+    return [{name: split[name][index] for name in resampled} for index in range(len(counts))]
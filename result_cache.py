@@ -0,0 +1,242 @@
+'''Content-addressed cache of processed runs.
+
+A run is identified by a hash of the raw upload and of the processing parameters,
+so re-uploading the same bytes (the pico retries) or regenerating the plot returns
+the stored arrays and output files without filtering or rendering again. Entries
+live in memory and on disk, both bounded in size with least recently used eviction.
+
+Several worker processes can share the disk level: an entry stored by another
+process is picked up on the first lookup, and one evicted by another process is
+dropped. Each process only counts the entries it has seen, so the disk budget is
+approximate when several of them write to the cache'''
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+CACHE_FOLDER = 'cache'
+MAX_DISK_BYTES = 500 * 1024 * 1024
+MAX_MEMORY_BYTES = 64 * 1024 * 1024
+ARRAYS_FILE = 'arrays.npz'
+# Temporary files older than this (seconds) are leftovers of an interrupted process.
+# Younger ones may belong to another worker process that is still writing them
+LEFTOVER_AGE = 3600
+
+
+def cache_hasher(parameters):
+    '''Returns a hash object seeded with the parameters. Feeding it the raw data of a
+    run, possibly chunk by chunk as it is uploaded, gives the same key as cache_key'''
+    digest = hashlib.sha256()
+    digest.update(json.dumps(parameters, sort_keys=True).encode())
+    digest.update(b'\0')
+    return digest
+
+
+def cache_key(raw_data, parameters):
+    '''Returns the hex digest that identifies a run processed with some parameters'''
+    digest = cache_hasher(parameters)
+    digest.update(raw_data)
+    return digest.hexdigest()
+
+
+def _folder_size(folder):
+    return sum(entry.stat().st_size for entry in os.scandir(folder) if entry.is_file())
+
+
+class ResultCache:
+    '''Two level LRU cache: processed arrays in memory, arrays plus output files on disk'''
+
+    def __init__(self, folder=CACHE_FOLDER, max_disk_bytes=MAX_DISK_BYTES, max_memory_bytes=MAX_MEMORY_BYTES):
+        self.folder = os.path.abspath(folder)
+        self.max_disk_bytes = max_disk_bytes
+        self.max_memory_bytes = max_memory_bytes
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()  # key -> (arrays, size)
+        self._memory_bytes = 0
+        self._disk = OrderedDict()  # key -> size, least recently used first
+        self._disk_bytes = 0
+        self.counters = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0}
+        self._load_index()
+
+    def _load_index(self):
+        '''Rebuilds the disk LRU order from the modification times of the entries'''
+        if not os.path.isdir(self.folder):
+            return
+        entries = []
+        stale = time.time() - LEFTOVER_AGE
+        for entry in os.scandir(self.folder):
+            if not entry.is_dir():
+                continue
+            try:
+                if entry.name.endswith('.tmp') or not os.path.exists(os.path.join(entry.path, ARRAYS_FILE)):
+                    if entry.stat().st_mtime < stale:
+                        # Leftover of an interrupted put()
+                        shutil.rmtree(entry.path, ignore_errors=True)
+                    continue
+                for leftover in os.scandir(entry.path):
+                    if leftover.name.endswith('.tmp') and leftover.stat().st_mtime < stale:
+                        # Export interrupted by a restart
+                        os.remove(leftover.path)
+                entries.append((entry.stat().st_mtime, entry.name, _folder_size(entry.path)))
+            except FileNotFoundError:
+                # Evicted or stored by another worker process meanwhile
+                continue
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_bytes += size
+
+    def _entry_folder(self, key):
+        return os.path.join(self.folder, key)
+
+    def _adopt(self, key):
+        '''Adds to the index an entry stored by another worker process. Returns True if
+        the entry exists on disk. Called with the lock held'''
+        folder = self._entry_folder(key)
+        try:
+            size = _folder_size(folder) if os.path.exists(os.path.join(folder, ARRAYS_FILE)) else None
+        except FileNotFoundError:
+            size = None
+        if size is None:
+            return False
+        self._disk[key] = size
+        self._disk_bytes += size
+        self._evict_disk()
+        return key in self._disk
+
+    def _forget(self, key):
+        '''Drops an entry deleted by another worker process. Called with the lock held'''
+        self._disk_bytes -= self._disk.pop(key, 0)
+        if key in self._memory:
+            self._memory_bytes -= self._memory.pop(key)[1]
+
+    def get(self, key):
+        '''Returns {'arrays': {...}, 'files': {name: path}} for a cached run, or None'''
+        with self._lock:
+            if key not in self._disk and not self._adopt(key):
+                self.counters['misses'] += 1
+                return None
+            folder = self._entry_folder(key)
+            self._disk.move_to_end(key)
+            try:
+                os.utime(folder)
+                files = {name: os.path.join(folder, name) for name in os.listdir(folder)
+                         if name != ARRAYS_FILE and not name.endswith('.tmp')}
+            except FileNotFoundError:
+                # Evicted by another worker process
+                self._forget(key)
+                self.counters['misses'] += 1
+                return None
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.counters['memory_hits'] += 1
+                return {'arrays': self._memory[key][0], 'files': files}
+
+        # Disk hit, load the arrays outside of the lock
+        try:
+            with np.load(os.path.join(folder, ARRAYS_FILE)) as stored:
+                arrays = {name: stored[name] for name in stored.files}
+        except FileNotFoundError:
+            # Evicted by another worker in the meantime
+            with self._lock:
+                self._forget(key)
+                self.counters['misses'] += 1
+            return None
+        with self._lock:
+            self.counters['disk_hits'] += 1
+            self._remember(key, arrays)
+        return {'arrays': arrays, 'files': files}
+
+    def put(self, key, arrays, files):
+        '''Stores the arrays of a run and copies its output files (name -> path) into the cache'''
+        folder = self._entry_folder(key)
+        temporary_folder = f'{folder}.{os.getpid()}-{threading.get_ident()}.tmp'
+        os.makedirs(temporary_folder, exist_ok=True)
+        np.savez(os.path.join(temporary_folder, ARRAYS_FILE), **arrays)
+        for name, path in files.items():
+            shutil.copyfile(path, os.path.join(temporary_folder, name))
+        size = _folder_size(temporary_folder)
+
+        with self._lock:
+            if key in self._disk:
+                # Another worker stored the same run first
+                shutil.rmtree(temporary_folder, ignore_errors=True)
+            else:
+                try:
+                    os.replace(temporary_folder, folder)
+                except OSError:
+                    # Stored first by another worker process, keep its copy
+                    shutil.rmtree(temporary_folder, ignore_errors=True)
+                    self._adopt(key)
+                else:
+                    self._disk[key] = size
+                    self._disk_bytes += size
+                    self._evict_disk()
+            self._remember(key, arrays)
+
+    def temporary_path(self, key, name):
+        '''Path where a file that will be added to a cached run with add_file can be written'''
+        return os.path.join(self._entry_folder(key), f'{name}.{os.getpid()}-{threading.get_ident()}.tmp')
+
+    def add_file(self, key, name, temporary_path):
+        '''Moves a file written at temporary_path into the entry of a cached run.
+        Returns its final path, or None if the run was evicted in the meantime'''
+        path = os.path.join(self._entry_folder(key), name)
+        with self._lock:
+            if key not in self._disk and not self._adopt(key):
+                if os.path.exists(temporary_path):
+                    os.remove(temporary_path)
+                return None
+            size = os.path.getsize(temporary_path)
+            if os.path.exists(path):
+                size -= os.path.getsize(path)
+            try:
+                os.replace(temporary_path, path)
+            except FileNotFoundError:
+                # The entry was evicted by another worker process
+                self._forget(key)
+                if os.path.exists(temporary_path):
+                    os.remove(temporary_path)
+                return None
+            self._disk[key] += size
+            self._disk_bytes += size
+            self._evict_disk()
+            return path if key in self._disk else None
+
+    def _remember(self, key, arrays):
+        '''Keeps the arrays in memory. Called with the lock held'''
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return
+        size = sum(array.nbytes for array in arrays.values())
+        self._memory[key] = (arrays, size)
+        self._memory_bytes += size
+        while self._memory_bytes > self.max_memory_bytes and len(self._memory) > 1:
+            _, (_, old_size) = self._memory.popitem(last=False)
+            self._memory_bytes -= old_size
+
+    def _evict_disk(self):
+        '''Deletes least recently used entries until the disk budget is met. Called with the lock held'''
+        while self._disk_bytes > self.max_disk_bytes and len(self._disk) > 1:
+            old_key, old_size = self._disk.popitem(last=False)
+            self._disk_bytes -= old_size
+            self.counters['evictions'] += 1
+            if old_key in self._memory:
+                self._memory_bytes -= self._memory.pop(old_key)[1]
+            shutil.rmtree(self._entry_folder(old_key), ignore_errors=True)
+
+    def stats(self):
+        '''Hit and miss counters plus the current size of both levels'''
+        with self._lock:
+            stats = dict(self.counters)
+            lookups = stats['memory_hits'] + stats['disk_hits'] + stats['misses']
+            stats['hit_rate'] = (stats['memory_hits'] + stats['disk_hits']) / lookups if lookups else 0.
+            stats['memory_entries'] = len(self._memory)
+            stats['memory_bytes'] = self._memory_bytes
+            stats['disk_entries'] = len(self._disk)
+            stats['disk_bytes'] = self._disk_bytes
+            return stats
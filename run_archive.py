@@ -0,0 +1,206 @@
+'''Compressed, chunked storage of the columns of old runs.
+
+A run that is no longer recent is rewritten from its .npy columns into two files of
+its folder: archive.dat, with the columns cut in chunks of CHUNK_ROWS rows and
+compressed with zlib, and archive.json, the index. For every chunk and column the
+index keeps the byte range and a "zone map", the minimum and maximum value, so a
+time window or a value threshold only decompresses the chunks that can contain
+matching rows.
+
+Each chunk of a column is compressed in the way that gives the fewest bytes:
+- plain: the bytes as they are. Good for the readings, which repeat a few ADC levels
+- shuffle: byte i of every value stored together
+- delta: difference with the previous value (as an unsigned integer of the same
+  size, so it is lossless), then shuffled. Good for the time column'''
+import json
+import os
+import threading
+import zlib
+
+import numpy as np
+
+DATA_FILE = 'archive.dat'
+INDEX_FILE = 'archive.json'
+CHUNK_ROWS = 65536
+COMPRESSION_LEVEL = 6
+
+
+def _shuffle(values):
+    return values.view(np.uint8).reshape(-1, values.dtype.itemsize).T.tobytes()
+
+
+def _unshuffle(data, dtype, n_rows):
+    return np.frombuffer(data, dtype=np.uint8).reshape(dtype.itemsize, n_rows).T.copy().view(dtype).ravel()
+
+
+def _delta(values):
+    integers = values.view(f'u{values.dtype.itemsize}')
+    differences = np.empty_like(integers)
+    differences[:1] = integers[:1]
+    np.subtract(integers[1:], integers[:-1], out=differences[1:])
+    return _shuffle(differences)
+
+
+def _undelta(data, dtype, n_rows):
+    differences = _unshuffle(data, np.dtype(f'u{dtype.itemsize}'), n_rows)
+    return np.cumsum(differences, dtype=differences.dtype).view(dtype)
+
+
+_ENCODERS = {'plain': lambda values: values.tobytes(), 'shuffle': _shuffle, 'delta': _delta}
+
+
+def _encode(values):
+    '''Returns (codec, compressed bytes) of the codec that compresses values the most'''
+    best = None
+    for codec, encoder in _ENCODERS.items():
+        data = zlib.compress(encoder(values), COMPRESSION_LEVEL)
+        if best is None or len(data) < len(best[1]):
+            best = (codec, data)
+    return best
+
+
+def _decode(codec, data, dtype, n_rows):
+    data = zlib.decompress(data)
+    if codec == 'plain':
+        return np.frombuffer(data, dtype=dtype).copy()
+    if codec == 'shuffle':
+        return _unshuffle(data, dtype, n_rows)
+    return _undelta(data, dtype, n_rows)
+
+
+def _zone(values):
+    '''(minimum, maximum) of a chunk ignoring NaN, None when no value is finite'''
+    finite = values[np.isfinite(values)] if values.dtype.kind == 'f' else values
+    if not len(finite):
+        return None, None
+    return float(finite.min()), float(finite.max())
+
+
+def is_archived(folder):
+    return os.path.exists(os.path.join(folder, INDEX_FILE))
+
+
+def write_archive(folder, columns, chunk_rows=CHUNK_ROWS):
+    '''Writes columns (name -> array of equal length) as archive.dat and archive.json
+    in folder. The index is written last, its presence marks a complete archive.
+    Returns the size in bytes of both files'''
+    n_rows = len(next(iter(columns.values()))) if columns else 0
+    index = {'n_rows': n_rows, 'chunk_rows': chunk_rows, 'columns': {}}
+    data_path = os.path.join(folder, DATA_FILE)
+    suffix = f'.{os.getpid()}-{threading.get_ident()}.tmp'
+    offset = 0
+    with open(data_path + suffix, 'wb') as file:
+        for name, values in columns.items():
+            values = np.ascontiguousarray(values)
+            chunks = []
+            for start in range(0, n_rows, chunk_rows):
+                chunk = values[start:start + chunk_rows]
+                codec, data = _encode(chunk)
+                file.write(data)
+                low, high = _zone(chunk)
+                chunks.append([offset, len(data), codec, low, high])
+                offset += len(data)
+            index['columns'][name] = {'dtype': values.dtype.str, 'chunks': chunks}
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(data_path + suffix, data_path)
+
+    index_path = os.path.join(folder, INDEX_FILE)
+    with open(index_path + suffix, 'w') as file:
+        json.dump(index, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(index_path + suffix, index_path)
+    return offset + os.path.getsize(index_path)
+
+
+def filter_rows(columns, time_name, t0=None, t1=None, column=None, low=None, high=None):
+    '''Boolean mask of the rows with t0 <= time <= t1 and low <= column <= high'''
+    times = columns[time_name]
+    keep = np.ones(len(times), dtype=bool)
+    if t0 is not None:
+        keep &= times >= t0
+    if t1 is not None:
+        keep &= times <= t1
+    if column is not None:
+        values = columns[column]
+        if low is not None:
+            keep &= values >= low
+        if high is not None:
+            keep &= values <= high
+    return keep
+
+
+class ColumnArchive:
+    '''Reader of an archive written by write_archive'''
+
+    def __init__(self, folder):
+        with open(os.path.join(folder, INDEX_FILE)) as file:
+            index = json.load(file)
+        self.data_path = os.path.join(folder, DATA_FILE)
+        self.n_rows = index['n_rows']
+        self.chunk_rows = index['chunk_rows']
+        self.columns = index['columns']
+        self.n_chunks = -(-self.n_rows // self.chunk_rows)
+        # Zone maps as arrays, NaN where a chunk has no finite value
+        self.zones = {}
+        for name, column in self.columns.items():
+            zone = np.array([[np.nan if value is None else value for value in chunk[3:5]]
+                             for chunk in column['chunks']], dtype=np.float64).reshape(-1, 2)
+            self.zones[name] = zone
+
+    def chunk_length(self, chunk):
+        return min(self.chunk_rows, self.n_rows - chunk * self.chunk_rows)
+
+    def chunks_in_range(self, name, low=None, high=None):
+        '''Indices of the chunks whose zone map of column name intersects [low, high]'''
+        zone = self.zones[name]
+        keep = np.ones(len(zone), dtype=bool)
+        if low is not None:
+            keep &= zone[:, 1] >= low
+        if high is not None:
+            keep &= zone[:, 0] <= high
+        return np.flatnonzero(keep)
+
+    def read(self, chunks=None, names=None):
+        '''Decompresses the given chunks (all by default) of the given columns'''
+        if chunks is None:
+            chunks = range(self.n_chunks)
+        names = list(self.columns) if names is None else names
+        columns = {}
+        with open(self.data_path, 'rb') as file:
+            for name in names:
+                column = self.columns[name]
+                dtype = np.dtype(column['dtype'])
+                parts = []
+                for chunk in chunks:
+                    offset, length, codec, _, _ = column['chunks'][chunk]
+                    file.seek(offset)
+                    parts.append(_decode(codec, file.read(length), dtype, self.chunk_length(chunk)))
+                columns[name] = np.concatenate(parts) if parts else np.empty(0, dtype=dtype)
+        return columns
+
+    def window(self, time_name, t0=None, t1=None, column=None, low=None, high=None):
+        '''Rows with t0 <= time <= t1 and, if column is given, low <= column <= high.
+        Only the chunks allowed by the zone maps are decompressed.
+        Returns (columns, start, end) with start:end the time slice of the whole run'''
+        chunks = self.chunks_in_range(time_name, t0, t1)
+        if column is not None:
+            chunks = np.intersect1d(chunks, self.chunks_in_range(column, low, high))
+        if not len(chunks):
+            return {name: np.empty(0, dtype=np.dtype(c['dtype'])) for name, c in self.columns.items()}, 0, 0
+        # Contiguous chunks for the time slice, the value filter is applied afterwards
+        first, last = int(chunks[0]), int(chunks[-1])
+        columns = self.read(range(first, last + 1) if column is None else chunks)
+        times = columns[time_name]
+        if column is None:
+            start = int(np.searchsorted(times, t0, side='left')) if t0 is not None else 0
+            end = int(np.searchsorted(times, t1, side='right')) if t1 is not None else len(times)
+            offset = first * self.chunk_rows
+            return {name: values[start:end] for name, values in columns.items()}, offset + start, offset + end
+        keep = filter_rows(columns, time_name, t0, t1, column, low, high)
+        positions = np.concatenate([np.arange(chunk * self.chunk_rows, chunk * self.chunk_rows + self.chunk_length(chunk))
+                                    for chunk in chunks])
+        rows = np.flatnonzero(keep)
+        start, end = (int(positions[rows[0]]), int(positions[rows[-1]]) + 1) if len(rows) else (0, 0)
+        return {name: values[rows] for name, values in columns.items()}, start, end
@@ -0,0 +1,367 @@
+'''Persistent store of every uploaded run.
+
+Each upload becomes an immutable run: its sample columns are saved as one .npy file
+per column in a folder of its own, and its metadata (device, upload time, number of
+samples, duration, processing parameters) goes to a SQLite catalog. Listing runs
+only reads the catalog, the sample files are opened when a run is fetched.
+
+The columns are sorted by time and stored as fixed width arrays, so they are opened
+memory-mapped: a time window is found by binary search on the mapped time column
+and returned as views of the files, without reading the rest of the run. The
+processed series of a run are stored the same way in its processed/ folder. The
+upload itself, as the pico sent it, is kept in the folder as raw.json or raw.bin.
+
+compact() rewrites the runs older than a given age into the compressed, chunked
+format of run_archive (and gzips their raw upload). Archived runs are read through
+the same methods, which then decompress only the chunks they need.
+
+Every file of a run is written under a name of its own and renamed into place, so
+several worker processes can share the store'''
+import contextlib
+import gzip
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+
+import numpy as np
+
+from devices import DEFAULT_DEVICE
+from run_archive import ColumnArchive, filter_rows, is_archived, write_archive
+
+RUNS_FOLDER = 'runs'
+CATALOG_FILE = 'catalog.sqlite'
+# Subfolder of a run with its processed series
+PROCESSED_FOLDER = 'processed'
+# Largest page returned by list_runs
+MAX_PAGE_SIZE = 500
+# Name (without extension) of the raw upload in the folder of a run
+RAW_FILE = 'raw'
+# Statistics of the processing stages of a run (see pipeline)
+REPORT_FILE = 'pipeline.json'
+# Uploads and run folders not in the catalog after this many seconds are leftovers
+# of an interrupted process. Younger ones may be an add() of another worker process
+LEFTOVER_AGE = 3600
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id TEXT PRIMARY KEY,
+    device TEXT NOT NULL,
+    uploaded REAL NOT NULL,
+    n_samples INTEGER NOT NULL,
+    duration REAL NOT NULL,
+    format TEXT,
+    cache_key TEXT,
+    parameters TEXT NOT NULL,
+    archived REAL
+);
+CREATE INDEX IF NOT EXISTS runs_by_upload ON runs (uploaded DESC, id DESC);
+CREATE INDEX IF NOT EXISTS runs_by_device ON runs (device, uploaded DESC, id DESC);
+'''
+_FIELDS = ('id', 'device', 'uploaded', 'n_samples', 'duration', 'format', 'cache_key', 'parameters', 'archived')
+
+
+def sort_by_time(columns, time_name='time'):
+    '''Returns the columns ordered by time. Already sorted columns are returned as they are'''
+    times = columns.get(time_name)
+    if times is None or np.all(times[1:] >= times[:-1]):
+        return columns
+    order = np.argsort(times, kind='stable')
+    return {name: values[order] for name, values in columns.items()}
+
+
+def fsync_directory(path):
+    '''Flushes the entries of a folder to disk, so a file renamed into it survives a
+    power loss. Windows has no way (and no need) to do it'''
+    if os.name == 'nt':
+        return
+    descriptor = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+def _save_columns(folder, columns):
+    '''Writes one .npy file per column and flushes them to disk'''
+    for name, values in columns.items():
+        with open(os.path.join(folder, name + '.npy'), 'wb') as file:
+            np.save(file, np.ascontiguousarray(values))
+            file.flush()
+            os.fsync(file.fileno())
+
+
+def _npy_files(folder):
+    return [entry for entry in os.scandir(folder) if entry.name.endswith('.npy')]
+
+
+def _gzip_file(path):
+    '''Replaces a file by its gzip compressed copy, path + '.gz'. Returns the new size'''
+    temporary_path = f'{path}.gz.{os.getpid()}-{threading.get_ident()}.tmp'
+    with open(path, 'rb') as source, open(temporary_path, 'wb') as file:
+        with gzip.GzipFile(fileobj=file, mode='wb', mtime=0) as compressed:
+            shutil.copyfileobj(source, compressed)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary_path, path + '.gz')
+    os.remove(path)
+    return os.path.getsize(path + '.gz')
+
+
+def _row_to_run(row):
+    run = dict(zip(_FIELDS, row))
+    run['parameters'] = json.loads(run['parameters'])
+    return run
+
+
+class RunStore:
+    '''Folder of run columns plus the SQLite catalog that indexes them'''
+
+    def __init__(self, folder=RUNS_FOLDER):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+        self._catalog = os.path.join(folder, CATALOG_FILE)
+        with self._connect() as connection:
+            # Readers do not block the writer (and the other way around)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.executescript(_SCHEMA)
+            existing = {row[1] for row in connection.execute('PRAGMA table_info(runs)')}
+            if 'archived' not in existing:
+                # Catalog created before the archive tier
+                connection.execute('ALTER TABLE runs ADD COLUMN archived REAL')
+        self._remove_leftovers()
+
+    @contextlib.contextmanager
+    def _connect(self):
+        '''Short lived connection, committed and closed at the end of the block,
+        so any thread can use the store'''
+        connection = sqlite3.connect(self._catalog, timeout=30)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def _remove_leftovers(self):
+        '''Deletes uploads and run folders of an add() interrupted before the catalog was updated'''
+        with self._connect() as connection:
+            known = {row[0] for row in connection.execute('SELECT id FROM runs')}
+        stale = time.time() - LEFTOVER_AGE
+        for entry in os.scandir(self.folder):
+            try:
+                if entry.stat().st_mtime >= stale:
+                    continue
+            except FileNotFoundError:
+                continue
+            if entry.is_dir() and entry.name not in known:
+                shutil.rmtree(entry.path, ignore_errors=True)
+            elif entry.name.startswith('upload-'):
+                os.remove(entry.path)
+
+    def upload_path(self, extension):
+        '''Unique path in the store where an upload can be written before add()'''
+        return os.path.join(self.folder, f'upload-{uuid.uuid4().hex}.{extension}')
+
+    def _run_folder(self, run_id):
+        return os.path.join(self.folder, run_id)
+
+    def add(self, columns, device=DEFAULT_DEVICE, parameters=None, cache_key=None, raw_format=None, raw_path=None):
+        '''Stores the columns of a new run, sorted by time, and returns its metadata.
+        raw_path, a file from upload_path(), is moved into the run as its raw upload'''
+        columns = sort_by_time(columns)
+        uploaded = time.time()
+        run_id = time.strftime('%Y%m%d-%H%M%S', time.localtime(uploaded)) + '-' + uuid.uuid4().hex[:8]
+        temporary_folder = self._run_folder(run_id) + '.tmp'
+        os.makedirs(temporary_folder)
+        try:
+            _save_columns(temporary_folder, columns)
+            if raw_path is not None:
+                os.replace(raw_path, os.path.join(temporary_folder, RAW_FILE + os.path.splitext(raw_path)[1]))
+            os.replace(temporary_folder, self._run_folder(run_id))
+            # The raw upload moved twice, both folders have to reach the disk
+            fsync_directory(self._run_folder(run_id))
+            fsync_directory(self.folder)
+        except BaseException:
+            shutil.rmtree(temporary_folder, ignore_errors=True)
+            raise
+
+        times = columns.get('time', ())
+        run = {
+            'id': run_id,
+            'device': device,
+            'uploaded': uploaded,
+            'n_samples': len(times),
+            'duration': float(times[-1] - times[0]) if len(times) else 0.,
+            'format': raw_format,
+            'cache_key': cache_key,
+            'parameters': json.dumps(parameters or {}, sort_keys=True),
+            'archived': None,
+        }
+        with self._connect() as connection:
+            connection.execute(f'INSERT INTO runs VALUES ({", ".join("?" * len(_FIELDS))})',
+                               [run[field] for field in _FIELDS])
+        run['parameters'] = parameters or {}
+        return run
+
+    def get(self, run_id):
+        '''Metadata of a run, or None if it does not exist'''
+        with self._connect() as connection:
+            row = connection.execute(f'SELECT {", ".join(_FIELDS)} FROM runs WHERE id = ?', (run_id,)).fetchone()
+        return _row_to_run(row) if row else None
+
+    def devices(self):
+        '''Ids of the devices that uploaded at least one run'''
+        with self._connect() as connection:
+            return [row[0] for row in connection.execute('SELECT DISTINCT device FROM runs ORDER BY device')]
+
+    def latest(self, device=None):
+        '''Metadata of the most recent run, of one device if given, or None'''
+        runs, _ = self.list_runs(limit=1, device=device, count=False)
+        return runs[0] if runs else None
+
+    def list_runs(self, limit=50, offset=0, device=None, count=True):
+        '''Page of runs, newest first. Returns (runs, total), total is None when count is False'''
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        where, arguments = ('WHERE device = ?', [device]) if device else ('', [])
+        with self._connect() as connection:
+            rows = connection.execute(
+                f'SELECT {", ".join(_FIELDS)} FROM runs {where} ORDER BY uploaded DESC, id DESC LIMIT ? OFFSET ?',
+                arguments + [limit, max(0, offset)]).fetchall()
+            total = connection.execute(f'SELECT COUNT(*) FROM runs {where}', arguments).fetchone()[0] if count else None
+        return [_row_to_run(row) for row in rows], total
+
+    def _columns_folder(self, run_id, processed):
+        '''Folder with the columns of a run, or None if the run does not exist'''
+        folder = self._run_folder(run_id)
+        if processed:
+            folder = os.path.join(folder, PROCESSED_FOLDER)
+        if not os.path.isdir(folder) or self.get(run_id) is None:
+            return None
+        return folder
+
+    def load_columns(self, run_id, processed=False, mmap=True):
+        '''Sample columns (or processed series) of a run, name -> array, or None if they
+        do not exist. With mmap the arrays are read-only maps of the files, archived
+        runs are decompressed'''
+        folder = self._columns_folder(run_id, processed)
+        if folder is None:
+            return None
+        files = _npy_files(folder)
+        if not files and is_archived(folder):
+            return ColumnArchive(folder).read()
+        return {entry.name[:-4]: np.load(entry.path, mmap_mode='r' if mmap else None) for entry in files}
+
+    def raw_path(self, run_id):
+        '''Path of the raw upload of a run (gzipped once archived), or None'''
+        folder = self._run_folder(run_id)
+        if os.path.isdir(folder):
+            for entry in os.scandir(folder):
+                if entry.name.startswith(RAW_FILE + '.') and not entry.name.endswith('.tmp'):
+                    return entry.path
+        return None
+
+    def has_processed(self, run_id):
+        return os.path.isdir(os.path.join(self._run_folder(run_id), PROCESSED_FOLDER))
+
+    def save_processed(self, run_id, arrays):
+        '''Stores the processed series of a run (name -> array, sorted by 't') once'''
+        folder = os.path.join(self._run_folder(run_id), PROCESSED_FOLDER)
+        if os.path.isdir(folder) or not os.path.isdir(self._run_folder(run_id)):
+            return
+        temporary_folder = f'{folder}.{os.getpid()}-{threading.get_ident()}.tmp'
+        os.makedirs(temporary_folder, exist_ok=True)
+        try:
+            _save_columns(temporary_folder, arrays)
+            os.replace(temporary_folder, folder)
+        except OSError:
+            # Saved by another thread in the meantime, or the run was deleted
+            shutil.rmtree(temporary_folder, ignore_errors=True)
+
+    def save_report(self, run_id, report):
+        '''Stores the statistics of the last processing of a run'''
+        folder = self._run_folder(run_id)
+        if not os.path.isdir(folder):
+            return
+        path = os.path.join(folder, REPORT_FILE)
+        temporary_path = f'{path}.{os.getpid()}-{threading.get_ident()}.tmp'
+        with open(temporary_path, 'w') as file:
+            json.dump(report, file)
+        os.replace(temporary_path, path)
+
+    def report(self, run_id):
+        '''Statistics of the last processing of a run, or None'''
+        try:
+            with open(os.path.join(self._run_folder(run_id), REPORT_FILE)) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+
+    def window(self, run_id, t0=None, t1=None, processed=False, column=None, low=None, high=None):
+        '''Samples of a run with t0 <= time <= t1 and, if column is given, with
+        low <= column <= high. Without column they are views of the memory-mapped
+        columns. Returns (columns, start, end) where start:end is the slice of the
+        whole run that holds them, or None if the run (or its processed series) does
+        not exist'''
+        folder = self._columns_folder(run_id, processed)
+        if folder is None:
+            return None
+        time_name = 't' if processed else 'time'
+        if not _npy_files(folder) and is_archived(folder):
+            return ColumnArchive(folder).window(time_name, t0, t1, column, low, high)
+
+        columns = self.load_columns(run_id, processed)
+        times = columns[time_name]
+        start = int(np.searchsorted(times, t0, side='left')) if t0 is not None else 0
+        end = int(np.searchsorted(times, t1, side='right')) if t1 is not None else len(times)
+        end = max(start, end)
+        columns = {name: values[start:end] for name, values in columns.items()}
+        if column is None:
+            return columns, start, end
+        rows = np.flatnonzero(filter_rows(columns, time_name, column=column, low=low, high=high))
+        if not len(rows):
+            return {name: values[:0] for name, values in columns.items()}, start, start
+        return {name: values[rows] for name, values in columns.items()}, start + int(rows[0]), start + int(rows[-1]) + 1
+
+    def compact(self, max_age, now=None):
+        '''Archives the runs uploaded more than max_age seconds ago. Returns the number
+        of runs archived and their size in bytes before and after'''
+        now = time.time() if now is None else now
+        with self._connect() as connection:
+            run_ids = [row[0] for row in connection.execute(
+                'SELECT id FROM runs WHERE archived IS NULL AND uploaded < ? ORDER BY uploaded', (now - max_age,))]
+        report = {'runs': 0, 'bytes_before': 0, 'bytes_after': 0}
+        for run_id in run_ids:
+            folders = [self._run_folder(run_id), os.path.join(self._run_folder(run_id), PROCESSED_FOLDER)]
+            folders = [folder for folder in folders if os.path.isdir(folder)]
+            if not folders:
+                continue
+            raw_path = self.raw_path(run_id)
+            if raw_path is not None and not raw_path.endswith('.gz'):
+                report['bytes_before'] += os.path.getsize(raw_path)
+                report['bytes_after'] += _gzip_file(raw_path)
+            for folder in folders:
+                files = _npy_files(folder)
+                if not files:
+                    continue
+                report['bytes_before'] += sum(entry.stat().st_size for entry in files)
+                columns = {entry.name[:-4]: np.load(entry.path, mmap_mode='r') for entry in files}
+                report['bytes_after'] += write_archive(folder, columns)
+            with self._connect() as connection:
+                connection.execute('UPDATE runs SET archived = ? WHERE id = ?', (time.time(), run_id))
+            # The readers use the .npy files while they exist, so they go last
+            for folder in folders:
+                for entry in _npy_files(folder):
+                    os.remove(entry.path)
+            report['runs'] += 1
+        return report
+
+    def delete(self, run_id):
+        '''Removes a run from the catalog and deletes its files. Returns False if it did not exist'''
+        with self._connect() as connection:
+            deleted = connection.execute('DELETE FROM runs WHERE id = ?', (run_id,)).rowcount
+        if deleted:
+            shutil.rmtree(self._run_folder(run_id), ignore_errors=True)
+        return bool(deleted)
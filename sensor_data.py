@@ -0,0 +1,350 @@
+'''Bulk loaders that turn the readings sent by the raspberry pi pico into NumPy columns'''
+import json
+import struct
+import warnings
+
+import numpy as np
+
+# orjson parses several times faster than the standard library. It is optional,
+# the loader falls back to json when it is not installed
+try:
+    from orjson import loads as _loads
+except ImportError:
+    _loads = json.loads
+
+# Keys written by the pico for every sample (see read_sensor in main.py)
+SENSOR_KEYS = ('time', 'distance_reading', 'angle_reading')
+
+# Characters that can appear in a plain decimal number. Every other byte is turned
+# into a separator by _NUMBERS_ONLY so that NumPy can read all the values at once
+_NUMBER_CHARS = b'0123456789.+-'
+_NUMBERS_ONLY = bytes(c if c in _NUMBER_CHARS else ord(' ') for c in range(256))
+
+
+# Binary sample format written by the pico (see read_sensor in main.py).
+# Header: magic, version, number of channels, record size in bytes, microseconds
+# per time tick and length of the channel names, followed by the comma separated
+# channel names and one float32 scale (volts per ADC count) per channel.
+# Records: uint16 tick delta since the previous sample, then one raw uint16
+# read_u16() value per channel, all little endian.
+# Version 2 adds skip records: a tick delta of TICK_SKIP carries no sample, only
+# its ticks, so a stall longer than MAX_TICK_DELTA ticks keeps the time of the
+# samples after it. Version 1 runs clipped those stalls and are still read
+BINARY_MAGIC = b'SNSR'
+BINARY_VERSION = 2
+BINARY_VERSIONS = (1, 2)
+TICK_SKIP = 65535
+MAX_TICK_DELTA = 65534
+BINARY_CONTENT_TYPE = 'application/x-sensor-samples'
+_BINARY_HEADER = struct.Struct('<4sBBHIH')
+
+
+def encode_binary_header(channels, scales, tick_us):
+    '''Returns the header of a binary run with the given channel names and scales'''
+    names = ','.join(channels).encode()
+    header = _BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, len(channels), 2 + 2 * len(channels), tick_us, len(names))
+    return header + names + struct.pack(f'<{len(channels)}f', *scales)
+
+
+def binary_record_dtype(channels, record_size):
+    '''Structured dtype of the records: tick_delta plus one uint16 per channel'''
+    fields = [('tick_delta', '<u2')] + [(name, '<u2') for name in channels]
+    return np.dtype({'names': [name for name, _ in fields], 'formats': [kind for _, kind in fields],
+                     'offsets': [2 * i for i in range(len(fields))], 'itemsize': record_size})
+
+
+def decode_binary(buffer):
+    '''Decodes a binary run without copying it.
+    Returns (header, records, skipped) where records is a structured NumPy view of
+    the buffer with a tick_delta field plus one field per channel, and skipped is
+    1 when the buffer ends with an incomplete record'''
+    buffer = memoryview(buffer).cast('B')
+    magic, version, n_channels, record_size, tick_us, names_length = _BINARY_HEADER.unpack_from(buffer)
+    if magic != BINARY_MAGIC:
+        raise ValueError('not a binary sensor run')
+    if version not in BINARY_VERSIONS:
+        raise ValueError(f'unsupported binary sensor run version {version}')
+    offset = _BINARY_HEADER.size
+    channels = bytes(buffer[offset:offset + names_length]).decode().split(',')
+    offset += names_length
+    scales = struct.unpack_from(f'<{n_channels}f', buffer, offset)
+    offset += 4 * n_channels
+    if len(channels) != n_channels or record_size < 2 + 2 * n_channels:
+        raise ValueError('corrupted binary sensor run header')
+
+    n_records, remainder = divmod(len(buffer) - offset, record_size)
+    records = np.frombuffer(buffer, dtype=binary_record_dtype(channels, record_size), count=n_records, offset=offset)
+    header = {'version': version, 'channels': channels, 'scales': scales, 'tick_us': tick_us,
+              'header_size': offset, 'record_size': record_size}
+    return header, records, int(remainder > 0)
+
+
+def binary_to_columns(buffer):
+    '''Converts a binary run into the same float64 columns as load_sensor_columns.
+    Returns (columns, skipped)'''
+    header, records, skipped = decode_binary(buffer)
+    return records_to_binary_columns(header, records), skipped
+
+
+def records_to_binary_columns(header, records, first_tick=0):
+    '''Converts decoded binary records into float64 columns. first_tick is the tick
+    count before the first record, for records that continue an earlier batch'''
+    ticks = np.cumsum(records['tick_delta'], dtype=np.int64) + first_tick
+    if header['version'] >= 2:
+        samples = records['tick_delta'] != TICK_SKIP
+        if not samples.all():
+            # The skip records only add their ticks to the next sample
+            records, ticks = records[samples], ticks[samples]
+    n = len(records)
+    columns = {'time': ticks * (header['tick_us'] * 1e-6)}
+    for name, scale in zip(header['channels'], header['scales']):
+        columns[name] = records[name] * np.float64(scale)
+    for key in SENSOR_KEYS:
+        if key not in columns:
+            columns[key] = np.zeros(n, dtype=np.float64)
+    return columns
+
+
+def _read_bytes(source):
+    '''Returns the raw bytes of a file name or of an already loaded buffer'''
+    if isinstance(source, bytes):
+        return source
+    if isinstance(source, (bytearray, memoryview)):
+        return bytes(source)
+    try:
+        with open(source, 'rb') as file:
+            return file.read()
+    except IOError:
+        print("Error reading the file")
+        return b''
+
+
+def _parse_uniform(data):
+    '''Fast path for files where every line has the same layout, which is what the pico
+    writes. Returns the columns, or None when the file does not qualify and has to
+    go through the JSON parser.
+
+    Removing the digits from every line must leave one identical template, for example
+    {"distance_reading": , "time": , "angle_reading": }. Exponents, nulls, strings,
+    blank lines or a broken line all change that template and make this return None'''
+    templates = data.translate(None, _NUMBER_CHARS).splitlines()
+    if len(set(templates)) != 1:
+        return None
+    n_lines = len(templates)
+    try:
+        first = json.loads(data.split(b'\n', 1)[0])
+    except ValueError:
+        return None
+    if not isinstance(first, dict) or not _is_record(first):
+        return None
+
+    # Read every number of the file in a single C loop. A value that is not a plain
+    # number makes NumPy warn about unmatched data, that is treated as a failure
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', DeprecationWarning)
+        try:
+            values = np.fromstring(data.translate(_NUMBERS_ONLY), dtype=np.float64, sep=' ')
+        except (ValueError, DeprecationWarning):
+            return None
+    keys = list(first)
+    if values.size != n_lines * len(keys):
+        return None
+
+    table = values.reshape(n_lines, len(keys))
+    columns = {}
+    for key in SENSOR_KEYS:
+        if key in first:
+            columns[key] = np.ascontiguousarray(table[:, keys.index(key)])
+        else:
+            columns[key] = np.zeros(n_lines, dtype=np.float64)
+    return columns
+
+
+def _is_record(record):
+    '''A line only counts as a sample if it is a JSON object with numeric (or missing) values'''
+    if not isinstance(record, dict):
+        return False
+    for key in SENSOR_KEYS:
+        value = record.get(key, 0)
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return False
+    return True
+
+
+def _parse_lines(lines):
+    '''Slow path: parse line by line so a malformed line only drops itself'''
+    records = []
+    skipped = 0
+    for line in lines:
+        try:
+            record = _loads(line)
+        except ValueError:
+            skipped += 1
+            continue
+        if _is_record(record):
+            records.append(record)
+        else:
+            skipped += 1
+    return records, skipped
+
+
+def empty_columns():
+    '''Returns the column dictionary of a run without samples'''
+    return {key: np.zeros(0, dtype=np.float64) for key in SENSOR_KEYS}
+
+
+def records_to_columns(records):
+    '''Packs a list of sample dictionaries into contiguous float64 columns.
+    Missing keys default to 0, as read_json_to_list does'''
+    columns = {}
+    for key in SENSOR_KEYS:
+        columns[key] = np.array([record.get(key, 0) for record in records], dtype=np.float64)
+    return columns
+
+
+def parse_ndjson(data):
+    '''Parses NDJSON bytes into float64 columns. Returns (columns, skipped)'''
+    columns = _parse_uniform(data)
+    if columns is not None:
+        return columns, 0
+
+    lines = data.splitlines()
+    # Blank lines are not valid JSON, read_json_to_list also drops them
+    non_blank = [line for line in lines if line.strip()]
+    skipped = len(lines) - len(non_blank)
+
+    # Mixed layouts: the whole file is still parsed in a single call by wrapping the lines in a JSON array
+    try:
+        records = _loads(b'[' + b','.join(non_blank) + b']')
+        if len(records) != len(non_blank) or not all(_is_record(record) for record in records):
+            raise ValueError('line does not hold exactly one sample')
+    except ValueError:
+        # At least one line is malformed, find out which ones and skip them
+        records, bad_lines = _parse_lines(non_blank)
+        skipped += bad_lines
+    return records_to_columns(records), skipped
+
+
+def load_sensor_columns(source):
+    '''Parses a whole NDJSON file (or byte buffer) of readings into float64 columns.
+    Returns (columns, skipped) where columns maps every name in SENSOR_KEYS to a
+    NumPy array and skipped is the number of malformed lines that were ignored.
+    Binary runs are recognised by their magic bytes and decoded instead'''
+    data = _read_bytes(source)
+    if not data:
+        return empty_columns(), 0
+    if data.startswith(BINARY_MAGIC):
+        return binary_to_columns(data)
+
+    columns, skipped = parse_ndjson(data)
+    if skipped:
+        print(f"JSON format error: skipped {skipped} lines")
+    return columns, skipped
+
+
+class _GrowingColumns:
+    '''float64 columns that double their capacity as samples are appended'''
+
+    def __init__(self, capacity=4096):
+        self.size = 0
+        self.arrays = {key: np.empty(capacity, dtype=np.float64) for key in SENSOR_KEYS}
+
+    def extend(self, columns):
+        n = len(columns['time'])
+        end = self.size + n
+        capacity = len(self.arrays['time'])
+        if end > capacity:
+            capacity = max(end, 2 * capacity)
+            for key, array in self.arrays.items():
+                grown = np.empty(capacity, dtype=np.float64)
+                grown[:self.size] = array[:self.size]
+                self.arrays[key] = grown
+        for key in SENSOR_KEYS:
+            self.arrays[key][self.size:end] = columns[key]
+        self.size = end
+
+    def columns(self):
+        '''Returns the filled part of every column, trimmed to its final size'''
+        return {key: array[:self.size].copy() for key, array in self.arrays.items()}
+
+
+class StreamingParser:
+    '''Parses a run while it is still arriving.
+
+    feed() takes the chunks of the upload in order. Complete lines (or records,
+    for binary runs) are parsed in batches of about batch_bytes and appended to
+    growing columns, so only one batch of text is held in memory at a time.
+    finish() parses what is left and returns (columns, skipped) like
+    load_sensor_columns. Binary runs are recognised by their magic bytes, a body
+    shorter than the magic that starts like it is a truncated binary run'''
+
+    def __init__(self, batch_bytes=64 * 1024):
+        self.batch_bytes = batch_bytes
+        self.format = None
+        self.header = None
+        self.skipped = 0
+        self.bytes_received = 0
+        self._pending = bytearray()
+        self._columns = _GrowingColumns()
+        self._last_tick = 0
+
+    def feed(self, chunk):
+        self.bytes_received += len(chunk)
+        self._pending += chunk
+        if self.format is None:
+            if len(self._pending) < len(BINARY_MAGIC) and BINARY_MAGIC.startswith(bytes(self._pending)):
+                return
+            self.format = 'binary' if self._pending.startswith(BINARY_MAGIC) else 'ndjson'
+        if len(self._pending) >= self.batch_bytes:
+            self._parse_pending(final=False)
+
+    def finish(self):
+        if self.format is None and self._pending:
+            # Only NDJSON and binary runs exist, and this is the start of the magic
+            raise ValueError('truncated binary sensor run header')
+        self._parse_pending(final=True)
+        if self.skipped and self.format == 'binary':
+            print("Binary format error: the run ends with an incomplete record")
+        elif self.skipped:
+            print(f"JSON format error: skipped {self.skipped} lines")
+        return self._columns.columns(), self.skipped
+
+    def _parse_pending(self, final):
+        if self.format == 'binary':
+            self._parse_binary(final)
+            return
+        # Only whole lines are parsed, the piece after the last newline waits for the next chunk
+        end = len(self._pending) if final else self._pending.rfind(b'\n') + 1
+        if end <= 0:
+            return
+        batch = bytes(self._pending[:end])
+        del self._pending[:end]
+        if batch.strip():
+            columns, skipped = parse_ndjson(batch)
+            self.skipped += skipped
+            self._columns.extend(columns)
+
+    def _parse_binary(self, final):
+        if self.header is None:
+            try:
+                self.header, records, _ = decode_binary(self._pending)
+            except struct.error:
+                # The header is not complete yet
+                if final:
+                    raise ValueError('truncated binary sensor run header')
+                return
+            self._dtype = records.dtype
+            del records
+            del self._pending[:self.header['header_size']]
+        record_size = self.header['record_size']
+        end = len(self._pending) // record_size * record_size
+        if final and end < len(self._pending):
+            self.skipped += 1
+        if not end:
+            return
+        batch = bytes(self._pending[:end])
+        del self._pending[:end]
+        records = np.frombuffer(batch, dtype=self._dtype)
+        # Ticks continue from the previous batch
+        self._columns.extend(records_to_binary_columns(self.header, records, self._last_tick))
+        self._last_tick += int(records['tick_delta'].sum(dtype=np.int64))
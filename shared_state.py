@@ -0,0 +1,299 @@
+'''Control state shared by the worker processes of the server.
+
+Under a multi-worker WSGI server (gunicorn -w 4 webserver:app) every process has its
+own globals, so a start signal set by one worker, or a job run by another one, would
+not be seen by the rest. The state that has to be shared lives in a small SQLite
+database in WAL mode, which several processes can read and write safely:
+- devices: start signal and capture state of every station. The ones without a
+  run are forgotten beyond MAX_IDLE_DEVICES or after IDLE_DEVICE_AGE
+- jobs: status of the processing jobs, whatever worker runs them
+- events: recent dashboard events, streamed by every worker
+- leases: background tasks that must run in only one worker (compaction)
+- values: single values such as the id of the last processed run
+- deferred_runs: stored runs that found the job queue full, kept until a worker
+  processed them so a restart does not lose them'''
+import contextlib
+import json
+import os
+import sqlite3
+import time
+
+STATE_FILE = 'server_state.sqlite'
+# Events kept for the streams and for the browsers that reconnect
+EVENT_HISTORY = 200
+# Devices without a run kept, any id can poll. The ones changed last are kept
+MAX_IDLE_DEVICES = 1000
+# Seconds after which a device without a run that is not seen is forgotten
+IDLE_DEVICE_AGE = 7 * 24 * 3600
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS devices (
+    id TEXT PRIMARY KEY,
+    start_signal INTEGER NOT NULL DEFAULT 0,
+    state TEXT NOT NULL DEFAULT 'idle',
+    last_seen REAL,
+    pending_run_id TEXT,
+    run_id TEXT,
+    changed REAL
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    pid INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    submitted REAL,
+    started REAL,
+    finished REAL,
+    error TEXT,
+    result TEXT
+);
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    event TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS leases (
+    name TEXT PRIMARY KEY,
+    owner INTEGER NOT NULL,
+    expires REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS state_values (
+    name TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS deferred_runs (
+    run_id TEXT PRIMARY KEY,
+    device TEXT NOT NULL,
+    deferred REAL NOT NULL,
+    pid INTEGER
+);
+'''
+_DEVICE_FIELDS = ('id', 'start_signal', 'state', 'last_seen', 'pending_run_id', 'run_id', 'changed')
+_JOB_FIELDS = ('id', 'pid', 'state', 'submitted', 'started', 'finished', 'error', 'result')
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # Exists but belongs to somebody else, or the platform cannot tell
+        return True
+    return True
+
+
+class SharedState:
+    '''SQLite database with the state shared by the worker processes'''
+
+    def __init__(self, filename=STATE_FILE):
+        self.filename = filename
+        with self._connect() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.executescript(_SCHEMA)
+
+    @contextlib.contextmanager
+    def _connect(self):
+        '''Short lived connection, committed and closed at the end of the block'''
+        connection = sqlite3.connect(self.filename, timeout=30)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    # --- Devices ---
+
+    def device(self, device_id):
+        '''State of a device as a dict, created idle if it is new'''
+        with self._connect() as connection:
+            row = connection.execute(f'SELECT {", ".join(_DEVICE_FIELDS)} FROM devices WHERE id = ?',
+                                     (device_id,)).fetchone()
+            if row is None:
+                self._insert_device(connection, device_id)
+                row = connection.execute(f'SELECT {", ".join(_DEVICE_FIELDS)} FROM devices WHERE id = ?',
+                                         (device_id,)).fetchone()
+        return self._device_dict(row)
+
+    def find_device(self, device_id):
+        '''State of a device as a dict, or None if it is unknown. Only reads'''
+        with self._connect() as connection:
+            row = connection.execute(f'SELECT {", ".join(_DEVICE_FIELDS)} FROM devices WHERE id = ?',
+                                     (device_id,)).fetchone()
+        return self._device_dict(row) if row else None
+
+    @staticmethod
+    def _insert_device(connection, device_id):
+        '''Creates a device if it is new. A new one makes room by forgetting the devices
+        without a run (no run to show, none pending) that are too old or too many'''
+        now = time.time()
+        if not connection.execute('INSERT OR IGNORE INTO devices (id, changed) VALUES (?, ?)',
+                                  (device_id, now)).rowcount:
+            return
+        connection.execute(
+            'DELETE FROM devices WHERE run_id IS NULL AND pending_run_id IS NULL AND id != ? AND (changed < ? OR '
+            'id NOT IN (SELECT id FROM devices WHERE run_id IS NULL AND pending_run_id IS NULL '
+            'ORDER BY changed DESC LIMIT ?))',
+            (device_id, now - IDLE_DEVICE_AGE, MAX_IDLE_DEVICES))
+
+    @staticmethod
+    def _device_dict(row):
+        device = dict(zip(_DEVICE_FIELDS, row))
+        device['start_signal'] = bool(device['start_signal'])
+        return device
+
+    def devices(self):
+        with self._connect() as connection:
+            rows = connection.execute(f'SELECT {", ".join(_DEVICE_FIELDS)} FROM devices ORDER BY id').fetchall()
+        return [self._device_dict(row) for row in rows]
+
+    def start_signal(self, device_id):
+        '''Current start flag of a device. A read, it never waits for the writers'''
+        with self._connect() as connection:
+            row = connection.execute('SELECT start_signal FROM devices WHERE id = ?', (device_id,)).fetchone()
+        return bool(row and row[0])
+
+    def update_device(self, device_id, only_if=None, **fields):
+        '''Sets fields of a device, creating it if needed. With only_if (field -> value)
+        nothing changes unless the device has those values. Returns True if it changed'''
+        fields['changed'] = time.time()
+        names = list(fields)
+        with self._connect() as connection:
+            self._insert_device(connection, device_id)
+            condition, arguments = '', []
+            for name, value in (only_if or {}).items():
+                condition += f' AND {name} IS ?'
+                arguments.append(value)
+            cursor = connection.execute(
+                f'UPDATE devices SET {", ".join(name + " = ?" for name in names)} WHERE id = ?{condition}',
+                [fields[name] for name in names] + [device_id] + arguments)
+            return cursor.rowcount > 0
+
+    # --- Jobs ---
+
+    def save_job(self, status):
+        '''Stores the status of a job of this process (see jobs.JobQueue)'''
+        row = dict(status, pid=os.getpid(), result=json.dumps(status['result']))
+        with self._connect() as connection:
+            connection.execute(f'INSERT OR REPLACE INTO jobs VALUES ({", ".join("?" * len(_JOB_FIELDS))})',
+                               [row[field] for field in _JOB_FIELDS])
+
+    def job(self, job_id):
+        '''Status of a job run by any worker, or None'''
+        with self._connect() as connection:
+            row = connection.execute(f'SELECT {", ".join(_JOB_FIELDS)} FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        status = dict(zip(_JOB_FIELDS, row))
+        del status['pid']
+        status['result'] = json.loads(status['result']) if status['result'] is not None else None
+        return status
+
+    def latest_job_id(self):
+        with self._connect() as connection:
+            row = connection.execute('SELECT id FROM jobs ORDER BY submitted DESC LIMIT 1').fetchone()
+        return row[0] if row else None
+
+    def fail_abandoned_jobs(self):
+        '''Marks as failed the unfinished jobs of worker processes that no longer exist,
+        e.g. after a crash. Returns their ids'''
+        with self._connect() as connection:
+            rows = connection.execute("SELECT id, pid FROM jobs WHERE state IN ('queued', 'running')").fetchall()
+            abandoned = [job_id for job_id, pid in rows if pid != os.getpid() and not _process_alive(pid)]
+            connection.executemany(
+                "UPDATE jobs SET state = 'failed', error = 'worker process exited', finished = ? WHERE id = ?",
+                [(time.time(), job_id) for job_id in abandoned])
+        return abandoned
+
+    def forget_old_jobs(self, keep):
+        with self._connect() as connection:
+            connection.execute("DELETE FROM jobs WHERE state IN ('done', 'failed') AND id NOT IN "
+                               '(SELECT id FROM jobs ORDER BY submitted DESC LIMIT ?)', (keep,))
+
+    # --- Events ---
+
+    def add_event(self, event, data):
+        '''Appends an event (data already JSON encoded) and returns its id'''
+        with self._connect() as connection:
+            event_id = connection.execute('INSERT INTO events (event, data) VALUES (?, ?)', (event, data)).lastrowid
+            connection.execute('DELETE FROM events WHERE id <= ?', (event_id - EVENT_HISTORY,))
+        return event_id
+
+    def events_after(self, last_id):
+        '''(id, event, data) of the events published after last_id, oldest first'''
+        with self._connect() as connection:
+            return connection.execute('SELECT id, event, data FROM events WHERE id > ? ORDER BY id',
+                                      (last_id,)).fetchall()
+
+    def last_event_id(self):
+        with self._connect() as connection:
+            row = connection.execute('SELECT MAX(id) FROM events').fetchone()
+        return row[0] or 0
+
+    # --- Leases and values ---
+
+    def acquire_lease(self, name, duration):
+        '''Takes (or renews) the lease name for duration seconds if it is free, expired
+        or already held by this process. Returns True if this process holds it'''
+        now = time.time()
+        with self._connect() as connection:
+            cursor = connection.execute(
+                'INSERT INTO leases VALUES (?, ?, ?) ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, '
+                'expires = excluded.expires WHERE leases.expires < ? OR leases.owner = excluded.owner',
+                (name, os.getpid(), now + duration, now))
+            return cursor.rowcount > 0
+
+    def release_lease(self, name):
+        '''Gives up the lease name if this process holds it'''
+        with self._connect() as connection:
+            connection.execute('DELETE FROM leases WHERE name = ? AND owner = ?', (name, os.getpid()))
+
+    def set_value(self, name, value):
+        with self._connect() as connection:
+            connection.execute('INSERT OR REPLACE INTO state_values VALUES (?, ?)', (name, json.dumps(value)))
+
+    def get_value(self, name, default=None):
+        with self._connect() as connection:
+            row = connection.execute('SELECT value FROM state_values WHERE name = ?', (name,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    # --- Deferred runs ---
+
+    def defer_run(self, run_id, device_id):
+        '''Keeps a stored run to be processed when a worker is free'''
+        with self._connect() as connection:
+            connection.execute('INSERT OR IGNORE INTO deferred_runs VALUES (?, ?, ?, NULL)',
+                               (run_id, device_id, time.time()))
+
+    def claim_deferred_run(self):
+        '''Takes the oldest deferred run no worker process has taken.
+        Returns (run id, device id) or None'''
+        while True:
+            with self._connect() as connection:
+                row = connection.execute('SELECT run_id, device FROM deferred_runs WHERE pid IS NULL '
+                                         'ORDER BY deferred LIMIT 1').fetchone()
+                if row is None:
+                    return None
+                # Another process may have taken it in the meantime
+                if connection.execute('UPDATE deferred_runs SET pid = ? WHERE run_id = ? AND pid IS NULL',
+                                      (os.getpid(), row[0])).rowcount:
+                    return row
+
+    def release_deferred_run(self, run_id):
+        '''Gives back a claimed run that could not be queued'''
+        with self._connect() as connection:
+            connection.execute('UPDATE deferred_runs SET pid = NULL WHERE run_id = ?', (run_id,))
+
+    def finish_deferred_run(self, run_id):
+        '''Forgets a deferred run once its job is over'''
+        with self._connect() as connection:
+            connection.execute('DELETE FROM deferred_runs WHERE run_id = ?', (run_id,))
+
+    def release_abandoned_runs(self):
+        '''Gives back the deferred runs claimed by worker processes that no longer exist,
+        or by an earlier process with the pid of this one. Returns their ids'''
+        with self._connect() as connection:
+            rows = connection.execute('SELECT run_id, pid FROM deferred_runs WHERE pid IS NOT NULL').fetchall()
+            abandoned = [run_id for run_id, pid in rows if pid == os.getpid() or not _process_alive(pid)]
+            connection.executemany('UPDATE deferred_runs SET pid = NULL WHERE run_id = ?',
+                                   [(run_id,) for run_id in abandoned])
+        return abandoned
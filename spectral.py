@@ -0,0 +1,94 @@
+'''Low-pass filtering and differentiation of uniformly sampled channels in the
+frequency domain.
+
+A derivative of order k multiplies every frequency component by (i w)^k, so one
+real FFT of a channel gives the smoothed signal and all its derivatives: the
+spectrum is multiplied by the low-pass window and by (i w)^k and transformed back.
+The channels are rows of a 2-D array and are transformed together.
+
+The FFT assumes a periodic signal. To avoid the ringing a jump between the last
+and the first sample would cause, a cubic with the values and the curvature of
+both ends is subtracted (and its derivatives added back afterwards), and the rest
+is extended with its odd reflection, which joins the copies without a jump in the
+value or its first three derivatives.
+
+The window keeps the frequencies below cutoff, falls to zero with a raised cosine
+over the next rolloff Hz and removes everything above'''
+import numpy as np
+
+# Frequencies kept untouched, in Hz
+SPECTRAL_CUTOFF = 10.
+# Width of the raised cosine after the cutoff, in Hz
+SPECTRAL_ROLLOFF = 5.
+
+
+def lowpass_window(frequencies, cutoff=SPECTRAL_CUTOFF, rolloff=SPECTRAL_ROLLOFF):
+    '''Gain of the low-pass window at each frequency (Hz)'''
+    if rolloff <= 0:
+        return (frequencies <= cutoff).astype(np.float64)
+    position = np.clip((frequencies - cutoff) / rolloff, 0., 1.)
+    return 0.5 * (1. + np.cos(np.pi * position))
+
+
+def _end_curvature(values, dt, n_fit):
+    '''Second derivative of every row at its first sample, from a parabola fitted
+    to its first n_fit samples'''
+    offsets = np.arange(n_fit) * dt
+    return 2. * np.polyfit(offsets, values[:, :n_fit].T, 2)[0]
+
+
+def _end_trend(values, dt, cutoff):
+    '''Cubic of every row with its values at both ends and its curvature there,
+    estimated over about half a period of the cutoff. Removing it leaves rows that
+    are zero and straight at the ends, so their odd reflection has no jump up to
+    the third derivative. Returns the cubic and its first two derivatives'''
+    n = values.shape[-1]
+    length = (n - 1) * dt
+    s = np.arange(n) / (n - 1)
+    slope = (values[:, -1] - values[:, 0]) / length
+    line = values[:, :1] + slope[:, None] * (s * length)
+    n_fit = min(n, max(5, int(0.5 / (cutoff * dt))))
+    if n_fit < 5:
+        return line, np.repeat(slope[:, None], n, axis=1), np.zeros_like(values)
+    start = _end_curvature(values, dt, n_fit)[:, None]
+    end = _end_curvature(values[:, ::-1], dt, n_fit)[:, None]
+    # Cubics that vanish at both ends with curvature 1 at the start (f) or at the end (g)
+    f = -s ** 3 / 6 + s ** 2 / 2 - s / 3
+    f_dot = (-s ** 2 / 2 + s - 1 / 3) / length
+    f_ddot = (1 - s) / length ** 2
+    g = (s ** 3 - s) / 6
+    g_dot = (s ** 2 / 2 - 1 / 6) / length
+    g_ddot = s / length ** 2
+    scale = length ** 2
+    return (line + scale * (start * f + end * g),
+            slope[:, None] + scale * (start * f_dot + end * g_dot),
+            scale * (start * f_ddot + end * g_ddot))
+
+
+def spectral_derivatives(values, dt, orders=(0, 1, 2), cutoff=SPECTRAL_CUTOFF, rolloff=SPECTRAL_ROLLOFF):
+    '''Low-pass filtered derivatives of the rows of values (n_channels, n_samples)
+    sampled every dt seconds. Returns an array (len(orders), n_channels, n_samples),
+    order 0 is the filtered signal'''
+    values = np.atleast_2d(np.asarray(values, dtype=np.float64))
+    n = values.shape[-1]
+    derivatives = np.zeros((len(orders),) + values.shape)
+    if n < 2:
+        if 0 in orders:
+            derivatives[list(orders).index(0)] = values
+        return derivatives
+
+    trend = _end_trend(values, dt, cutoff)
+    rest = values - trend[0]
+    # Odd reflection: period 2 (n - 1), the ends of rest are zero
+    extended = np.concatenate([rest, -rest[:, -2:0:-1]], axis=1)
+
+    spectrum = np.fft.rfft(extended, axis=1)
+    frequencies = np.fft.rfftfreq(extended.shape[1], dt)
+    spectrum *= lowpass_window(frequencies, cutoff, rolloff)
+    i_omega = 2j * np.pi * frequencies
+    for index, order in enumerate(orders):
+        derivative = np.fft.irfft(spectrum * i_omega ** order, extended.shape[1], axis=1)[:, :n]
+        if order < len(trend):
+            derivative += trend[order]
+        derivatives[index] = derivative
+    return derivatives
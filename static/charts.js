@@ -0,0 +1,314 @@
+// Interactive charts of the processed series, drawn on <canvas> elements.
+// The data comes from /runs/<id>/series, already reduced by the server to about
+// one point per pixel. Mouse wheel: zoom the time axis, drag: pan, double click:
+// show the whole run. After zooming the visible window is requested again so
+// the detail grows with the zoom. All the charts share the same time axis.
+// While a run is streamed the charts show its partial series from
+// /streams/<id>/series and grow with it.
+
+var CHARTS = [
+    {name: 'r', title: 'Distance vs Time', label: 'Distance (r)', color: '#1f77b4'},
+    {name: 'r_dot', title: 'Linear Velocity vs Time', label: 'Velocity (dr/dt)', color: '#1f77b4'},
+    {name: 'r_ddot', title: 'Linear Acceleration vs Time', label: 'Acceleration (d²r/dt²)', color: '#1f77b4'},
+    {name: 'theta', title: 'Angle vs Time', label: 'Angle (θ)', color: '#ff7f0e'},
+    {name: 'theta_dot', title: 'Angular Velocity vs Time', label: 'Velocity (dθ/dt)', color: '#ff7f0e'},
+    {name: 'theta_ddot', title: 'Angular Acceleration vs Time', label: 'Acceleration (d²θ/dt²)', color: '#ff7f0e'}
+];
+var MARGIN = {left: 60, right: 10, top: 24, bottom: 28};
+
+var chartState = {
+    device: null,      // station whose runs are shown, 'latest' means its last run
+    runId: null,       // run shown in the charts
+    streamId: null,    // stream shown in the charts while it is captured
+    closedStream: null, // last stream that ended, its run replaces it
+    streamRequest: null,
+    pendingStream: null,
+    fullRange: null,   // [t0, t1] of the whole run
+    view: null,        // [t0, t1] currently visible
+    series: {},        // name -> {t: [...], y: [...]}
+    hover: null,       // time under the mouse
+    reloadTimer: null
+};
+
+function setupCharts(container) {
+    CHARTS.forEach(function (chart) {
+        var canvas = document.createElement('canvas');
+        canvas.width = 480;
+        canvas.height = 300;
+        canvas.id = 'chart_' + chart.name;
+        canvas.style.cursor = 'crosshair';
+        container.appendChild(canvas);
+        chart.canvas = canvas;
+        attachChartEvents(canvas);
+    });
+}
+
+function loadSeries(runId, window) {
+    var width = CHARTS[0].canvas.width - MARGIN.left - MARGIN.right;
+    var url = '/runs/' + runId + '/series?width=' + width;
+    if (window) {
+        url += '&t0=' + window[0] + '&t1=' + window[1];
+    }
+    if (runId === 'latest' && chartState.device) {
+        url += '&device=' + encodeURIComponent(chartState.device);
+    }
+    var xhr = new XMLHttpRequest();
+    xhr.open('GET', url, true);
+    xhr.onload = function () {
+        if (xhr.status !== 200) {
+            return;
+        }
+        var data = JSON.parse(xhr.responseText);
+        if (data.run_id !== chartState.runId) {
+            // A new run, show it whole
+            chartState.runId = data.run_id;
+            chartState.streamId = null;
+            chartState.fullRange = data.t_range;
+            chartState.view = data.t_range.slice();
+        }
+        chartState.series = data.series;
+        drawCharts();
+    };
+    xhr.send();
+}
+
+// Partial series of a run that is still being captured. The charts follow the
+// run as it grows, unless the user zoomed into it
+function loadStreamSeries(streamId) {
+    if (chartState.streamRequest) {
+        // One request at a time, the last stream event is loaded after it
+        chartState.pendingStream = streamId;
+        return;
+    }
+    var width = CHARTS[0].canvas.width - MARGIN.left - MARGIN.right;
+    var xhr = new XMLHttpRequest();
+    chartState.streamRequest = xhr;
+    xhr.open('GET', '/streams/' + streamId + '/series?width=' + width, true);
+    xhr.onload = function () {
+        if (xhr.status !== 200 || streamId === chartState.closedStream) {
+            return;
+        }
+        var data = JSON.parse(xhr.responseText);
+        if (data.stream_id !== streamId || data.t_range.length === 0) {
+            return;
+        }
+        var full = chartState.fullRange, view = chartState.view;
+        var following = chartState.streamId !== streamId || !view || (view[0] === full[0] && view[1] === full[1]);
+        chartState.runId = null;
+        chartState.streamId = streamId;
+        chartState.fullRange = data.t_range;
+        if (following) {
+            chartState.view = data.t_range.slice();
+        }
+        chartState.series = data.series;
+        drawCharts();
+    };
+    xhr.onloadend = function () {
+        chartState.streamRequest = null;
+        var pending = chartState.pendingStream;
+        chartState.pendingStream = null;
+        if (pending && pending !== chartState.closedStream) {
+            loadStreamSeries(pending);
+        }
+    };
+    xhr.send();
+}
+
+function drawCharts() {
+    CHARTS.forEach(function (chart) {
+        drawChart(chart, chartState.series[chart.name]);
+    });
+}
+
+function visibleBounds(series, view) {
+    var low = Infinity, high = -Infinity;
+    for (var i = 0; i < series.t.length; i++) {
+        var y = series.y[i];
+        if (y === null || series.t[i] < view[0] || series.t[i] > view[1]) {
+            continue;
+        }
+        low = Math.min(low, y);
+        high = Math.max(high, y);
+    }
+    if (low === Infinity) {
+        return [0, 1];
+    }
+    if (low === high) {
+        return [low - 1, high + 1];
+    }
+    var pad = (high - low) * 0.05;
+    return [low - pad, high + pad];
+}
+
+function drawChart(chart, series) {
+    var canvas = chart.canvas;
+    var ctx = canvas.getContext('2d');
+    var plotWidth = canvas.width - MARGIN.left - MARGIN.right;
+    var plotHeight = canvas.height - MARGIN.top - MARGIN.bottom;
+    ctx.clearRect(0, 0, canvas.width, canvas.height);
+
+    ctx.fillStyle = '#000';
+    ctx.font = '13px sans-serif';
+    ctx.textAlign = 'center';
+    ctx.fillText(chart.title, canvas.width / 2, 16);
+    ctx.strokeStyle = '#888';
+    ctx.strokeRect(MARGIN.left, MARGIN.top, plotWidth, plotHeight);
+    if (!series || !chartState.view) {
+        return;
+    }
+
+    var view = chartState.view;
+    var bounds = visibleBounds(series, view);
+    var xOf = function (t) { return MARGIN.left + (t - view[0]) / (view[1] - view[0]) * plotWidth; };
+    var yOf = function (y) { return MARGIN.top + (bounds[1] - y) / (bounds[1] - bounds[0]) * plotHeight; };
+
+    // Axis labels: limits of both axes
+    ctx.font = '11px sans-serif';
+    ctx.textAlign = 'right';
+    ctx.fillText(bounds[1].toPrecision(4), MARGIN.left - 4, MARGIN.top + 10);
+    ctx.fillText(bounds[0].toPrecision(4), MARGIN.left - 4, MARGIN.top + plotHeight);
+    ctx.save();
+    ctx.translate(12, MARGIN.top + plotHeight / 2);
+    ctx.rotate(-Math.PI / 2);
+    ctx.textAlign = 'center';
+    ctx.fillText(chart.label, 0, 0);
+    ctx.restore();
+    ctx.textAlign = 'left';
+    ctx.fillText(view[0].toFixed(3) + ' s', MARGIN.left, canvas.height - 8);
+    ctx.textAlign = 'right';
+    ctx.fillText(view[1].toFixed(3) + ' s', MARGIN.left + plotWidth, canvas.height - 8);
+    ctx.textAlign = 'center';
+    ctx.fillText('Time (s)', MARGIN.left + plotWidth / 2, canvas.height - 8);
+
+    // Curve, clipped to the plot area. Missing values (null) break the line
+    ctx.save();
+    ctx.beginPath();
+    ctx.rect(MARGIN.left, MARGIN.top, plotWidth, plotHeight);
+    ctx.clip();
+    ctx.strokeStyle = chart.color;
+    ctx.lineWidth = 1.2;
+    ctx.beginPath();
+    var drawing = false;
+    for (var i = 0; i < series.t.length; i++) {
+        if (series.y[i] === null) {
+            drawing = false;
+            continue;
+        }
+        var x = xOf(series.t[i]), y = yOf(series.y[i]);
+        if (drawing) {
+            ctx.lineTo(x, y);
+        } else {
+            ctx.moveTo(x, y);
+            drawing = true;
+        }
+    }
+    ctx.stroke();
+
+    // Hover: vertical line and value of the nearest point
+    if (chartState.hover !== null) {
+        var nearest = nearestIndex(series.t, chartState.hover);
+        if (nearest >= 0 && series.y[nearest] !== null) {
+            var hx = xOf(series.t[nearest]), hy = yOf(series.y[nearest]);
+            ctx.strokeStyle = '#aaa';
+            ctx.lineWidth = 1;
+            ctx.beginPath();
+            ctx.moveTo(hx, MARGIN.top);
+            ctx.lineTo(hx, MARGIN.top + plotHeight);
+            ctx.stroke();
+            ctx.fillStyle = chart.color;
+            ctx.beginPath();
+            ctx.arc(hx, hy, 3, 0, 2 * Math.PI);
+            ctx.fill();
+            ctx.fillStyle = '#000';
+            ctx.textAlign = hx > MARGIN.left + plotWidth / 2 ? 'right' : 'left';
+            ctx.fillText('t=' + series.t[nearest].toFixed(3) + '  ' + series.y[nearest].toPrecision(4),
+                         hx + (ctx.textAlign === 'left' ? 6 : -6), MARGIN.top + 14);
+        }
+    }
+    ctx.restore();
+}
+
+function nearestIndex(times, t) {
+    // Binary search, the times are sorted
+    var low = 0, high = times.length - 1;
+    if (high < 0) {
+        return -1;
+    }
+    while (high - low > 1) {
+        var middle = (low + high) >> 1;
+        if (times[middle] < t) {
+            low = middle;
+        } else {
+            high = middle;
+        }
+    }
+    return Math.abs(times[low] - t) <= Math.abs(times[high] - t) ? low : high;
+}
+
+function timeAt(canvas, event) {
+    var rect = canvas.getBoundingClientRect();
+    var x = (event.clientX - rect.left) * canvas.width / rect.width;
+    var plotWidth = canvas.width - MARGIN.left - MARGIN.right;
+    var view = chartState.view;
+    return view[0] + (x - MARGIN.left) / plotWidth * (view[1] - view[0]);
+}
+
+function setView(t0, t1) {
+    var full = chartState.fullRange;
+    var span = Math.min(t1 - t0, full[1] - full[0]);
+    t0 = Math.max(full[0], Math.min(t0, full[1] - span));
+    chartState.view = [t0, t0 + span];
+    drawCharts();
+    // Ask for the detail of the new window once the user stops zooming
+    clearTimeout(chartState.reloadTimer);
+    chartState.reloadTimer = setTimeout(function () {
+        // The series of a stream are reloaded by its next batch
+        if (chartState.runId) {
+            loadSeries(chartState.runId, chartState.view);
+        }
+    }, 250);
+}
+
+function attachChartEvents(canvas) {
+    var dragStart = null;
+    canvas.addEventListener('mousemove', function (event) {
+        if (!chartState.view) {
+            return;
+        }
+        var t = timeAt(canvas, event);
+        if (dragStart !== null) {
+            var shift = dragStart - t;
+            setView(chartState.view[0] + shift, chartState.view[1] + shift);
+            return;
+        }
+        chartState.hover = t;
+        drawCharts();
+    });
+    canvas.addEventListener('mouseleave', function () {
+        chartState.hover = null;
+        dragStart = null;
+        drawCharts();
+    });
+    canvas.addEventListener('mousedown', function (event) {
+        if (chartState.view) {
+            dragStart = timeAt(canvas, event);
+        }
+    });
+    canvas.addEventListener('mouseup', function () {
+        dragStart = null;
+    });
+    canvas.addEventListener('wheel', function (event) {
+        if (!chartState.view) {
+            return;
+        }
+        event.preventDefault();
+        var t = timeAt(canvas, event);
+        var factor = event.deltaY < 0 ? 0.8 : 1.25;
+        setView(t - (t - chartState.view[0]) * factor, t + (chartState.view[1] - t) * factor);
+    }, {passive: false});
+    canvas.addEventListener('dblclick', function () {
+        if (chartState.fullRange) {
+            setView(chartState.fullRange[0], chartState.fullRange[1]);
+        }
+    });
+}
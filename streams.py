@@ -0,0 +1,220 @@
+'''Runs sent in batches while the pico captures them (streaming mode).
+
+The pico opens a stream with the header of its binary run, sends the records in
+batches as its sample buffer fills, each one with the number of records it sent
+before it (offset), and closes the stream when the sweep ends. A batch with an
+offset already received is a resend and is ignored, one with a larger offset
+means a batch was lost and is refused, so the records always match the capture.
+
+The batches are appended to an upload file of the run store, the only state of a
+stream the worker processes share. Any process can take a batch: a process that
+did not see the ones before reads them from the file before processing it. Each
+process keeps the online pipeline (see online) of the streams it has seen, so
+the partial results are there while the mechanism is moving, and the complete
+run when the last batch arrives. A stream that is not closed is removed with the
+other leftovers of the run store, and forgotten by the processes after
+STREAM_IDLE seconds without batches'''
+import contextlib
+import os
+import re
+import threading
+import time
+import uuid
+
+import numpy as np
+
+from online import OnlinePipeline, streamable
+from sensor_data import decode_binary, binary_record_dtype, records_to_binary_columns
+
+# Streams without batches for this long (seconds) are dropped from memory
+STREAM_IDLE = 3600
+# Longest a process can keep a stream locked, in case it dies while appending
+APPEND_LEASE = 10
+# Stream ids are uuid4 hex strings, anything else never names a file
+STREAM_ID_PATTERN = re.compile(r'[0-9a-f]{32}')
+
+
+class StreamError(ValueError):
+    '''Batch that does not fit the stream. expected is the offset the stream is at'''
+
+    def __init__(self, message, expected=None):
+        super().__init__(message)
+        self.expected = expected
+
+
+class LiveStream:
+    '''A stream as seen by this process: its header, the records it has processed
+    and the online pipeline'''
+
+    def __init__(self, stream_id, path, parameters):
+        self.id = stream_id
+        self.path = path
+        self.lock = threading.Lock()
+        with open(path, 'rb') as file:
+            # The header is small, the records after it are read by catch_up
+            self.header, _, _ = decode_binary(file.read(4096))
+        self.dtype = binary_record_dtype(self.header['channels'], self.header['record_size'])
+        self.offset = self.header['header_size']  # bytes of the file already processed
+        self.records = 0
+        self.ticks = 0
+        self.duration = 0.
+        self.pipeline = OnlinePipeline(parameters) if streamable(parameters) else None
+        self.touched = time.monotonic()
+
+    def catch_up(self):
+        '''Processes the records appended to the file since the last call'''
+        with open(self.path, 'rb') as file:
+            file.seek(self.offset)
+            data = file.read()
+        n_records = len(data) // self.header['record_size']
+        self.touched = time.monotonic()
+        if not n_records:
+            return
+        records = np.frombuffer(data, dtype=self.dtype, count=n_records)
+        columns = records_to_binary_columns(self.header, records, self.ticks)
+        self.ticks += int(records['tick_delta'].sum(dtype=np.int64))
+        self.offset += n_records * self.header['record_size']
+        self.records += n_records
+        if not len(columns['time']):
+            # Only skip records, the next batch brings their samples
+            return
+        self.duration = float(columns['time'][-1])
+        if self.pipeline is not None:
+            self.pipeline.feed(columns)
+
+    def status(self):
+        return {
+            'id': self.id,
+            'records': self.records,
+            'duration': self.duration,
+            'online': self.pipeline is not None,
+            'samples': self.pipeline.samples if self.pipeline is not None else 0,
+            'segments': self.pipeline.segments if self.pipeline is not None else 0,
+        }
+
+
+class StreamStore:
+    '''Streams of every device. The metadata (device, state and, once closed, the
+    run) is kept in the SharedState database under stream:<id>'''
+
+    def __init__(self, folder, state, parameters):
+        self.folder = folder
+        self.state = state
+        self.parameters = parameters
+        self._lock = threading.Lock()
+        self._streams = {}
+
+    def path(self, stream_id):
+        # Named like the uploads, so the run store removes abandoned ones
+        return os.path.join(self.folder, f'upload-{stream_id}.bin')
+
+    def info(self, stream_id):
+        '''Shared metadata of a stream, or None'''
+        if not STREAM_ID_PATTERN.fullmatch(stream_id):
+            return None
+        return self.state.get_value(f'stream:{stream_id}')
+
+    def _set_info(self, info):
+        self.state.set_value(f'stream:{info["id"]}', info)
+
+    def open(self, device_id, header):
+        '''Starts the stream of a device from the header of its binary run (records
+        may follow it). Returns the metadata of the stream'''
+        # Fails with ValueError if the header is not valid
+        decode_binary(header)
+        stream_id = uuid.uuid4().hex
+        path = self.path(stream_id)
+        temporary_path = f'{path}.{os.getpid()}-{threading.get_ident()}.tmp'
+        with open(temporary_path, 'wb') as file:
+            file.write(header)
+        os.replace(temporary_path, path)
+        info = {'id': stream_id, 'device': device_id, 'state': 'capturing', 'opened': time.time(), 'run_id': None}
+        self._set_info(info)
+        self._forget_idle()
+        return info
+
+    def get(self, stream_id):
+        '''LiveStream of an open stream, up to date with its file, or None'''
+        if not STREAM_ID_PATTERN.fullmatch(stream_id) or not os.path.exists(self.path(stream_id)):
+            return None
+        stream = self._streams.get(stream_id)
+        if stream is None:
+            try:
+                stream = LiveStream(stream_id, self.path(stream_id), self.parameters)
+            except FileNotFoundError:
+                return None
+            with self._lock:
+                stream = self._streams.setdefault(stream_id, stream)
+        with stream.lock:
+            try:
+                stream.catch_up()
+            except FileNotFoundError:
+                # Closed by another process in the meantime
+                pass
+        return stream
+
+    def append(self, stream_id, offset, data):
+        '''Adds a batch of records sent after offset records. Returns the LiveStream'''
+        stream = self.get(stream_id)
+        if stream is None:
+            raise KeyError(stream_id)
+        record_size = stream.header['record_size']
+        if len(data) % record_size:
+            raise StreamError(f'the batch is not a whole number of {record_size} byte records')
+        with stream.lock, self._append_lease(stream_id):
+            stream.catch_up()
+            if offset + len(data) // record_size <= stream.records:
+                # Sent again after a lost answer, already there
+                return stream
+            if offset != stream.records:
+                raise StreamError(f'batch at record {offset}, the stream has {stream.records}', stream.records)
+            with open(stream.path, 'ab') as file:
+                file.write(data)
+            stream.catch_up()
+        return stream
+
+    @contextlib.contextmanager
+    def _append_lease(self, stream_id):
+        '''Keeps the other processes from appending to the same stream'''
+        deadline = time.monotonic() + APPEND_LEASE
+        while not self.state.acquire_lease(f'stream:{stream_id}', APPEND_LEASE):
+            if time.monotonic() > deadline:
+                raise TimeoutError(f'stream {stream_id} is locked by another process')
+            time.sleep(0.01)
+        try:
+            yield
+        finally:
+            self.state.release_lease(f'stream:{stream_id}')
+
+    def close(self, stream_id):
+        '''Ends a stream. Returns (LiveStream, series, report), series and report are
+        None when the pipeline is not streamable. The file stays where it is, the
+        caller moves it into the run and calls closed()'''
+        stream = self.get(stream_id)
+        if stream is None:
+            raise KeyError(stream_id)
+        with stream.lock, self._append_lease(stream_id):
+            stream.catch_up()
+            # The pico deletes its file once the stream is closed
+            with open(stream.path, 'ab') as file:
+                os.fsync(file.fileno())
+            if stream.pipeline is None:
+                return stream, None, None
+            report = {}
+            series = stream.pipeline.finish(report)
+        return stream, series, report
+
+    def closed(self, stream_id, run_id):
+        '''Records the run of a closed stream and forgets its pipeline'''
+        info = self.info(stream_id) or {'id': stream_id}
+        info.update(state='done', run_id=run_id)
+        self._set_info(info)
+        with self._lock:
+            self._streams.pop(stream_id, None)
+
+    def _forget_idle(self):
+        limit = time.monotonic() - STREAM_IDLE
+        with self._lock:
+            for stream_id, stream in list(self._streams.items()):
+                if stream.touched < limit:
+                    del self._streams[stream_id]
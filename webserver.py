@@ -1,194 +1,597 @@
 '''Web server that displays a webpage used to view the data from the raspberry pi pico'''
 # Impor the web-relevant server libraries
-from flask import Flask, request, render_template, jsonify
+from flask import Flask, request, render_template, jsonify, Response, send_file, stream_with_context, redirect, url_for
+import gzip
 import json
+import math
 import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
 
-# Import data handling libraries
-import pandas as pd
-from openpyxl import Workbook
-
-
-# Matplotlib handles data visualization
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-
+# scipy, matplotlib and openpyxl take most of the startup time and only the processing
+# or the export of a run needs them, so they are imported inside the functions that
+# use them (process_readings, get_plot_renderer, exports). See warmup() to load them early
 
 # NumPy handles the different computations (speeds, positions, etc). It is imported as np by convention
 # Note: Numpy handles numerical and array computations, similar to matlab. Be careful when operating with scalars
 import numpy as np
 
-# SciPy provides several signal processing and filtering capabilities
-# it also provides cumulative integrals by trapezoidal rule
-from scipy import integrate
-from scipy import signal
-from filterpy.kalman import KalmanFilter
-from scipy.signal import savgol_filter
+# Bulk loader for the readings file and the batched Kalman filter
+from sensor_data import load_sensor_columns, StreamingParser, BINARY_CONTENT_TYPE, SENSOR_KEYS, binary_to_columns
+from kalman import KALMAN_R, KALMAN_Q, KALMAN_P0
+
+# Uniform time grid for the filters, split at the holes of the capture
+from resampling import RESAMPLE_RATE, MAX_GAP
+
+# Optional smoothing and differentiation in the frequency domain
+from spectral import SPECTRAL_CUTOFF, SPECTRAL_ROLLOFF
+
+# The processing is a list of stages (Kalman, calibration, smoothing, derivatives...)
+from pipeline import get_pipeline, DEFAULT_STAGES, measure
+
+# Processed runs are cached by the hash of their raw data
+from result_cache import ResultCache, cache_hasher, cache_key
+
+# Every upload is kept as a run with its metadata in a SQLite catalog
+from run_store import RunStore, sort_by_time, fsync_directory
+
+# Start signal, capture state and last run of each station (one pico each)
+from devices import DeviceRegistry, DEFAULT_DEVICE, valid_device_id
+
+# Runs sent in batches during the capture, processed while they arrive
+from streams import StreamStore, StreamError
+
+# Reduction of the series sent to the dashboard charts
+from decimation import lttb_indices
+
+# Data exports (CSV, NPY, NPZ, XLSX, Parquet) produced when they are downloaded
+import exports
+
+# Uploads are processed in the background by a bounded pool of workers
+from jobs import JobQueue, QueueFull, MAX_HISTORY
+from events import EventBroadcaster
+
+# Counters and histograms served by /metrics
+from metrics import Registry, SIZE_BUCKETS
+
+# Start signals, jobs, events and the last run live in a database shared by the worker
+# processes, so the app can run under a multi-worker WSGI server. Every pico keeps a
+# long poll of /check_start_signal open and every dashboard an /events stream, so
+# with thread workers each of them holds a thread all the time. An async worker
+# class serves them without a thread each (gevent has to be installed):
+#   gunicorn -k gevent -w 4 --worker-connections 1000 webserver:app
+# With threads, give every process one per station and per open dashboard plus
+# some for the uploads and downloads, e.g. for 10 stations and 5 browsers:
+#   gunicorn -w 4 --threads 24 webserver:app
+# MAX_LONG_POLLS and MAX_EVENT_STREAMS (per process) keep them from taking every
+# thread anyway: polls beyond the limit wait SHORT_START_WAIT at most, streams
+# beyond it are closed and the browser connects again EVENT_STREAM_RETRY ms later
+from shared_state import SharedState
 
 
 app = Flask(__name__)
-start_signal = False
-
-def export_to_excel(t, r, r_dot, r_ddot, theta, theta_dot, theta_ddot):
-    '''Function to export the variables to an Excel file'''
-    data = {
-        'Time (s)': t,
-        'r (Distance)': r,
-        'r_dot (Velocity)': r_dot,
-        'r_ddot (Acceleration)': r_ddot,
-        'theta (Angle)': theta,
-        'theta_dot (Angular Velocity)': theta_dot,
-        'theta_ddot (Angular Acceleration)': theta_ddot
-    }
+# Longest time a /check_start_signal?wait= request is held, in seconds
+MAX_START_WAIT = 60
+# Long polls and event streams held at the same time by a worker process
+MAX_LONG_POLLS = int(os.environ.get('SENSOR_MAX_LONG_POLLS', 16))
+MAX_EVENT_STREAMS = int(os.environ.get('SENSOR_MAX_EVENT_STREAMS', 8))
+# Wait of the polls beyond MAX_LONG_POLLS, in seconds
+SHORT_START_WAIT = 1.
+# Milliseconds a browser waits to connect again when MAX_EVENT_STREAMS are open
+EVENT_STREAM_RETRY = 10000
+long_polls = threading.BoundedSemaphore(MAX_LONG_POLLS)
+event_streams = threading.BoundedSemaphore(MAX_EVENT_STREAMS)
+
+# State shared by every worker process of the server
+shared_state = SharedState()
+# Tells the open dashboards when a job changes state (Server-Sent Events)
+event_broadcaster = EventBroadcaster(state=shared_state)
+
+
+def job_changed(status):
+    '''Listener of the job queue: any worker can answer /jobs/<id> and the dashboards are told'''
+    shared_state.save_job(status)
+    if status['state'] == 'done':
+        shared_state.forget_old_jobs(MAX_HISTORY)
+    event_broadcaster.publish('job', status)
+    if status['state'] in ('done', 'failed'):
+        # A worker is free, a run that found the queue full can go now
+        submit_deferred_run()
+
+
+# Queue that runs generate_plot after each upload
+job_queue = JobQueue(listener=job_changed)
+# Job drawing the plot of each cache key, see request_plot
+plot_jobs = {}
+# Jobs left unfinished by a worker process that crashed will never finish
+shared_state.fail_abandoned_jobs()
+# Runs stored while the queue was full are kept in the shared state. They are
+# queued when a job finishes, at startup (resume_deferred_runs), or processed by
+# run_results when they are read first. The ones a dead process took are given back
+shared_state.release_abandoned_runs()
+# Stations and their start signals. The dashboards get a 'device' event on every change
+device_registry = DeviceRegistry(shared_state, listener=lambda state: event_broadcaster.publish('device', state))
+# The plot figure is not thread safe and every job writes the same output files,
+# so the workers of a process take turns for the plotting part
+output_lock = threading.Lock()
+# Arrays and output files of recently processed runs
+result_cache = ResultCache()
+# Uploaded runs (sample columns and catalog)
+run_store = RunStore()
+# Figure reused for every plot.png, created on the first render
+plot_renderer = None
+
+# Metrics of this process, recorded once per request or job (see metrics)
+metrics_registry = Registry()
+upload_bytes = metrics_registry.histogram('sensor_upload_bytes', 'Size of the received uploads in bytes',
+                                          buckets=SIZE_BUCKETS)
+upload_seconds = metrics_registry.histogram('sensor_upload_seconds',
+                                            'Time to receive, parse, hash and store an upload')
+uploads = metrics_registry.counter('sensor_uploads_total', 'Uploads by result: accepted, invalid or deferred '
+                                   '(stored while the job queue was full)',
+                                   labels=('result',))
+stage_seconds = metrics_registry.histogram(
+    'sensor_stage_seconds', 'Time of each processing step of a run: parse, the pipeline stages '
+    '(resample, kalman filter, savgol smoothing, gradient or spectral derivatives...), plot render and export',
+    labels=('stage',))
+stream_batches = metrics_registry.counter(
+    'sensor_stream_batches_total', 'Record batches of streamed runs by result: accepted or refused', labels=('result',))
+start_polls = metrics_registry.counter('sensor_start_polls_total', 'Start signal polls by device', labels=('device',))
+# Most stations with series of their own in the per-device metrics, any id is
+# valid so the ones after them are counted together as 'other'
+MAX_DEVICE_LABELS = 64
+device_labels = set()
+device_labels_lock = threading.Lock()
 
-    # Create a pandas DataFrame
-    df = pd.DataFrame(data)
 
-    # Save DataFrame to Excel file
-    excel_filename = 'static/sensor_data.xlsx'  # Path where the Excel file will be saved
-    df.to_excel(excel_filename, index=False)
-    print(f"Data exported to {excel_filename}")
+def device_label(device_id):
+    '''Value of the device label of a station, bounded to MAX_DEVICE_LABELS stations'''
+    if device_id not in device_labels:
+        with device_labels_lock:
+            if device_id not in device_labels and len(device_labels) >= MAX_DEVICE_LABELS:
+                return 'other'
+            device_labels.add(device_id)
+    return device_id
 
 
-def generate_plot():
-    '''Function to generate the plot and save it as an image to the server folder'''
+output_requests = metrics_registry.counter(
+    'sensor_output_requests_total', 'Plot and export downloads served from the result cache (hit) or produced (miss)',
+    labels=('file', 'result'))
+metrics_registry.gauge('sensor_jobs_queued', 'Jobs waiting for a worker thread',
+                       lambda: job_queue.pending() - job_queue.running())
+metrics_registry.gauge('sensor_jobs_running', 'Worker threads processing a job', lambda: job_queue.running())
+metrics_registry.gauge('sensor_result_cache_lookups_total', 'Lookups of processed runs in the result cache',
+                       lambda: {(name,): result_cache.counters[name] for name in ('memory_hits', 'disk_hits', 'misses')},
+                       labels=('result',), kind='counter')
+metrics_registry.gauge('sensor_result_cache_bytes', 'Size of the result cache by level',
+                       lambda: {(level,): result_cache.stats()[f'{level}_bytes'] for level in ('memory', 'disk')},
+                       labels=('level',))
+
+
+def observe_stages(report):
+    '''Adds the times of a processing report (see pipeline) to the stage histogram'''
+    for stage in report.get('stages', ()):
+        stage_seconds.observe(stage['seconds'], stage['stage'])
+
+# Runs older than this (seconds) are moved to the compressed archive tier
+ARCHIVE_AGE = float(os.environ.get('SENSOR_ARCHIVE_AGE', 7 * 24 * 3600))
+# Seconds between two compaction passes
+COMPACTION_INTERVAL = 3600
+# Longest a compaction pass can keep the other worker processes from compacting,
+# in case the process running it dies
+COMPACTION_LEASE = 3600
+# Set by POST /runs/compact to start a compaction pass right away
+compaction_requested = threading.Event()
+# Most samples returned by one /runs/<id>/window request
+MAX_WINDOW_SAMPLES = 100_000
+# Series sent to the dashboard charts, in the order they are drawn
+SERIES_NAMES = ('r', 'r_dot', 'r_ddot', 'theta', 'theta_dot', 'theta_ddot')
+
+# Processing parameters. They are part of the cache key of every processed run
+PROCESSING_PARAMETERS = {
+    'kalman_R': KALMAN_R,
+    'kalman_Q': KALMAN_Q.tolist(),
+    'kalman_P0': KALMAN_P0,
+    'savgol_window': 51,
+    'savgol_order': 3,
+    'angle_voltage_scale': 3.33,  # theta = V / 3.33 * 333.3
+    'angle_range': 333.3,
+    'distance_k': 20.1,  # r = 20.1 * V ** -1.19
+    'distance_exponent': -1.19,
+    'resample_rate': RESAMPLE_RATE,  # Hz of the uniform grid the readings are interpolated on
+    'max_gap': MAX_GAP,  # seconds without samples that split the run in segments
+    # Stages run on every segment, see pipeline.STAGES. By default Savitzky-Golay and
+    # np.gradient, SENSOR_DERIVATIVES=spectral uses the low-pass window and the
+    # derivatives from one FFT per channel instead. SENSOR_PIPELINE lists the stages
+    'stages': (os.environ['SENSOR_PIPELINE'].split(',') if os.environ.get('SENSOR_PIPELINE')
+               else list(DEFAULT_STAGES[os.environ.get('SENSOR_DERIVATIVES', 'gradient')])),
+    'spectral_cutoff': SPECTRAL_CUTOFF,  # Hz kept by the spectral window
+    'spectral_rolloff': SPECTRAL_ROLLOFF,  # Hz over which it falls to zero
+    'threshold': 0.8,  # |values| below it become 0 (threshold stage)
+    'medfilt_kernel': 3,  # samples of the median filter (medfilt stage)
+    'wiener_size': 3,  # samples of the Wiener filter (wiener stage)
+}
+# Fails at startup if the configured stages do not fit together
+get_pipeline(PROCESSING_PARAMETERS)
+# Runs the picos send while they capture them (streaming mode). Their batches are
+# appended to upload files of the run store
+stream_store = StreamStore(run_store.folder, shared_state, PROCESSING_PARAMETERS)
+# Shortest time between two 'stream' events of the same stream, in seconds
+STREAM_EVENT_INTERVAL = 1.
+# Time of the last 'stream' event of each stream sent by this process
+stream_events = {}
+
+# Errors of the pipeline on data it cannot process, e.g. a distance reading of 0
+# makes r infinite and the smoothing raises. The run is not processed again
+PROCESSING_ERRORS = (ValueError, ArithmeticError)
+
+# Output files of a run, stored with the arrays in the result cache.
+# The data exports are produced on demand by /runs/<id>/export.<format>
+OUTPUT_FILES = {'plot.png': 'static/plot.png'}
+
+
+def process_readings(columns, parameters=PROCESSING_PARAMETERS, report=None):
+    '''Function to filter the raw sensor columns and derive the kinematic variables
+    with the stages of the parameters (see pipeline). report, if given, gets the
+    time and memory of every stage.
+    Returns a dictionary with t, r, r_dot, r_ddot, theta, theta_dot and theta_ddot'''
+    return get_pipeline(parameters).run(columns, parameters, report)
+
+
+def generate_plot(filename='received_sensor_readings.json', columns=None, key=None, report=None):
+    '''Function to generate the plot and save it as an image to the server folder.
+    Runs that were already processed with the same parameters come from the cache.
+    columns and key can be passed when the upload was already parsed and hashed
+    while it was being received, then filename is not read. report, if given, gets
+    the statistics of the processing stages and of the plot'''
+    report = {} if report is None else report
+
+    if key is None:
+        with open(filename, 'rb') as file:
+            raw_data = file.read()
+        key = cache_key(raw_data, PROCESSING_PARAMETERS)
+    cached = result_cache.get(key)
+    if cached is not None:
+        with output_lock:
+            for name, path in OUTPUT_FILES.items():
+                if name in cached['files']:
+                    copy_atomically(cached['files'][name], path)
+        report['cache_hit'] = True
+        return cached['arrays']
+
+    if columns is None:
+        columns, skipped = load_sensor_columns(filename)
+    report['cache_hit'] = False
+    results = process_readings(columns, report=report)
+    save_plot(key, results, report)
+    observe_stages(report)
+    return results
+
+
+def save_plot(key, results, report):
+    '''Draws the plot of processed results and keeps both in the result cache.
+    The time of the plot is added to the stages of the report'''
     if not os.path.exists('static'):
         os.makedirs('static')
+    plot_step = {}
+    with output_lock:
+        # Created (and matplotlib imported) before the plot is measured
+        get_plot_renderer()
+        with measure(plot_step, 'plot', results):
+            save_outputs(**results)
+        result_cache.put(key, results, OUTPUT_FILES)
+    report.setdefault('stages', []).extend(plot_step.values())
+
+
+def record_failure(run_id, report, error):
+    '''Keeps the error of a run the pipeline cannot process in its report, so the
+    next reads of the run answer 422 instead of processing it again'''
+    report['error'] = repr(error)
+    run_store.save_report(run_id, report)
+
+
+def process_upload(columns, key, run_id, device_id=DEFAULT_DEVICE):
+    '''Job run after every upload. Returns the id of the processed run'''
+    report = {}
+    try:
+        results = generate_plot(run_store.raw_path(run_id), columns, key, report)
+        # Memory-mapped copy of the processed series for /runs/<id>/window
+        run_store.save_processed(run_id, results)
+        # Time and memory of every stage, for /runs/<id>/pipeline
+        run_store.save_report(run_id, report)
+    except Exception as error:
+        if isinstance(error, PROCESSING_ERRORS):
+            record_failure(run_id, report, error)
+        device_registry.run_processed(device_id, run_id, failed=True)
+        raise
+    # Shown by the dashboards of every worker process
+    shared_state.set_value('latest_run_id', run_id)
+    device_registry.run_processed(device_id, run_id)
+    return run_id
+
+
+def plot_streamed_run(key, results, run_id, report):
+    '''Job run after a stream is closed. Its run was processed while it arrived,
+    only the plot is left. Returns the id of the run'''
+    save_plot(key, results, report)
+    stage_seconds.observe(report['stages'][-1]['seconds'], 'plot')
+    run_store.save_report(run_id, report)
+    return run_id
 
-    Sharp_V_reading, CJMCU103_V_Reading, times = read_json_to_list('received_sensor_readings.json')
-    
-    kf = KalmanFilter(dim_x=2, dim_z=1)
-    kf.x = np.array([[0.], [0.]])  # estado inicial
-    kf.F = np.array([[1., 1.], [0., 1.]])  # matriz de transición
-    kf.H = np.array([[1., 0.]])  # matriz de observación
-    kf.P *= 1000.  # incertidumbre inicial
-    kf.R = 5  # incertidumbre de la medición
-    kf.Q = np.eye(2)  # ruido del proceso
-
-    # Aplicar el filtro de Kalman
-    # Aplicar el filtro de Kalman y asegurar que el tiempo esté sincronizado
-    datos_filtrados_Sharp = []
-    datos_filtrados_CJMCU = []
-    tiempos_filtrados = []  # Tiempo sincronizado
-    for z,theta, t in zip(Sharp_V_reading,CJMCU103_V_Reading, times):
-        kf.predict()
-        kf.update(z)
-        datos_filtrados_Sharp.append(kf.x[0])
-        datos_filtrados_CJMCU.append(kf.x[0])
-        tiempos_filtrados.append(t)  # Mantén el tiempo sincronizado con los datos filtrados
-    '''
-    for z in CJMCU103_V_Reading:
-        kf.predict()
-        kf.update(z)
-        datos_filtrados_CJMCU.append(kf.x[0])
-    '''
-    r=[]
-    theta =[]
-    # Convertir a arrays de numpy
-    for i in range(len(datos_filtrados_Sharp)):
-        r.append(datos_filtrados_Sharp[i][0])
-        theta.append(datos_filtrados_CJMCU[i][0])
-    theta = (np.array(theta) / 3.33 * 333.3) 
-    r = np.power(np.array(r),-1.19)* 20.1
-    t = np.array(tiempos_filtrados)  # Usamos el tiempo filtrado
-    r = savgol_filter(r, window_length=51, polyorder=3)
-    theta = savgol_filter(theta, window_length=51, polyorder=3)
-
-    '''threshold = 0.8
-    # Filter the noise of the distance reading
-    r = [0 if -threshold < x < threshold else x for x in r]
-    r = signal.medfilt(r)
-    r = signal.wiener(r)
-    r = signal.detrend(r)
-
-    # Filter the noise of the angle reading
-    theta = [0 if -threshold < x < threshold else x for x in theta]
-    theta = signal.medfilt(theta)
-    theta = signal.wiener(theta)
-    theta = signal.detrend(theta)
-    
-    '''
-     # --- Derive velocity and acceleration using np.gradient (numerical differentiation) ---
-    dt = np.gradient(t)
-
-    # Linear velocity (dr/dt) and acceleration (d²r/dt²)
-    r_dot = np.gradient(r, dt)  # First derivative: velocity
-    r_ddot = np.gradient(r_dot, dt)  # Second derivative: acceleration
-
-    # Angular velocity (dθ/dt) and angular acceleration (d²θ/dt²)
-    theta_dot = np.gradient(theta, dt)  # Angular velocity
-    theta_ddot = np.gradient(theta_dot, dt)  # Angular acceleration
-
-    # Export data to Excel
-    export_to_excel(t, r, r_dot, r_ddot, theta, theta_dot, theta_ddot)
 
+def process_stored_run(run_id, device_id):
+    '''Job of a run stored while the queue was full. Returns the id of the run'''
+    try:
+        run = run_store.get(run_id)
+        if run is None:
+            # Deleted in the meantime
+            return None
+        if result_cache.get(run['cache_key']) is not None and run_store.has_processed(run_id):
+            # Already processed by run_results on a read
+            shared_state.set_value('latest_run_id', run_id)
+            device_registry.run_processed(device_id, run_id)
+            return run_id
+        columns = run_store.load_columns(run_id, mmap=False)
+        return process_upload(columns, run['cache_key'], run_id, device_id)
+    finally:
+        shared_state.finish_deferred_run(run_id)
+
+
+def defer_run(run_id, device_id):
+    '''Keeps a stored run that found the queue full. The pico has deleted its file
+    once the answer is the success text, so the run is never dropped'''
+    shared_state.defer_run(run_id, device_id)
+    uploads.inc('deferred')
+
+
+def submit_deferred_run():
+    '''Queues the oldest deferred run, if any. Returns the job id or None'''
+    deferred = shared_state.claim_deferred_run()
+    if deferred is None:
+        return None
+    try:
+        return job_queue.submit(process_stored_run, *deferred)
+    except QueueFull:
+        shared_state.release_deferred_run(deferred[0])
+        return None
+
+
+def resume_deferred_runs():
+    '''Queues the deferred runs left by a restart, as many as the queue takes.
+    Returns the number of runs queued'''
+    queued = 0
+    while submit_deferred_run() is not None:
+        queued += 1
+    if queued:
+        print(f"Queued {queued} deferred runs")
+    return queued
+
+
+def find_run(run_id):
+    '''Metadata of a stored run, or None. 'latest' is the last processed run, or the
+    newest stored one after a restart. With ?device= in the request it is the last
+    run of that station, None for an invalid or unknown station'''
+    if run_id == 'latest':
+        device_id = request.args.get('device')
+        if device_id is None:
+            latest = shared_state.get_value('latest_run_id')
+        elif not valid_device_id(device_id):
+            return None
+        else:
+            # A GET never creates a device
+            device = device_registry.find(device_id)
+            latest = device['run_id'] if device else None
+        if latest is None:
+            return run_store.latest(device_id)
+        run_id = latest
+    return run_store.get(run_id)
+
+
+class ProcessingFailed(Exception):
+    '''The pipeline cannot process the data of a run, answered with 422'''
+
+    def __init__(self, run_id, error):
+        super().__init__(error)
+        self.run_id = run_id
+
+
+def run_results(run):
+    '''Processed arrays and cache entry of a stored run. Runs no longer in the result
+    cache are processed again from their stored columns, with their own parameters.
+    Raises ProcessingFailed if the processing of the run failed, now or before'''
+    cached = result_cache.get(run['cache_key'])
+    if cached is None:
+        report = run_store.report(run['id'])
+        if report and 'error' in report:
+            # It would fail the same way again
+            raise ProcessingFailed(run['id'], report['error'])
+        columns = run_store.load_columns(run['id'])
+        if columns is None:
+            return None
+        report = {'cache_hit': False}
+        try:
+            results = process_readings(columns, run['parameters'], report)
+        except PROCESSING_ERRORS as error:
+            record_failure(run['id'], report, error)
+            raise ProcessingFailed(run['id'], report['error']) from error
+        observe_stages(report)
+        run_store.save_report(run['id'], report)
+        result_cache.put(run['cache_key'], results, {})
+        cached = result_cache.get(run['cache_key'])
+        # The plot is drawn by a job, never on a request thread
+        request_plot(run)
+    run_store.save_processed(run['id'], cached['arrays'])
+    return cached
+
+
+def render_run_plot(run_id, key):
+    '''Job that draws the plot of a stored run and keeps it with the run in the
+    result cache. Returns the id of the run'''
+    try:
+        run = run_store.get(run_id)
+        cached = run_results(run) if run else None
+        if cached is None or 'plot.png' in cached['files']:
+            return run_id
+        temporary_path = result_cache.temporary_path(key, 'plot.png')
+        with output_lock:
+            renderer = get_plot_renderer()
+            started = time.perf_counter()
+            renderer.render(cached['arrays'], temporary_path)
+            stage_seconds.observe(time.perf_counter() - started, 'plot')
+        result_cache.add_file(key, 'plot.png', temporary_path)
+        return run_id
+    finally:
+        plot_jobs.pop(key, None)
+
+
+def request_plot(run):
+    '''Queues render_run_plot for a run, once while its job is pending. Returns the
+    job id, None if the queue is full'''
+    job_id = plot_jobs.get(run['cache_key'])
+    status = job_queue.status(job_id) if job_id else None
+    if status is not None and status['state'] in ('queued', 'running'):
+        return job_id
+    try:
+        job_id = job_queue.submit(render_run_plot, run['id'], run['cache_key'])
+    except QueueFull:
+        return None
+    plot_jobs[run['cache_key']] = job_id
+    return job_id
+
+
+def temporary_name(filename):
+    '''Name next to filename that no other thread or worker process writes to'''
+    return f'{filename}.{os.getpid()}-{threading.get_ident()}.tmp'
+
+
+def copy_atomically(source, destination):
+    '''Copies a file so that readers never see it half written'''
+    temporary_destination = temporary_name(destination)
+    shutil.copyfile(source, temporary_destination)
+    os.replace(temporary_destination, destination)
+
+
+def save_outputs(t, r, r_dot, r_ddot, theta, theta_dot, theta_ddot):
+    '''Function to write the plot of a processed run'''
     # --- Plot the results ---
-    
-    # Crear un solo gráfico con subplots
-    fig, axs = plt.subplots(2, 3, figsize=(15, 10))  # 2 filas, 3 columnas
-
-    # Gráficos de r (Distancia)
-    axs[0, 0].plot(t, r, label='Distance (r)')
-    axs[0, 0].set_title('Distance vs Time')
-    axs[0, 0].set_xlabel('Time (s)')
-    axs[0, 0].set_ylabel('Distance (r)')
-    axs[0, 0].legend()
-
-    axs[0, 1].plot(t, r_dot, label='Linear Velocity (dr/dt)')
-    axs[0, 1].set_title('Linear Velocity vs Time')
-    axs[0, 1].set_xlabel('Time (s)')
-    axs[0, 1].set_ylabel('Velocity (dr/dt)')
-    axs[0, 1].legend()
-
-    axs[0, 2].plot(t, r_ddot, label='Linear Acceleration (d²r/dt²)')
-    axs[0, 2].set_title('Linear Acceleration vs Time')
-    axs[0, 2].set_xlabel('Time (s)')
-    axs[0, 2].set_ylabel('Acceleration (d²r/dt²)')
-    axs[0, 2].legend()
-
-    # Gráficos de theta (Ángulo)
-    axs[1, 0].plot(t, theta, color='orange', label='Angle (θ)')
-    axs[1, 0].set_title('Angle vs Time')
-    axs[1, 0].set_xlabel('Time (s)')
-    axs[1, 0].set_ylabel('Angle (θ)')
-    axs[1, 0].legend()
-
-    axs[1, 1].plot(t, theta_dot, color='orange', label='Angular Velocity (dθ/dt)')
-    axs[1, 1].set_title('Angular Velocity vs Time')
-    axs[1, 1].set_xlabel('Time (s)')
-    axs[1, 1].set_ylabel('Velocity (dθ/dt)')
-    axs[1, 1].legend()
-
-    axs[1, 2].plot(t, theta_ddot, color='orange', label='Angular Acceleration (d²θ/dt²)')
-    axs[1, 2].set_title('Angular Acceleration vs Time')
-    axs[1, 2].set_xlabel('Time (s)')
-    axs[1, 2].set_ylabel('Acceleration (d²θ/dt²)')
-    axs[1, 2].legend()
-
-    # Ajustar el layout y guardar la imagen
-    plt.tight_layout()
-    plt.savefig('static/plot.png')
-    plt.close()
+    # The figure is built once and reused, only the data of the lines changes
+    results = {'t': t, 'r': r, 'r_dot': r_dot, 'r_ddot': r_ddot,
+               'theta': theta, 'theta_dot': theta_dot, 'theta_ddot': theta_ddot}
+    get_plot_renderer().render(results, 'static/plot.png')
+
+
+def get_plot_renderer():
+    '''Returns the figure reused for every plot.png, creating it the first time'''
+    global plot_renderer
+    if plot_renderer is None:
+        # Matplotlib handles data visualization
+        from plotting import PlotRenderer
+        plot_renderer = PlotRenderer()
+    return plot_renderer
+
+
+def warmup():
+    '''Loads the processing libraries and renders a small synthetic run to a temporary
+    file, so the first upload does not wait for the imports, the font cache and the
+    first draw of the figure'''
+    started = time.perf_counter()
+    t = np.linspace(0., 1., 200)
+    columns = {'time': t,
+               'distance_reading': 1.5 + 0.1 * np.sin(2 * np.pi * t),
+               'angle_reading': 1.5 + 0.1 * np.cos(2 * np.pi * t)}
+    results = process_readings(columns)
+    with tempfile.TemporaryDirectory() as folder, output_lock:
+        get_plot_renderer().render(results, os.path.join(folder, 'plot.png'))
+    print(f"Warmup done in {time.perf_counter() - started:.2f} s")
+
+
+def compaction_loop(interval=COMPACTION_INTERVAL):
+    '''Archives the runs older than ARCHIVE_AGE every interval seconds, or when requested.
+    Every worker process runs the loop, the lease lets only one of them compact at a time'''
+    while True:
+        try:
+            if shared_state.acquire_lease('compaction', COMPACTION_LEASE):
+                try:
+                    report = run_store.compact(ARCHIVE_AGE)
+                finally:
+                    shared_state.release_lease('compaction')
+                if report['runs']:
+                    print(f"Archived {report['runs']} runs: {report['bytes_before']} -> {report['bytes_after']} bytes")
+        except Exception as error:
+            print(f"Compaction failed: {error!r}")
+        compaction_requested.wait(interval)
+        compaction_requested.clear()
+
+
+def start_compaction():
+    '''Runs compaction_loop() in a background thread'''
+    thread = threading.Thread(target=compaction_loop, name='compaction', daemon=True)
+    thread.start()
+    return thread
+
+
+def start_warmup():
+    '''Runs warmup() in a background thread so the server can answer requests meanwhile'''
+    thread = threading.Thread(target=warmup, name='warmup', daemon=True)
+    thread.start()
+    return thread
+
+
+def request_device():
+    '''Device id sent with the request (?device=), DEFAULT_DEVICE for the picos and
+    pages that do not send one, None if it is not a valid id'''
+    device_id = request.args.get('device', DEFAULT_DEVICE)
+    return device_id if valid_device_id(device_id) else None
 
 
 # When the user presses the 'start reading' button, JavaScript invokes
-# this app route. It sets the start_signal flag to TRUE
+# this app route. It sets the start signal of the station given by ?device=
 @app.route('/start_reading')
 def start_reading():
-    global start_signal
-    start_signal = True
+    device_id = request_device()
+    if device_id is None:
+        return 'Invalid device id', 400
+    device_registry.request_start(device_id)
     return "Start signal set"
 
-# This route is polled continuously by the picoW to check if it should start reading
+# This route is polled continuously by each picoW to check if it should start reading.
+# The pico sends its id in ?device= and only takes the start signal of its station.
+# With ?wait=<seconds> the request is held until the start signal is set or the
+# time runs out (long polling). Without it the flag is returned right away
 @app.route('/check_start_signal')
 def check_start_signal():
-    global start_signal
-    # Respond to the request with the current value of the start_signal flag
-    response = jsonify({'start': start_signal})
-    # Reset the signal after it's checked
-    start_signal = False
-    return response
+    device_id = request_device()
+    if device_id is None:
+        return jsonify({'error': 'invalid device id'}), 400
+    wait = request.args.get('wait', 0, type=float)
+    # nan or inf would hold the request forever
+    if not math.isfinite(wait):
+        return jsonify({'error': 'wait must be a number of seconds'}), 400
+    wait = max(0., min(wait, MAX_START_WAIT))
+    start_polls.inc(device_label(device_id))
+    # Every held poll takes a thread, beyond MAX_LONG_POLLS they are kept short
+    held = wait > SHORT_START_WAIT and long_polls.acquire(blocking=False)
+    if not held:
+        wait = min(wait, SHORT_START_WAIT)
+    try:
+        # The signal is reset once the pico has taken it
+        return jsonify({'start': device_registry.wait_for_start(device_id, wait)})
+    finally:
+        if held:
+            long_polls.release()
+
+
+# Stations known by the server: the ones that polled or uploaded and the ones with stored runs
+@app.route('/devices')
+def list_devices():
+    devices = {device['id']: device for device in device_registry.devices()}
+    for device_id in run_store.devices():
+        if device_id not in devices:
+            devices[device_id] = device_registry.get(device_id)
+    return jsonify(sorted(devices.values(), key=lambda device: device['id']))
 
 # Function to get the JSON data and put into a python list []
 def read_json_to_list(filename):
@@ -213,36 +616,605 @@ def read_json_to_list(filename):
 
     return distance_readings, angle_readings, times
 
-# A function to clear the file when the user is done
-def clear_file(filename):
-    with open(filename, 'w') as file:
-        pass  # Opening in 'w' mode and writing nothing will clear the file
-    image_path = 'static/plot.png'  
-    if os.path.exists(image_path):
-        os.remove(image_path)
-
-# Route for the button to invoke the clear_file function
+# Route for the button to clear the data of a station
 # When the user presses the 'Clear Data' button, JavaScript invokes
 # this app route.
+# The stored runs are kept, the station just stops showing its last run
 @app.route('/clear_data')
 def clear_data():
-    clear_file('received_sensor_readings.json')
+    device_id = request_device()
+    if device_id is None:
+        return 'Invalid device id', 400
+    device_registry.clear(device_id)
+    event_broadcaster.publish('cleared', {'device': device_id})
     return "Data cleared"
 
 
+def store_durably(filename, chunks):
+    '''Writes the chunks to a temporary file, flushes it to disk and renames it to filename'''
+    temporary_filename = temporary_name(filename)
+    try:
+        with open(temporary_filename, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+            # Make sure the bytes are on disk before telling the pico it can delete them
+            f.flush()
+            os.fsync(f.fileno())
+    except BaseException:
+        os.remove(temporary_filename)
+        raise
+    os.replace(temporary_filename, filename)
+    # The rename itself is only on disk once the folder is
+    fsync_directory(os.path.dirname(os.path.abspath(filename)))
+
+
+def read_request_chunks():
+    '''Generator over the body of the request in chunks'''
+    while True:
+        chunk = request.stream.read(512)  # Adjust chunk size as needed
+        if not chunk:
+            break
+        yield chunk
+
+
+def receive_upload(filename, expected_format=None):
+    '''Stores the body of the request in filename while parsing and hashing it, so
+    the columns and the cache key are ready when the last chunk arrives.
+    Raises ValueError, and removes the file, if the data is not a run in
+    expected_format or has no samples. Returns (columns, key)'''
+    parser = StreamingParser()
+    hasher = cache_hasher(PROCESSING_PARAMETERS)
+    started = time.perf_counter()
+    # Bytes received and seconds spent parsing them
+    totals = {'bytes': 0, 'parse': 0.}
+
+    def parsed_chunks():
+        for chunk in read_request_chunks():
+            totals['bytes'] += len(chunk)
+            hasher.update(chunk)
+            parse_started = time.perf_counter()
+            parser.feed(chunk)
+            totals['parse'] += time.perf_counter() - parse_started
+            if expected_format and parser.format not in (None, expected_format):
+                raise ValueError(f'expected a {expected_format} run')
+            yield chunk
+
+    store_durably(filename, parsed_chunks())
+    parse_started = time.perf_counter()
+    try:
+        columns, skipped = parser.finish()
+        # An empty body, or one too short to tell, has no format
+        if expected_format and parser.format != expected_format:
+            raise ValueError(f'expected a {expected_format} run')
+        if not len(columns['time']):
+            raise ValueError('no samples')
+    except (ValueError, struct.error):
+        os.remove(filename)
+        raise
+    totals['parse'] += time.perf_counter() - parse_started
+    upload_bytes.observe(totals['bytes'])
+    upload_seconds.observe(time.perf_counter() - started)
+    stage_seconds.observe(totals['parse'], 'parse')
+    return columns, hasher.hexdigest()
+
+
 # Web route to receive the JSON data as a bit stream and write it onto the file
+# The data is parsed while it arrives. The pico only waits until it is safely
+# stored, the plot is generated afterwards by the job queue
 @app.route('/upload_json', methods=['POST'])
 def upload_json():
-    with open('received_sensor_readings.json', 'wb') as f:
-        while True:
-            chunk = request.stream.read(512)  # Adjust chunk size as needed
-            if not chunk:
-                break
-            f.write(chunk)
+    # Each station uploads with its id in ?device=
+    device_id = request_device()
+    if device_id is None:
+        return 'Invalid device id', 400
+    # The Content-Type tells the binary runs of the new firmware from the JSON lines
+    binary = request.mimetype == BINARY_CONTENT_TYPE
+    # Every upload gets a file of its own, so simultaneous uploads never mix
+    filename = run_store.upload_path('bin' if binary else 'json')
+    try:
+        columns, key = receive_upload(filename, 'binary' if binary else None)
+    except (ValueError, struct.error) as error:
+        uploads.inc('invalid')
+        return f'Invalid run: {error}', 400
+    # Keep the run in the store, the upload file moves into its folder
+    columns = sort_by_time(columns)
+    run = run_store.add(columns, device=device_id,
+                        parameters=PROCESSING_PARAMETERS, cache_key=key,
+                        raw_format='binary' if binary else 'ndjson', raw_path=filename)
+
+    device_registry.upload_received(device_id, run['id'])
+
     # Generate the new plot with the just uploaded data
-    generate_plot()
-    return 'JSON file received successfully'
-    
+    try:
+        job_id = job_queue.submit(process_upload, columns, key, run['id'], device_id)
+    except QueueFull:
+        # The pico does not send a run twice and overwrites its file with the next
+        # capture, so the stored run is kept and processed later
+        defer_run(run['id'], device_id)
+        return 'JSON file received successfully', 202, {'X-Run-Id': run['id']}
+    uploads.inc('accepted')
+    # The pico compares the body with this exact text, the job id goes in the headers
+    return 'JSON file received successfully', 202, {'X-Job-Id': job_id, 'Location': f'/jobs/{job_id}',
+                                                    'X-Run-Id': run['id']}
+
+
+# Status of a processing job: queued, running, done or failed, whatever worker
+# process runs it. 'latest' returns the job of the most recent upload
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    if job_id == 'latest':
+        job_id = shared_state.latest_job_id()
+    status = job_queue.status(job_id) or shared_state.job(job_id)
+    if status is None:
+        return jsonify({'error': 'unknown job'}), 404
+    return jsonify(status)
+
+
+def finite_list(values):
+    '''Converts an array to a list of floats with 6 significant digits, for JSON.
+    NaN and infinite values become None (null)'''
+    return [float(f'{value:.6g}') if np.isfinite(value) else None for value in values.tolist()]
+
+
+# Catalog of the stored runs, newest first. Only the catalog is read, the sample
+# files are not opened. Parameters: limit (page size), offset and device (optional)
+@app.route('/runs')
+def list_runs():
+    limit = request.args.get('limit', 50, type=int)
+    offset = max(0, request.args.get('offset', 0, type=int))
+    device = request.args.get('device')
+    runs, total = run_store.list_runs(limit, offset, device)
+    next_offset = offset + len(runs)
+    return jsonify({'runs': runs, 'total': total, 'offset': offset,
+                    'next_offset': next_offset if next_offset < total else None})
+
+
+# Starts a compaction pass now instead of waiting for the next one
+@app.route('/runs/compact', methods=['POST'])
+def compact_runs():
+    compaction_requested.set()
+    return jsonify({'archive_age': ARCHIVE_AGE}), 202
+
+
+# Metadata of one run (GET) or deletion of the run and its files (DELETE)
+@app.route('/runs/<run_id>', methods=['GET', 'DELETE'])
+def run_detail(run_id):
+    run = find_run(run_id)
+    if run is None:
+        return jsonify({'error': 'unknown run'}), 404
+    if request.method == 'DELETE':
+        run_store.delete(run['id'])
+        if shared_state.get_value('latest_run_id') == run['id']:
+            shared_state.set_value('latest_run_id', None)
+        device_registry.forget_run(run['id'])
+        return jsonify({'deleted': run['id']})
+    return jsonify(run)
+
+
+# Reads of a run the pipeline cannot process (see run_results)
+@app.errorhandler(ProcessingFailed)
+def processing_failed(error):
+    return jsonify({'error': 'the run could not be processed', 'run_id': error.run_id,
+                    'reason': str(error)}), 422
+
+
+# Plot of a run, drawn by a job after the processing and kept with the run in the
+# result cache. A plot that is not there yet (a run processed again after leaving
+# the cache) answers 202 with the job that draws it.
+# static/plot.png is only the plot of the last run of any station
+@app.route('/runs/<run_id>/plot.png')
+def run_plot(run_id):
+    run = find_run(run_id)
+    cached = run_results(run) if run else None
+    if cached is None:
+        return jsonify({'error': 'unknown run'}), 404
+    path = cached['files'].get('plot.png')
+    output_requests.inc('plot', 'hit' if path else 'miss')
+    if path is None:
+        job_id = request_plot(run)
+        if job_id is None:
+            return jsonify({'error': 'server busy'}), 503, {'Retry-After': '5'}
+        return jsonify({'run_id': run['id'], 'job_id': job_id}), 202, {'Location': f'/jobs/{job_id}',
+                                                                       'Retry-After': '1'}
+    return send_file(path, mimetype='image/png', conditional=True)
+
+
+# Time, peak memory and sizes of every processing stage of a run, from its last processing
+@app.route('/runs/<run_id>/pipeline')
+def run_pipeline(run_id):
+    run = find_run(run_id)
+    report = run_store.report(run['id']) if run else None
+    if report is None:
+        return jsonify({'error': 'run not processed'}), 404
+    return jsonify(dict(report, run_id=run['id']))
+
+
+# Raw sample columns of a run as received from the pico
+@app.route('/runs/<run_id>/samples')
+def run_samples(run_id):
+    run = find_run(run_id)
+    columns = run_store.load_columns(run['id']) if run else None
+    if columns is None:
+        return jsonify({'error': 'unknown run'}), 404
+    return compressed_json(f'"{run["id"]}-samples"',
+                           {'run_id': run['id'], 'columns': {name: values.tolist() for name, values in columns.items()}})
+
+
+def json_list(values):
+    '''Converts an array to a list of floats for JSON, NaN and infinite values become None'''
+    values = np.asarray(values, dtype=np.float64)
+    converted = values.astype(object)
+    converted[~np.isfinite(values)] = None
+    return converted.tolist()
+
+
+# Samples of a run inside a time window, read from the memory-mapped columns (or
+# from the chunks of an archived run that can hold them).
+# Parameters: t0 and t1 (optional, seconds), kind ('raw' or 'processed'),
+# column with min and/or max to keep only the rows where that column is in range,
+# and max_samples. Longer windows are cut and next_t0 tells where the next page starts.
+# start:end is the slice of the whole run that holds the rows of the window
+@app.route('/runs/<run_id>/window')
+def run_window(run_id):
+    time_window = requested_window()
+    if time_window is None:
+        return jsonify({'error': 't0 and t1 must be numbers'}), 400
+    run = find_run(run_id)
+    if run is None:
+        return jsonify({'error': 'unknown run'}), 404
+    kind = request.args.get('kind', 'raw')
+    if kind not in ('raw', 'processed'):
+        return jsonify({'error': 'kind must be raw or processed'}), 400
+    processed = kind == 'processed'
+    if processed and not run_store.has_processed(run['id']) and run_results(run) is None:
+        return jsonify({'error': 'unknown run'}), 404
+    max_samples = max(1, min(request.args.get('max_samples', 10_000, type=int), MAX_WINDOW_SAMPLES))
+    column = request.args.get('column')
+    if column is not None and column not in (SERIES_NAMES if processed else SENSOR_KEYS):
+        return jsonify({'error': f'unknown column {column}'}), 400
+
+    window = run_store.window(run['id'], *time_window, processed, column,
+                              request.args.get('min', type=float), request.args.get('max', type=float))
+    if window is None:
+        return jsonify({'error': 'unknown run'}), 404
+    columns, start, end = window
+    times = columns['t' if processed else 'time']
+    next_t0 = float(times[max_samples]) if len(times) > max_samples else None
+    etag = '"{}-{}-{}-{}-{}"'.format(run['id'], kind, start, end, request.query_string.decode())
+    return compressed_json(etag, {
+        'run_id': run['id'],
+        'kind': kind,
+        'start': start,
+        'end': end,
+        'n_window': len(times),
+        'n_samples': run['n_samples'],
+        'next_t0': next_t0,
+        'columns': {name: json_list(values[:max_samples]) for name, values in columns.items()},
+    })
+
+
+# Processed series of a run, reduced with LTTB to about one point per pixel
+# so the payload does not grow with the length of the run.
+# Parameters: width (points per series), t0 and t1 (time window, optional).
+# 'latest' is the last processed run
+@app.route('/runs/<run_id>/series')
+def run_series(run_id):
+    window = requested_window()
+    if window is None:
+        return jsonify({'error': 't0 and t1 must be numbers'}), 400
+    run = find_run(run_id)
+    run_id = run['id'] if run else None
+    width = max(3, min(request.args.get('width', 800, type=int), 5000))
+    # A processed run never changes, the same request always gets the same answer
+    etag = '"{}-{}-{}-{}"'.format(run_id, width, request.args.get('t0', ''), request.args.get('t1', ''))
+    if run_id and request.if_none_match.contains(etag.strip('"')):
+        return '', 304, {'ETag': etag}
+    cached = run_results(run) if run else None
+    if cached is None:
+        return jsonify({'error': 'unknown run'}), 404
+    return compressed_json(etag, dict({'run_id': run_id}, **series_payload(cached['arrays'], width, *window)))
+
+
+def requested_window():
+    '''(t0, t1) of the request, each None when it is not given. None when one of
+    them is not a number'''
+    window = []
+    for name in ('t0', 't1'):
+        value = request.args.get(name, type=float)
+        if name in request.args and (value is None or math.isnan(value)):
+            return None
+        window.append(value)
+    return tuple(window)
+
+
+def series_payload(arrays, width, t0=None, t1=None):
+    '''Series of the processed arrays between t0 and t1 (seconds, optional),
+    reduced with LTTB to about width points each'''
+    t = arrays['t']
+    start, end = 0, len(t)
+    if t0 is not None:
+        start = int(np.searchsorted(t, t0, side='left'))
+    if t1 is not None:
+        end = int(np.searchsorted(t, t1, side='right'))
+    t = t[start:end]
+
+    series = {}
+    for name in SERIES_NAMES:
+        y = arrays[name][start:end]
+        indices = lttb_indices(t, y, width)
+        series[name] = {'t': finite_list(t[indices]), 'y': finite_list(y[indices])}
+    return {
+        'n_samples': len(arrays['t']),
+        'n_window': len(t),
+        't_range': finite_list(arrays['t'][[0, -1]]) if len(arrays['t']) else [],
+        'series': series,
+    }
+
+
+# Streaming mode of the pico: it opens a stream with the header of its binary run,
+# sends the records in batches while it captures them (?offset= is the number of
+# records it sent before the batch) and ends the stream when the sweep is over.
+# The batches are processed as they arrive (see online), the dashboards get a
+# 'stream' event about every STREAM_EVENT_INTERVAL and the partial series are at
+# /streams/<id>/series. The end answers like /upload_json
+@app.route('/streams', methods=['POST'])
+def open_stream():
+    device_id = request_device()
+    if device_id is None:
+        return 'Invalid device id', 400
+    try:
+        info = stream_store.open(device_id, request.get_data())
+    except (ValueError, struct.error) as error:
+        return f'Invalid binary run header: {error}', 400
+    event_broadcaster.publish('stream', stream_status(info['id']))
+    # The pico reads the id from the body
+    return info['id'], 201, {'Location': f"/streams/{info['id']}"}
+
+
+def stream_status(stream_id, stream=None):
+    '''Metadata of a stream plus its progress in this process, or None'''
+    info = stream_store.info(stream_id)
+    if info is None:
+        return None
+    if info['state'] != 'done':
+        stream = stream or stream_store.get(stream_id)
+        if stream is not None:
+            info.update(stream.status())
+    return info
+
+
+def publish_stream(stream_id, stream):
+    '''Tells the dashboards how far a stream is, at most every STREAM_EVENT_INTERVAL'''
+    now = time.monotonic()
+    if now - stream_events.get(stream_id, 0.) < STREAM_EVENT_INTERVAL:
+        return
+    stream_events[stream_id] = now
+    status = stream_status(stream_id, stream)
+    if status is not None:
+        event_broadcaster.publish('stream', status)
+
+
+@app.route('/streams/<stream_id>/records', methods=['POST'])
+def stream_records(stream_id):
+    offset = request.args.get('offset', type=int)
+    if offset is None or offset < 0:
+        return 'Missing ?offset=', 400
+    try:
+        stream = stream_store.append(stream_id, offset, request.get_data())
+    except KeyError:
+        return 'Unknown stream', 404
+    except StreamError as error:
+        stream_batches.inc('refused')
+        if error.expected is None:
+            return str(error), 400
+        # The pico can send again from the offset in X-Records
+        return str(error), 409, {'X-Records': str(error.expected)}
+    stream_batches.inc('accepted')
+    publish_stream(stream_id, stream)
+    return 'OK', 200, {'X-Records': str(stream.records)}
+
+
+@app.route('/streams/<stream_id>/end', methods=['POST'])
+def close_stream(stream_id):
+    info = stream_store.info(stream_id)
+    if info is None:
+        return 'Unknown stream', 404
+    if info['state'] == 'done':
+        # The answer to the first end was lost, the run is already there
+        return 'JSON file received successfully', 200, {'X-Run-Id': info['run_id']}
+    device_id = info['device']
+    try:
+        stream, series, report = stream_store.close(stream_id)
+    except KeyError:
+        return 'Unknown stream', 404
+    with open(stream.path, 'rb') as file:
+        raw_data = file.read()
+    # Same key as the upload of the whole file
+    key = cache_key(raw_data, PROCESSING_PARAMETERS)
+    columns, _ = binary_to_columns(raw_data)
+    del raw_data
+    run = run_store.add(columns, device=device_id, parameters=PROCESSING_PARAMETERS, cache_key=key,
+                        raw_format='binary', raw_path=stream.path)
+    stream_store.closed(stream_id, run['id'])
+    stream_events.pop(stream_id, None)
+    event_broadcaster.publish('stream', stream_status(stream_id))
+    device_registry.upload_received(device_id, run['id'])
+    headers = {'X-Run-Id': run['id']}
+
+    if series is None:
+        # The pipeline has stages without an online version, the run is processed now
+        try:
+            job_id = job_queue.submit(process_upload, columns, key, run['id'], device_id)
+        except QueueFull:
+            # Kept and processed later, as in upload_json
+            defer_run(run['id'], device_id)
+            return 'JSON file received successfully', 202, headers
+        uploads.inc('accepted')
+        headers.update({'X-Job-Id': job_id, 'Location': f'/jobs/{job_id}'})
+        return 'JSON file received successfully', 202, headers
+
+    # Processed while it arrived: the run is ready, the plot is drawn by a job
+    report['cache_hit'] = False
+    result_cache.put(key, series, {})
+    run_store.save_processed(run['id'], series)
+    run_store.save_report(run['id'], report)
+    observe_stages(report)
+    shared_state.set_value('latest_run_id', run['id'])
+    device_registry.run_processed(device_id, run['id'])
+    uploads.inc('accepted')
+    try:
+        job_id = job_queue.submit(plot_streamed_run, key, series, run['id'], report)
+        headers.update({'X-Job-Id': job_id, 'Location': f'/jobs/{job_id}'})
+    except QueueFull:
+        # /runs/<id>/plot.png draws it when it is requested
+        pass
+    return 'JSON file received successfully', 200, headers
+
+
+# Metadata and progress of a stream: device, state (capturing or done), run_id
+# once it is closed, records, duration, samples processed and segments
+@app.route('/streams/<stream_id>')
+def stream_detail(stream_id):
+    status = stream_status(stream_id)
+    if status is None:
+        return jsonify({'error': 'unknown stream'}), 404
+    return jsonify(status)
+
+
+# Processed series of a stream so far, like /runs/<id>/series. A closed stream
+# answers with the series of its run
+@app.route('/streams/<stream_id>/series')
+def stream_series(stream_id):
+    info = stream_store.info(stream_id)
+    if info is None:
+        return jsonify({'error': 'unknown stream'}), 404
+    if info['state'] == 'done':
+        return redirect(url_for('run_series', run_id=info['run_id'], **request.args))
+    window = requested_window()
+    if window is None:
+        return jsonify({'error': 't0 and t1 must be numbers'}), 400
+    stream = stream_store.get(stream_id)
+    if stream is None or stream.pipeline is None:
+        return jsonify({'error': 'the stream is not processed online'}), 404
+    width = max(3, min(request.args.get('width', 800, type=int), 5000))
+    with stream.lock:
+        arrays = stream.pipeline.results()
+        samples = stream.pipeline.samples
+    # Changes with every batch
+    etag = '"{}-{}-{}-{}"'.format(stream_id, samples, width, request.query_string.decode())
+    if request.if_none_match.contains(etag.strip('"')):
+        return '', 304, {'ETag': etag}
+    payload = series_payload(arrays, width, *window)
+    return compressed_json(etag, dict({'run_id': None, 'stream_id': stream_id}, **payload))
+
+
+def compressed_json(etag, payload):
+    '''JSON response, gzip compressed when the browser accepts it'''
+    body = json.dumps(payload, separators=(',', ':')).encode()
+    headers = {'Content-Type': 'application/json', 'Vary': 'Accept-Encoding', 'ETag': etag,
+               'Cache-Control': 'no-cache'}
+    if 'gzip' in request.headers.get('Accept-Encoding', ''):
+        body = gzip.compress(body, compresslevel=5)
+        headers['Content-Encoding'] = 'gzip'
+    return body, 200, headers
+
+
+# Download of the data of a run, produced the first time it is requested and then
+# kept with the run in the result cache. Formats: csv, npy, npz, xlsx and parquet
+# (when pyarrow is installed). Cached exports support HTTP Range requests.
+# 'latest' is the last processed run
+@app.route('/runs/<run_id>/export.<export_format>')
+def run_export(run_id, export_format):
+    if export_format not in exports.available_formats():
+        return jsonify({'error': 'unknown format', 'formats': exports.available_formats()}), 404
+    run = find_run(run_id)
+    cached = run_results(run) if run else None
+    if cached is None:
+        return jsonify({'error': 'unknown run'}), 404
+    run_id, key = run['id'], run['cache_key']
+
+    name = f'export.{export_format}'
+    download_name = f'sensor_data_{run_id[:12]}.{export_format}'
+    mimetype = exports.MIMETYPES[export_format]
+    path = cached['files'].get(name)
+    output_requests.inc('export', 'hit' if path else 'miss')
+    if path is None and export_format in exports.STREAMED_FORMATS and request.range is None:
+        # First download: send the chunks while they are produced and keep a copy
+        chunks = save_export_chunks(key, name, exports.export_chunks(export_format, cached['arrays']))
+        return Response(stream_with_context(chunks), mimetype=mimetype,
+                        headers={'Content-Disposition': f'attachment; filename={download_name}'})
+    if path is None:
+        # Ranges need the size of the whole file, so it is written before answering
+        temporary_path = result_cache.temporary_path(key, name)
+        started = time.perf_counter()
+        try:
+            exports.write_export(export_format, cached['arrays'], temporary_path)
+            stage_seconds.observe(time.perf_counter() - started, 'export')
+        except BaseException:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise
+        path = result_cache.add_file(key, name, temporary_path)
+        if path is None:
+            return jsonify({'error': 'unknown run'}), 404
+    return send_file(path, mimetype=mimetype, as_attachment=True, download_name=download_name, conditional=True)
+
+
+def save_export_chunks(key, name, chunks):
+    '''Yields the chunks of an export while writing them to the result cache entry key.
+    The copy is only kept if the whole export was sent'''
+    temporary_path = result_cache.temporary_path(key, name)
+    complete = False
+    # Time spent producing the chunks, without the time the client takes to read them
+    producing = 0.
+    try:
+        with open(temporary_path, 'wb') as file:
+            chunks = iter(chunks)
+            while True:
+                started = time.perf_counter()
+                chunk = next(chunks, None)
+                producing += time.perf_counter() - started
+                if chunk is None:
+                    break
+                file.write(chunk)
+                yield chunk
+        complete = True
+        stage_seconds.observe(producing, 'export')
+    finally:
+        if complete:
+            result_cache.add_file(key, name, temporary_path)
+        elif os.path.exists(temporary_path):
+            os.remove(temporary_path)
+
+
+# Stream of Server-Sent Events for the dashboard: 'job' when a job changes state
+# (the run id is in its result once it is done), 'cleared' after /clear_data and
+# 'stream' while a run is streamed
+@app.route('/events')
+def events():
+    last_id = request.headers.get('Last-Event-ID', type=int)
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    if not event_streams.acquire(blocking=False):
+        # Every stream holds a thread. The browser connects again after the retry
+        # and catches up with the devices on 'open'
+        return Response(f'retry: {EVENT_STREAM_RETRY}\n\n', mimetype='text/event-stream', headers=headers)
+    response = Response(event_broadcaster.stream(last_id), mimetype='text/event-stream', headers=headers)
+    response.call_on_close(event_streams.release)
+    return response
+
+
+# Counters and histograms of this worker process in the Prometheus text format
+@app.route('/metrics')
+def metrics():
+    return Response(metrics_registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8',
+                    headers={'Cache-Control': 'no-cache'})
+
+
+# Hit and miss counters of the result cache
+@app.route('/cache_stats')
+def cache_stats():
+    return jsonify(result_cache.stats())
+
 
 
 # This app route of the server displays the webpage.
@@ -252,10 +1224,20 @@ def display_messages():
     #readings, times = read_json_to_list('received_sensor_readings.json')
     #readings_times = zip(times, readings)
     #return render_template('messages.html', readings_times=readings_times)
-    return render_template('messages.html')
+    return render_template('messages.html', default_device=DEFAULT_DEVICE)
 
 
+# Under a multi-worker WSGI server each worker process starts the background tasks,
+# e.g. from the post_fork hook of gunicorn: start_warmup(), start_compaction() and
+# resume_deferred_runs()
 if __name__ == '__main__':
+    # With debug=True the reloader runs this file twice, only the child process serves.
+    # SENSOR_WARMUP=0 disables the warmup
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        if os.environ.get('SENSOR_WARMUP', '1') != '0':
+            start_warmup()
+        start_compaction()
+        resume_deferred_runs()
     app.run(debug=True, host='0.0.0.0')
 
 